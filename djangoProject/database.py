@@ -0,0 +1,105 @@
+import contextvars
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# With a 'replica' database configured, catalog reads (the store app) go to the
+# replica and everything else, writes and cart reads included, to the primary.
+# Reads stick to the primary for REPLICA_LAG seconds:
+#   - for a visitor after their own writes, carried in the PIN_COOKIE cookie
+#   - for everyone after a write to CATALOG_MODELS, so the version bumps of
+#     store.cache are never followed by stale rows from the replica being cached
+#   - for the rest of a request once it has written anything
+# Pinning is kept on the RequestState that PrimaryPinMiddleware installs for a
+# request. Outside of requests (management commands, the shell) nothing is
+# pinned, only reads inside a transaction go to the primary.
+REPLICA = 'replica'
+REPLICA_APPS = {'store'}
+CATALOG_MODELS = {'store.product', 'store.category'}
+PIN_COOKIE = 'primary_pin'
+CATALOG_WRITE_KEY = 'db:catalog_write'
+
+_request_state = contextvars.ContextVar('replica_request_state', default=None)
+
+
+class RequestState:
+    def __init__(self, pinned):
+        self.pinned = pinned
+        self.wrote = False
+
+
+def has_replica():
+    return REPLICA in settings.DATABASES
+
+
+def get_replica_lag():
+    return getattr(settings, 'REPLICA_LAG', 5)
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        state = _request_state.get()
+        if (
+            model._meta.app_label in REPLICA_APPS and has_replica() and not (state and state.pinned)
+            and not connections[DEFAULT_DB_ALIAS].in_atomic_block
+        ):
+            return REPLICA
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        state = _request_state.get()
+        if state is not None:
+            state.pinned = state.wrote = True
+        if model._meta.label_lower in CATALOG_MODELS and has_replica():
+            cache.set(CATALOG_WRITE_KEY, True, get_replica_lag())
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica holds the same rows
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+class PrimaryPinMiddleware:
+    """Pins the reads of a request to the primary when it has to see recent writes"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not has_replica():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        state = self.get_state(request, cache.get(CATALOG_WRITE_KEY))
+        token = _request_state.set(state)
+        try:
+            return self.finish(state, self.get_response(request))
+        finally:
+            _request_state.reset(token)
+
+    async def __acall__(self, request):
+        state = self.get_state(request, await cache.aget(CATALOG_WRITE_KEY))
+        token = _request_state.set(state)
+        try:
+            return self.finish(state, await self.get_response(request))
+        finally:
+            _request_state.reset(token)
+
+    def get_state(self, request, catalog_written):
+        return RequestState(PIN_COOKIE in request.COOKIES or bool(catalog_written))
+
+    def finish(self, state, response):
+        if state.wrote:
+            response.set_cookie(PIN_COOKIE, '1', max_age=get_replica_lag(), httponly=True, samesite='Lax')
+        return response
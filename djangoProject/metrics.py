@@ -0,0 +1,323 @@
+import atexit
+import contextvars
+import hmac
+import json
+import os
+import random
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from pathlib import Path
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache.backends.locmem import LocMemCache as BaseLocMemCache
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.http import Http404, HttpResponse
+
+# A METRICS_SAMPLE_RATE share of requests is measured: wall time, SQL queries
+# (count, time and exact repeats), cache hits and misses and template render
+# time, per URL name. Each process keeps histograms of its own and writes them
+# to METRICS_DIR every METRICS_FLUSH_INTERVAL seconds; the metrics view adds up
+# the files of all workers in Prometheus text format for a scraper holding
+# METRICS_TOKEN. With the rate at 0 the middleware is not loaded, what is left
+# is a context variable lookup per query and cache read.
+PREFIX = 'django_'
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+HISTOGRAMS = {
+    'request_duration_seconds': ('Wall time of sampled requests', TIME_BUCKETS),
+    'request_queries': ('SQL queries per sampled request', COUNT_BUCKETS),
+    'request_query_seconds': ('Time spent in SQL per sampled request', TIME_BUCKETS),
+    'request_template_seconds': ('Template render time per sampled request', TIME_BUCKETS),
+}
+COUNTERS = {
+    'request_duplicate_queries_total': 'Queries that repeat an earlier query of the same request with the same parameters',
+    'request_cache_hits_total': 'Cache reads of sampled requests that found a value',
+    'request_cache_misses_total': 'Cache reads of sampled requests that found nothing',
+}
+
+_sample = contextvars.ContextVar('metrics_sample', default=None)
+_missing = object()
+
+
+class Sample:
+    """What one request spent, filled in by the query wrapper and the cache backends"""
+
+    def __init__(self):
+        self.queries = Counter()
+        self.query_time = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.template_time = 0
+        self.render_started = None
+
+    def rendered(self, response):
+        self.template_time += time.perf_counter() - self.render_started
+
+
+class Registry:
+    """Histograms and counters of this process, by metric and view"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (name, view) -> [count per bucket (+Inf last), sum]
+        self.histograms = {}
+        self.counters = Counter()
+        self.flushed_at = time.monotonic()
+
+    def observe(self, name, view, value):
+        buckets = HISTOGRAMS[name][1]
+        with self.lock:
+            series = self.histograms.setdefault((name, view), [0] * (len(buckets) + 2))
+            series[bisect_left(buckets, value)] += 1
+            series[-1] += value
+
+    def add(self, name, view, value):
+        if value:
+            with self.lock:
+                self.counters[(name, view)] += value
+
+    def record(self, view, sample, duration):
+        self.observe('request_duration_seconds', view, duration)
+        self.observe('request_queries', view, sum(sample.queries.values()))
+        self.observe('request_query_seconds', view, sample.query_time)
+        self.observe('request_template_seconds', view, sample.template_time)
+        self.add('request_duplicate_queries_total', view, sum(count - 1 for count in sample.queries.values()))
+        self.add('request_cache_hits_total', view, sample.cache_hits)
+        self.add('request_cache_misses_total', view, sample.cache_misses)
+        if time.monotonic() - self.flushed_at >= getattr(settings, 'METRICS_FLUSH_INTERVAL', 10):
+            self.write()
+
+    def write(self):
+        """Replace this process's file in METRICS_DIR with its current totals"""
+        with self.lock:
+            self.flushed_at = time.monotonic()
+            if not self.histograms and not self.counters:
+                return
+            data = {
+                'histograms': [[name, view, series] for (name, view), series in self.histograms.items()],
+                'counters': [[name, view, value] for (name, view), value in self.counters.items()],
+            }
+        directory = Path(settings.METRICS_DIR)
+        directory.mkdir(parents=True, exist_ok=True)
+        # Written aside and renamed, so a reader never sees half a file
+        temporary = directory / f'.{os.getpid()}.json'
+        temporary.write_text(json.dumps(data))
+        os.replace(temporary, directory / f'{os.getpid()}.json')
+
+
+registry = Registry()
+atexit.register(registry.write)
+
+
+def is_running(pid):
+    if os.name != 'posix':
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Running as another user
+        pass
+    return True
+
+
+def is_stale(file):
+    """Whether a worker file belongs to a process that exited or stopped writing"""
+    max_age = getattr(settings, 'METRICS_FLUSH_INTERVAL', 10) * getattr(settings, 'METRICS_STALE_INTERVALS', 30)
+    # The age also catches pids reused by another process. An idle worker drops
+    # out too, until its next sampled request writes the file again.
+    return not is_running(int(file.stem)) or time.time() - file.stat().st_mtime > max_age
+
+
+def collect():
+    """Totals of every live process that wrote to METRICS_DIR, the files of the others are removed"""
+    histograms, counters = {}, Counter()
+    # Not the .<pid>.json files being written
+    for file in Path(settings.METRICS_DIR).glob('[!.]*.json'):
+        try:
+            if is_stale(file):
+                file.unlink(missing_ok=True)
+                continue
+            data = json.loads(file.read_text())
+        except (OSError, ValueError):
+            # Removed or replaced while reading, or not a worker file
+            continue
+        for name, view, series in data['histograms']:
+            if name in HISTOGRAMS:
+                total = histograms.setdefault((name, view), [0] * len(series))
+                for i, value in enumerate(series):
+                    total[i] += value
+        for name, view, value in data['counters']:
+            if name in COUNTERS:
+                counters[(name, view)] += value
+    return histograms, counters
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render(histograms, counters):
+    lines = [
+        f'# HELP {PREFIX}metrics_sample_rate Share of requests that are measured',
+        f'# TYPE {PREFIX}metrics_sample_rate gauge',
+        f'{PREFIX}metrics_sample_rate {getattr(settings, "METRICS_SAMPLE_RATE", 0)}',
+    ]
+    for name, (description, buckets) in HISTOGRAMS.items():
+        lines += [f'# HELP {PREFIX}{name} {description}', f'# TYPE {PREFIX}{name} histogram']
+        for (series_name, view), series in sorted(histograms.items()):
+            if series_name != name:
+                continue
+            label = f'view="{escape(view)}"'
+            cumulative = 0
+            for bound, count in zip([*buckets, '+Inf'], series):
+                cumulative += count
+                lines.append(f'{PREFIX}{name}_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f'{PREFIX}{name}_sum{{{label}}} {series[-1]}')
+            lines.append(f'{PREFIX}{name}_count{{{label}}} {cumulative}')
+    for name, description in COUNTERS.items():
+        lines += [f'# HELP {PREFIX}{name} {description}', f'# TYPE {PREFIX}{name} counter']
+        for (series_name, view), value in sorted(counters.items()):
+            if series_name == name:
+                lines.append(f'{PREFIX}{name}{{view="{escape(view)}"}} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view(request):
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    authorization = request.headers.get('Authorization', '')
+    if not token or not hmac.compare_digest(authorization.encode(), f'Bearer {token}'.encode()):
+        raise Http404
+    # Up to date for the process that answers, the others lag by a flush interval
+    registry.write()
+    return HttpResponse(render(*collect()), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def record_query(execute, sql, params, many, context):
+    sample = _sample.get()
+    if sample is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        sample.query_time += time.perf_counter() - started
+        sample.queries[(sql, repr(params))] += 1
+
+
+def add_query_recorder(sender=None, connection=None, **kwargs):
+    # Sent again when a persistent connection reconnects
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def install_query_recorder():
+    connection_created.connect(add_query_recorder, dispatch_uid='metrics')
+    # Those opened before, in this thread
+    for connection in connections.all(initialized_only=True):
+        add_query_recorder(connection=connection)
+
+
+class MetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.sample_rate = getattr(settings, 'METRICS_SAMPLE_RATE', 0)
+        if not self.sample_rate:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        install_query_recorder()
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+            # A sync hook would cost every async template response a thread
+            self.process_template_response = self.aprocess_template_response
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if random.random() >= self.sample_rate:
+            return self.get_response(request)
+        sample = Sample()
+        token = _sample.set(sample)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _sample.reset(token)
+        self.record(request, sample, time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        if random.random() >= self.sample_rate:
+            return await self.get_response(request)
+        sample = Sample()
+        token = _sample.set(sample)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _sample.reset(token)
+        self.record(request, sample, time.perf_counter() - started)
+        return response
+
+    def record(self, request, sample, duration):
+        match = request.resolver_match
+        view = match.view_name if match else 'unresolved'
+        if view != 'metrics':
+            registry.record(view, sample, duration)
+
+    def process_template_response(self, request, response):
+        return self.time_render(response)
+
+    async def aprocess_template_response(self, request, response):
+        return self.time_render(response)
+
+    def time_render(self, response):
+        sample = _sample.get()
+        if sample is not None:
+            # Django renders right after the last of these hooks, this one being outermost
+            sample.render_started = time.perf_counter()
+            response.add_post_render_callback(sample.rendered)
+        return response
+
+
+class CacheMetricsMixin:
+    """Counts the hits and misses of sampled requests, get_many and aget included"""
+
+    def get(self, key, default=None, version=None, **kwargs):
+        sample = _sample.get()
+        if sample is None:
+            return super().get(key, default, version, **kwargs)
+        value = super().get(key, _missing, version, **kwargs)
+        if value is _missing:
+            sample.cache_misses += 1
+            return default
+        sample.cache_hits += 1
+        return value
+
+
+class LocMemCache(CacheMetricsMixin, BaseLocMemCache):
+    pass
+
+
+try:
+    from django_redis.cache import RedisCache as BaseRedisCache
+except ImportError:
+    pass
+else:
+    class RedisCache(CacheMetricsMixin, BaseRedisCache):
+        def get_many(self, keys, version=None, **kwargs):
+            keys = list(keys)
+            values = super().get_many(keys, version=version, **kwargs)
+            sample = _sample.get()
+            if sample is not None:
+                sample.cache_hits += len(values)
+                sample.cache_misses += len(keys) - len(values)
+            return values
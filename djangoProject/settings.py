@@ -1,6 +1,8 @@
+from django.core.exceptions import ImproperlyConfigured
 from django.utils.translation import gettext_lazy as _
 from pathlib import Path
 import os
+import tempfile
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -46,26 +48,75 @@ LOGIN_REDIRECT_URL = 'store:home'
 LOGOUT_REDIRECT_URL = 'store:home'
 
 # Cache settings
-CACHES = {
-    'default': {
-        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
-        'LOCATION': 'unique-snowflake',
+# Set REDIS_URL to share the cache (and the live carts kept in it) between workers
+if os.environ.get('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'djangoProject.metrics.RedisCache',
+            'LOCATION': os.environ['REDIS_URL'],
+            'OPTIONS': {
+                'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+            }
+        },
+        'sessions': {
+            'BACKEND': 'djangoProject.metrics.RedisCache',
+            'LOCATION': os.environ['REDIS_URL'],
+            'KEY_PREFIX': 'sessions',
+            'OPTIONS': {
+                'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+            }
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'djangoProject.metrics.LocMemCache',
+            'LOCATION': 'unique-snowflake',
+        },
     }
-}
 
+# Lifetime of cached catalog pages. Their version counters are only seen by
+# every worker through a shared cache; with the per process one a change may
+# take this long to show up in the other workers.
+CATALOG_TIMEOUT = 60 * 60 * 6 if os.environ.get('REDIS_URL') else 60 * 15
+
+# Session storage:
+#   db        - Django's default, one query per request that uses the session
+#   cached_db - read from the cache, written through to the session table
+#   cache     - no session rows at all, a session lives as long as the cache keeps it
+# The cache based ones need REDIS_URL. The local cache is per process, another
+# worker would not know a session or keep serving one that was logged out.
+SESSION_STORAGE = os.environ.get('SESSION_STORAGE', 'cache' if os.environ.get('REDIS_URL') else 'db')
+if SESSION_STORAGE in ('cache', 'cached_db') and not os.environ.get('REDIS_URL'):
+    raise ImproperlyConfigured(f'SESSION_STORAGE={SESSION_STORAGE} needs a shared cache, set REDIS_URL')
+SESSION_ENGINE = f'django.contrib.sessions.backends.{SESSION_STORAGE}'
+SESSION_CACHE_ALIAS = 'sessions'
+
+
+# Share of requests measured by djangoProject.metrics, 0 turns it off. Every
+# worker of the host writes its numbers to METRICS_DIR, served together at
+# /metrics to requests with an "Authorization: Bearer <METRICS_TOKEN>" header,
+# without a token the endpoint is off. Files of workers that have exited or not
+# written for METRICS_STALE_INTERVALS flush intervals are removed.
+METRICS_SAMPLE_RATE = float(os.environ.get('METRICS_SAMPLE_RATE', 0))
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'djangoProject-metrics'))
+METRICS_FLUSH_INTERVAL = 10
+METRICS_STALE_INTERVALS = 30
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
 
 MIDDLEWARE = [
-    'django.middleware.cache.UpdateCacheMiddleware',
+    # First, so its wall time includes the other middleware
+    'djangoProject.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'djangoProject.database.PrimaryPinMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.locale.LocaleMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'users.middleware.UserActivityMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'django.middleware.cache.FetchFromCacheMiddleware',
-
 ]
 
 ROOT_URLCONF = 'djangoProject.urls'
@@ -90,13 +141,54 @@ TEMPLATES = [
 WSGI_APPLICATION = 'djangoProject.wsgi.application'
 
 # Database
+# SQLITE_PROFILE=production opens every connection with WAL (readers no
+# longer wait for the writer), a busy timeout instead of immediate "database is
+# locked" errors and memory-mapped reads, keeps connections between requests
+# and starts write transactions IMMEDIATE so they queue up instead of
+# deadlocking. benchmark_database compares the profiles.
+SQLITE_PROFILE = os.environ.get('SQLITE_PROFILE', 'default')
+SQLITE_PROFILES = {
+    'default': {},
+    'production': {
+        'CONN_MAX_AGE': 60,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'init_command': (
+                # busy_timeout first, switching to WAL needs a lock
+                'PRAGMA busy_timeout=5000; PRAGMA journal_mode=WAL; '
+                'PRAGMA synchronous=NORMAL; PRAGMA mmap_size=268435456'
+            ),
+            'transaction_mode': 'IMMEDIATE',
+        },
+    },
+}
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        **SQLITE_PROFILES[SQLITE_PROFILE],
     }
 }
 
+# Set DATABASE_REPLICA to a read-only copy of the database (e.g. kept by
+# litestream) to serve catalog reads from it, see djangoProject/database.py
+if os.environ.get('DATABASE_REPLICA'):
+    DATABASES['replica'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': f"file:{os.environ['DATABASE_REPLICA']}?mode=ro",
+        'CONN_MAX_AGE': 60,
+        'OPTIONS': {
+            'init_command': 'PRAGMA busy_timeout=5000; PRAGMA mmap_size=268435456',
+        },
+        'TEST': {
+            'MIRROR': 'default',
+        },
+    }
+DATABASE_ROUTERS = ['djangoProject.database.PrimaryReplicaRouter']
+# Seconds reads stay on the primary after a write
+REPLICA_LAG = 5
+
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -144,6 +236,8 @@ STATICFILES_DIRS = [
 # Media files
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
+# Threads resizing uploaded product images, 0 resizes during the request
+IMAGE_WORKERS = 2
 
 # Default primary key field type
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
@@ -158,8 +252,27 @@ MESSAGE_TAGS = {
     messages.ERROR: 'alert-danger',
 }
 
+# User activity tracking (users.middleware.UserActivityMiddleware), switched
+# on with the buffered stamps; it was not installed before. last_active_datetime
+# is only refreshed once it is older than the granularity, and buffered stamps
+# are flushed in bulk. USER_ACTIVITY_TRACKING=0 turns it off.
+USER_ACTIVITY_TRACKING = os.environ.get('USER_ACTIVITY_TRACKING', '1') == '1'
+USER_ACTIVITY_GRANULARITY = 60 * 5
+USER_ACTIVITY_FLUSH_INTERVAL = 60
+
+# Shop listing pagination: 'offset' (numbered pages) or 'keyset' (cursor links,
+# constant cost per page and no COUNT(*), for large catalogs)
+PRODUCT_LIST_PAGINATION = 'offset'
+
 # Cart session settings
 CART_SESSION_ID = 'cart'
+# Seconds between write-behind flushes of cached carts to Cart/CartItem, with
+# redis only: without it every cart change is written through
+CART_FLUSH_INTERVAL = 30
+
+# Route the cart and product pages to their async views. asgi.py turns this on,
+# under WSGI the sync views avoid an event loop per request.
+ASYNC_VIEWS = os.environ.get('DJANGO_ASYNC_VIEWS') == '1'
 
 # Email settings (update these with your email service details)
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
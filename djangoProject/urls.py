@@ -3,12 +3,17 @@ from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import path, include
 from django.conf.urls.i18n import i18n_patterns
-from store.views import ProductListView, ProductDetailView
-from order.views import CartListView, AddToCartView, CheckoutView
+from djangoProject.metrics import metrics_view
+from store.views import ProductListView, ProductDetailView, ProductSearchView, AsyncProductDetailView
+from order.views import CartListView, AddToCartView, CartBatchView, CheckoutView, AsyncCartListView, AsyncAddToCartView
+
+if settings.ASYNC_VIEWS:
+    ProductDetailView, CartListView, AddToCartView = AsyncProductDetailView, AsyncCartListView, AsyncAddToCartView
 
 # Non-translated URLs
 urlpatterns = [
     path('i18n/', include('django.conf.urls.i18n')),
+    path('metrics', metrics_view, name='metrics'),
 ]
 
 # Translated URLs
@@ -19,10 +24,12 @@ urlpatterns += i18n_patterns(
     path('accounts/', include('django.contrib.auth.urls')),
     path('accounts/', include(('users.urls', 'users'), namespace='users')),
     path('product/<slug:slug>/', ProductDetailView.as_view(), name='product_details'),
+    path('search/', ProductSearchView.as_view(), name='product_search'),
     path('category/', ProductListView.as_view(), name='product_list'),
     path('category/<slug:slug>/', ProductListView.as_view(), name='product_list'),
     path('cart/', CartListView.as_view(), name='cart_list'),
     path('add-to-cart/', AddToCartView.as_view(), name='add_to_cart'),
+    path('cart/update/', CartBatchView.as_view(), name='cart_update'),
     path('checkout/', CheckoutView.as_view(), name='checkout'),
     prefix_default_language=False
 )
@@ -0,0 +1,703 @@
+import contextvars
+import logging
+import threading
+import time
+import uuid
+from decimal import Decimal
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, OuterRef, Subquery
+from django.utils import timezone
+from django.utils.translation import get_language
+
+from order.models import Cart, CartItem
+from store.models import Product
+from store.popularity import record_added, record_removed
+
+# Carts are cached as {product_id: quantity} hashes keyed by their owner
+# ("u<user id>" or "s<session id>"). With redis the cache is shared by every
+# worker and holds the live cart: mutations only touch it and mark the owner
+# dirty, the Cart/CartItem rows are written later in batches by
+# flush_dirty_carts(). The local cache is per process, there every change is
+# written through to the database and the cache only serves reads.
+CART_KEY = 'cart:{owner}'
+DIRTY_KEY = 'cart:dirty'
+LOADED_FIELD = '_'
+CART_TIMEOUT = 60 * 60 * 24 * 7
+# How long another worker may show a cart from before a change
+LOCAL_CART_TIMEOUT = 5
+PRODUCT_NAME_TIMEOUT = 60 * 60
+MAX_BATCH_CHANGES = 100
+# Owners taken from the dirty set per round trip
+DIRTY_BATCH_SIZE = 1000
+# Carts a request flushes once the interval has passed, a backlog is left to the flush_carts command
+INLINE_FLUSH_SIZE = 20
+
+logger = logging.getLogger(__name__)
+
+_last_flush = time.monotonic()
+# Set while delete_cart_items() runs, the items it deletes are uncounted in one batch
+_deleting_in_bulk = contextvars.ContextVar('cart_items_deleting_in_bulk', default=False)
+
+
+def get_flush_interval():
+    return getattr(settings, 'CART_FLUSH_INTERVAL', 30)
+
+
+class InvalidCartChange(ValueError):
+    def __init__(self, message, product_ids=()):
+        super().__init__(message)
+        self.product_ids = sorted(product_ids)
+
+
+class AsyncCartBackendMixin:
+    """
+    Async variants of the backend calls. Writes run the sync implementation in
+    a thread, so the locks and pipelines stay in one place.
+    """
+
+    async def aget(self, owner):
+        return await sync_to_async(self.get)(owner)
+
+    async def aload(self, owner, lines):
+        await sync_to_async(self.load)(owner, lines)
+
+    async def aincr(self, owner, product_id, delta):
+        return await sync_to_async(self.incr)(owner, product_id, delta)
+
+    async def aremove(self, owner, product_id):
+        return await sync_to_async(self.remove)(owner, product_id)
+
+    async def acount(self, owner):
+        return await sync_to_async(self.count)(owner)
+
+    async def amark_dirty(self, owner):
+        await sync_to_async(self.mark_dirty)(owner)
+
+
+class LocalCartBackend(AsyncCartBackendMixin):
+    """
+    Writes every change through to Cart/CartItem and keeps the lines in the
+    local cache for reads only. Each process has its own copy, none of them
+    may be the only one.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def key(self, owner):
+        return CART_KEY.format(owner=owner)
+
+    def load(self, owner, lines):
+        cache.set(self.key(owner), lines, LOCAL_CART_TIMEOUT)
+
+    def get(self, owner):
+        return cache.get(self.key(owner))
+
+    async def aget(self, owner):
+        return await cache.aget(self.key(owner))
+
+    def count(self, owner):
+        """Number of lines, None if the cart is not cached"""
+        lines = self.get(owner)
+        return None if lines is None else len(lines)
+
+    async def acount(self, owner):
+        lines = await self.aget(owner)
+        return None if lines is None else len(lines)
+
+    def incr(self, owner, product_id, delta):
+        return self.apply(owner, {product_id: delta}).get(product_id, 0)
+
+    def apply(self, owner, deltas):
+        """Add several {product_id: delta} at once, returns the new lines"""
+        # Changed from the stored lines, another worker's change may not be cached here
+        with self.lock, transaction.atomic():
+            lines = dict(get_stored_lines(owner))
+            for product_id, delta in deltas.items():
+                quantity = lines.get(product_id, 0) + delta
+                if quantity > 0:
+                    lines[product_id] = quantity
+                else:
+                    lines.pop(product_id, None)
+            persist_cart(owner, lines)
+        self.load(owner, lines)
+        return dict(lines)
+
+    def remove(self, owner, product_id):
+        with self.lock, transaction.atomic():
+            lines = dict(get_stored_lines(owner))
+            removed = lines.pop(product_id, None) is not None
+            if removed:
+                persist_cart(owner, lines)
+        self.load(owner, lines)
+        return removed
+
+    def delete(self, owner):
+        cache.delete(self.key(owner))
+
+    def delete_many(self, owners):
+        cache.delete_many([self.key(owner) for owner in owners])
+
+    def mark_dirty(self, owner):
+        # Nothing is pending, the change is stored already
+        pass
+
+    def pop_dirty(self, owner=None, count=DIRTY_BATCH_SIZE):
+        return set()
+
+    def dirty_among(self, owners):
+        return set()
+
+
+class RedisCartBackend(AsyncCartBackendMixin):
+    """Stores carts as native redis hashes so increments are atomic across workers"""
+
+    def __init__(self):
+        from django_redis import get_redis_connection
+        self.connection = get_redis_connection('default')
+
+    def key(self, owner):
+        return cache.make_key(CART_KEY.format(owner=owner))
+
+    def load(self, owner, lines):
+        # HSETNX keeps increments that raced with the load
+        pipe = self.connection.pipeline()
+        pipe.hsetnx(self.key(owner), LOADED_FIELD, 0)
+        for product_id, quantity in lines.items():
+            pipe.hsetnx(self.key(owner), product_id, quantity)
+        pipe.expire(self.key(owner), CART_TIMEOUT)
+        pipe.execute()
+
+    def get(self, owner):
+        raw = self.connection.hgetall(self.key(owner))
+        if not raw:
+            return None
+        return {
+            int(field): int(value) for field, value in raw.items()
+            if field.decode() != LOADED_FIELD and int(value) > 0
+        }
+
+    def count(self, owner):
+        # Lines are removed as soon as they reach zero, so the hash length is
+        # the count; a loaded hash always holds LOADED_FIELD
+        length = self.connection.hlen(self.key(owner))
+        return length - 1 if length else None
+
+    def incr(self, owner, product_id, delta):
+        quantity = self.connection.hincrby(self.key(owner), product_id, delta)
+        if quantity <= 0:
+            self.connection.hdel(self.key(owner), product_id)
+        self.connection.expire(self.key(owner), CART_TIMEOUT)
+        return quantity
+
+    def apply(self, owner, deltas):
+        # One round trip for the increments and one for the cleanup
+        pipe = self.connection.pipeline()
+        for product_id, delta in deltas.items():
+            pipe.hincrby(self.key(owner), product_id, delta)
+        quantities = pipe.execute()
+
+        pipe = self.connection.pipeline()
+        emptied = [product_id for product_id, quantity in zip(deltas, quantities) if quantity <= 0]
+        if emptied:
+            pipe.hdel(self.key(owner), *emptied)
+        pipe.expire(self.key(owner), CART_TIMEOUT)
+        pipe.hgetall(self.key(owner))
+        raw = pipe.execute()[-1]
+        return {
+            int(field): int(value) for field, value in raw.items()
+            if field.decode() != LOADED_FIELD and int(value) > 0
+        }
+
+    def remove(self, owner, product_id):
+        return bool(self.connection.hdel(self.key(owner), product_id))
+
+    def delete(self, owner):
+        self.connection.delete(self.key(owner))
+
+    def delete_many(self, owners):
+        if owners:
+            self.connection.delete(*[self.key(owner) for owner in owners])
+
+    def mark_dirty(self, owner):
+        self.connection.sadd(cache.make_key(DIRTY_KEY), owner)
+
+    def pop_dirty(self, owner=None, count=DIRTY_BATCH_SIZE):
+        if owner is None:
+            dirty = self.connection.spop(cache.make_key(DIRTY_KEY), count) or []
+            return {member.decode() for member in dirty}
+        if self.connection.srem(cache.make_key(DIRTY_KEY), owner):
+            return {owner}
+        return set()
+
+    def dirty_among(self, owners):
+        """The owners that have pending changes, without taking them out of the set"""
+        if not owners:
+            return set()
+        flags = self.connection.smismember(cache.make_key(DIRTY_KEY), owners)
+        return {owner for owner, flag in zip(owners, flags) if flag}
+
+
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        # django_redis backends (also the metrics subclass) expose their client
+        if hasattr(cache, 'client'):
+            _backend = RedisCartBackend()
+        else:
+            _backend = LocalCartBackend()
+    return _backend
+
+
+def user_owner(user_id):
+    return f'u{user_id}'
+
+
+def session_owner(session_id):
+    return f's{session_id}'
+
+
+def get_cart_owner(cart):
+    if cart.user_id is not None:
+        return user_owner(cart.user_id)
+    return session_owner(cart.session_id)
+
+
+def get_cart_filter(owner):
+    """Lookup kwargs for the Cart row that belongs to an owner key"""
+    if owner.startswith('u'):
+        return {'user_id': int(owner[1:])}
+    return {'session_id': owner[1:]}
+
+
+def get_stored_lines(owner):
+    """(product_id, quantity) pairs of the persisted cart"""
+    carts = Cart.objects.filter(**get_cart_filter(owner))
+    return CartItem.objects.filter(cart__in=carts).values_list('product_id', 'quantity')
+
+
+def _product_name_key(product_id):
+    return f'cart_product_name_{product_id}_{get_language()}'
+
+
+def get_product_name(product_id):
+    """Translated product name for cart messages, None if the product does not exist"""
+    cache_key = _product_name_key(product_id)
+    name = cache.get(cache_key)
+    if name is None:
+        product = Product.objects.filter(id=product_id).first()
+        if product is None:
+            return None
+        name = product.name
+        cache.set(cache_key, name, PRODUCT_NAME_TIMEOUT)
+    return name
+
+
+async def aget_product_name(product_id):
+    cache_key = _product_name_key(product_id)
+    name = await cache.aget(cache_key)
+    if name is None:
+        product = await Product.objects.filter(id=product_id).afirst()
+        if product is None:
+            return None
+        name = product.name
+        await cache.aset(cache_key, name, PRODUCT_NAME_TIMEOUT)
+    return name
+
+
+class CartStore:
+    """
+    Cache-first view of the current visitor's cart. Methods prefixed with "a"
+    are the async variants for async views, they share the owner keys, backend
+    and persistence with the sync ones.
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self.backend = get_backend()
+
+    def get_owner(self, create=False):
+        if self.request.user.is_authenticated:
+            return user_owner(self.request.user.pk)
+
+        session_id = self.request.session.get('cart_session_id')
+        if not session_id and create:
+            session_id = str(uuid.uuid4())
+            self.request.session['cart_session_id'] = session_id
+        return session_owner(session_id) if session_id else None
+
+    async def aget_owner(self, create=False):
+        user = await self.request.auser()
+        if user.is_authenticated:
+            return user_owner(user.pk)
+
+        session_id = await self.request.session.aget('cart_session_id')
+        if not session_id and create:
+            session_id = str(uuid.uuid4())
+            await self.request.session.aset('cart_session_id', session_id)
+        return session_owner(session_id) if session_id else None
+
+    def lines(self, owner=None):
+        """Return {product_id: quantity}, loading the cart from the database on a cache miss"""
+        owner = owner or self.get_owner()
+        if owner is None:
+            return {}
+
+        lines = self.backend.get(owner)
+        if lines is None:
+            lines = dict(get_stored_lines(owner))
+            self.backend.load(owner, lines)
+        return lines
+
+    async def alines(self, owner=None):
+        owner = owner or await self.aget_owner()
+        if owner is None:
+            return {}
+
+        lines = await self.backend.aget(owner)
+        if lines is None:
+            lines = {product_id: quantity async for product_id, quantity in get_stored_lines(owner)}
+            await self.backend.aload(owner, lines)
+        return lines
+
+    def count(self):
+        """Number of lines, one cache read when the cart is cached"""
+        owner = self.get_owner()
+        if owner is None:
+            return 0
+        count = self.backend.count(owner)
+        return len(self.lines(owner)) if count is None else count
+
+    async def acount(self):
+        owner = await self.aget_owner()
+        if owner is None:
+            return 0
+        count = await self.backend.acount(owner)
+        return len(await self.alines(owner)) if count is None else count
+
+    def add(self, product_id, quantity=1):
+        """Increment a line, returns the new quantity"""
+        owner = self.get_owner(create=True)
+        self.lines(owner)
+        quantity = self.backend.incr(owner, product_id, quantity)
+        self.backend.mark_dirty(owner)
+        return quantity
+
+    async def aadd(self, product_id, quantity=1):
+        owner = await self.aget_owner(create=True)
+        await self.alines(owner)
+        quantity = await self.backend.aincr(owner, product_id, quantity)
+        await self.backend.amark_dirty(owner)
+        return quantity
+
+    def apply(self, changes):
+        """
+        Apply (product_id, delta) pairs as one update, returns summarize() of
+        the new cart. Every product is checked with one query before anything
+        changes, an unknown product rejects the whole batch.
+        """
+        deltas = {}
+        for product_id, delta in changes:
+            deltas[product_id] = deltas.get(product_id, 0) + delta
+        if len(deltas) > MAX_BATCH_CHANGES:
+            raise InvalidCartChange(f'At most {MAX_BATCH_CHANGES} products can be changed at once')
+
+        owner = self.get_owner(create=bool(deltas))
+        lines = self.lines(owner) if owner is not None else {}
+        products = Product.objects.in_bulk(set(lines) | set(deltas))
+        unknown = set(deltas) - set(products)
+        if unknown:
+            raise InvalidCartChange('Unknown products', unknown)
+
+        deltas = {product_id: delta for product_id, delta in deltas.items() if delta}
+        if deltas:
+            lines = self.backend.apply(owner, deltas)
+            self.backend.mark_dirty(owner)
+        return summarize(lines, products)
+
+    def remove(self, product_id):
+        """Drop a line, returns False if it was not in the cart"""
+        owner = self.get_owner()
+        if owner is None or product_id not in self.lines(owner):
+            return False
+        self.backend.remove(owner, product_id)
+        self.backend.mark_dirty(owner)
+        return True
+
+    async def aremove(self, product_id):
+        owner = await self.aget_owner()
+        if owner is None or product_id not in await self.alines(owner):
+            return False
+        await self.backend.aremove(owner, product_id)
+        await self.backend.amark_dirty(owner)
+        return True
+
+    def get_cart(self):
+        """The persisted Cart row, with any pending changes written first"""
+        owner = self.get_owner()
+        if owner is None:
+            return None
+        flush_cart(owner)
+        return Cart.objects.filter(**get_cart_filter(owner)).first()
+
+    async def aget_cart(self):
+        owner = await self.aget_owner()
+        if owner is None:
+            return None
+        # Persisting runs in a transaction, which the async ORM does not support yet
+        await sync_to_async(flush_cart)(owner)
+        return await Cart.objects.filter(**get_cart_filter(owner)).afirst()
+
+    def items(self):
+        """Persisted cart items with products joined and line totals annotated"""
+        # The cached lines are current, an empty cart needs no Cart row or query
+        if not self.lines():
+            return self.cart_items(None)
+        return self.cart_items(self.get_cart())
+
+    async def aitems(self):
+        if not await self.alines():
+            return self.cart_items(None)
+        return self.cart_items(await self.aget_cart())
+
+    def cart_items(self, cart):
+        if cart is None:
+            return CartItem.objects.none().with_totals()
+        return cart.items.with_totals()
+
+    def invalidate(self):
+        owner = self.get_owner()
+        if owner is not None:
+            self.backend.delete(owner)
+
+
+def summarize(lines, products):
+    """Line totals and counts for cached lines, products is {id: Product}"""
+    items = []
+    subtotal = Decimal('0.00')
+    for product_id, quantity in lines.items():
+        product = products.get(product_id)
+        if product is None:
+            # Deleted since it was added, the next flush drops the line
+            continue
+        total = product.price * quantity
+        subtotal += total
+        items.append({'product': product, 'quantity': quantity, 'total_price': total})
+    return {
+        'items': items,
+        'item_count': sum(item['quantity'] for item in items),
+        'subtotal': subtotal,
+    }
+
+
+def persist_cart(owner, lines):
+    """Write one cart's cached lines to Cart/CartItem with set-based statements"""
+    with transaction.atomic():
+        if lines:
+            cart, created = Cart.objects.get_or_create(**get_cart_filter(owner))
+        else:
+            # An emptied cart keeps its row until delete_empty_carts, but none is created for it
+            cart, created = Cart.objects.filter(**get_cart_filter(owner)).first(), False
+            if cart is None:
+                return None
+        if not created:
+            Cart.objects.filter(pk=cart.pk).update(updated_at=timezone.now())
+
+        product_ids = set(Product.objects.filter(id__in=lines).values_list('id', flat=True))
+        existing = set() if created else set(cart.items.values_list('product_id', flat=True))
+        if existing - product_ids:
+            # A queryset delete still sends post_delete, which keeps the popularity counters right
+            cart.items.filter(product_id__in=existing - product_ids).delete()
+        now = timezone.now()
+        CartItem.objects.bulk_create(
+            [
+                CartItem(cart=cart, product_id=product_id, quantity=lines[product_id], created_at=now)
+                for product_id in product_ids
+            ],
+            update_conflicts=True,
+            unique_fields=['cart', 'product'],
+            update_fields=['quantity'],
+        )
+        # bulk_create sends no post_save, count the new lines here
+        record_added(product_ids - existing, now)
+    return cart
+
+
+def flush_cart(owner):
+    """Persist a single cart if it has pending changes"""
+    backend = get_backend()
+    if not backend.pop_dirty(owner):
+        return False
+    lines = backend.get(owner)
+    if lines is not None:
+        persist_cart(owner, lines)
+    return True
+
+
+def flush_dirty_carts(limit=None):
+    """Persist the carts with pending changes, all or up to `limit`, returns the number of carts written"""
+    global _last_flush
+    _last_flush = time.monotonic()
+
+    backend = get_backend()
+    flushed = popped = 0
+    while limit is None or popped < limit:
+        dirty = backend.pop_dirty(count=DIRTY_BATCH_SIZE if limit is None else min(DIRTY_BATCH_SIZE, limit - popped))
+        if not dirty:
+            break
+        popped += len(dirty)
+        pending = list(dirty)
+        try:
+            while pending:
+                owner = pending[-1]
+                lines = backend.get(owner)
+                if lines is not None:
+                    persist_cart(owner, lines)
+                    flushed += 1
+                pending.pop()
+        finally:
+            # Taken from the dirty set but not written, left for the next flush
+            for owner in pending:
+                backend.mark_dirty(owner)
+    return flushed
+
+
+def is_flush_due():
+    return time.monotonic() - _last_flush >= get_flush_interval()
+
+
+def flush_carts_if_due():
+    """Flush a few carts from a request once the interval has passed, returns the number written"""
+    if not is_flush_due():
+        return 0
+    try:
+        return flush_dirty_carts(limit=INLINE_FLUSH_SIZE)
+    except Exception:
+        # Other visitors' carts, the change of this request is stored already
+        logger.exception('Could not flush the dirty carts')
+        return 0
+
+
+async def aflush_carts_if_due():
+    if is_flush_due():
+        return await sync_to_async(flush_carts_if_due)()
+    return 0
+
+
+def delete_expired_carts(older_than, chunk_size=500):
+    """
+    Delete anonymous carts not updated since `older_than`, `chunk_size` carts
+    per transaction, returns the number of carts deleted. Their session has
+    expired by then, so nobody can reach them any more.
+    """
+    backend = get_backend()
+    # updated_at only moves when a cart is flushed, pending changes would be lost
+    flush_dirty_carts()
+    expired = Cart.objects.filter(user__isnull=True, updated_at__lt=older_than).order_by('id')
+    deleted = 0
+    last_id = 0
+    while carts := list(expired.filter(id__gt=last_id).values_list('id', 'session_id')[:chunk_size]):
+        last_id = carts[-1][0]
+        owners = {pk: session_owner(session_id) for pk, session_id in carts}
+        # Changed since the flush, left for the next run
+        dirty = backend.dirty_among(list(owners.values()))
+        with transaction.atomic():
+            # Checked again in case a flush wrote to one of them meanwhile
+            ids = list(expired.filter(id__in=[pk for pk in owners if owners[pk] not in dirty]).values_list(
+                'id', flat=True
+            ))
+            # One popularity update per chunk instead of a post_delete per item
+            delete_cart_items(CartItem.objects.filter(cart_id__in=ids))
+            Cart.objects.filter(id__in=ids).delete()
+        backend.delete_many([owners[pk] for pk in ids])
+        deleted += len(ids)
+    return deleted
+
+
+def delete_empty_carts(older_than, chunk_size=500):
+    """
+    Delete carts without items not updated since `older_than`, `chunk_size`
+    per statement, returns the number deleted. Carts are created on the first
+    flush of a cart with items, this removes the ones emptied since and those
+    created eagerly for every user in the past.
+    """
+    empty = Cart.objects.filter(items__isnull=True, updated_at__lt=older_than).order_by('id')
+    deleted = 0
+    while ids := list(empty.values_list('id', flat=True)[:chunk_size]):
+        # Checked again in the DELETE in case a flush added items meanwhile
+        deleted += Cart.objects.filter(id__in=ids, items__isnull=True).delete()[1].get(Cart._meta.label, 0)
+    return deleted
+
+
+def is_deleting_in_bulk():
+    return _deleting_in_bulk.get()
+
+
+def delete_cart_items(items):
+    """
+    Delete the CartItem queryset `items`, uncounting them from the product
+    popularity with one update instead of one per item in post_delete.
+    """
+    record_removed(items.values_list('product_id', 'created_at'))
+    token = _deleting_in_bulk.set(True)
+    try:
+        items.delete()
+    finally:
+        _deleting_in_bulk.reset(token)
+
+
+def merge_carts(src, dst):
+    """Move every item of src into dst and delete src, using a fixed number of statements"""
+    backend = get_backend()
+    owners = [get_cart_owner(src), get_cart_owner(dst)]
+    for owner in owners:
+        flush_cart(owner)
+
+    with transaction.atomic():
+        # Lock both rows in a stable order so concurrent merges queue up instead of deadlocking
+        locked = list(Cart.objects.select_for_update().filter(pk__in=[src.pk, dst.pk]).order_by('pk'))
+        if len(locked) < 2:
+            # src was already merged by a concurrent request
+            return dst
+
+        src_items = CartItem.objects.filter(cart=src)
+        dst_items = CartItem.objects.filter(cart=dst)
+
+        # Products in both carts: add the src quantity to the existing dst line
+        dst_items.filter(product_id__in=src_items.values('product_id')).update(
+            quantity=F('quantity') + Subquery(
+                src_items.filter(product_id=OuterRef('product_id')).values('quantity')[:1]
+            )
+        )
+        # Products only in src: reassign the rows to dst
+        src_items.exclude(product_id__in=dst_items.values('product_id')).update(cart=dst)
+        # What is left in src was added to dst, drop it before the cart so it does not cascade item by item
+        delete_cart_items(src_items)
+        src.delete()
+
+        transaction.on_commit(lambda: [backend.delete(owner) for owner in owners])
+    return dst
+
+
+def merge_session_cart(request, user):
+    """Merge the anonymous session cart into the user's cart, returns True if one was merged"""
+    session_id = request.session.get('cart_session_id')
+    if not session_id:
+        return False
+    del request.session['cart_session_id']
+
+    flush_cart(session_owner(session_id))
+    anonymous_cart = Cart.objects.filter(session_id=session_id).first()
+    if anonymous_cart is None:
+        return False
+
+    user_cart, _ = Cart.objects.get_or_create(user=user)
+    merge_carts(anonymous_cart, user_cart)
+    return True
@@ -0,0 +1,60 @@
+import time
+import uuid
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from order.cart import merge_carts
+from order.models import Cart, CartItem
+from store.models import Category, Product
+
+
+def legacy_merge(anonymous_cart, user_cart):
+    """The previous per-item merge from CheckoutView"""
+    for item in anonymous_cart.items.all():
+        existing_item = user_cart.items.filter(product=item.product).first()
+        if existing_item:
+            existing_item.quantity += item.quantity
+            existing_item.save()
+        else:
+            item.cart = user_cart
+            item.save()
+    anonymous_cart.delete()
+
+
+class Command(BaseCommand):
+    help = 'Compare the per-item and set-based anonymous cart merge'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=200, help='Number of items in each cart')
+
+    def handle(self, *args, **options):
+        items = options['items']
+        # Everything runs inside a transaction that is rolled back afterwards
+        with transaction.atomic():
+            category = Category.objects.create(name='Benchmark', description='Benchmark category')
+            products = Product.objects.bulk_create([
+                Product(name=f'Benchmark {i}', category=category, price=1, slug=f'benchmark-merge-{uuid.uuid4().hex}')
+                for i in range(items * 2)
+            ])
+            for label, merge in (('Per-item merge', legacy_merge), ('merge_carts', merge_carts)):
+                src, dst = self.make_carts(products, items)
+                with CaptureQueriesContext(connection) as queries:
+                    started = time.perf_counter()
+                    merge(src, dst)
+                    elapsed = time.perf_counter() - started
+                self.stdout.write(f'{label}: {len(queries)} queries, {elapsed * 1000:.1f} ms')
+            transaction.set_rollback(True)
+
+    def make_carts(self, products, items):
+        # Half of the anonymous cart overlaps with the user's cart
+        user = get_user_model().objects.create(username=f'benchmark-{uuid.uuid4().hex[:12]}')
+        dst = Cart.objects.create(user=user)
+        src = Cart.objects.create(session_id=str(uuid.uuid4()))
+        CartItem.objects.bulk_create(
+            [CartItem(cart=dst, product=product, quantity=1) for product in products[:items]]
+            + [CartItem(cart=src, product=product, quantity=2) for product in products[items // 2:items // 2 + items]]
+        )
+        return src, dst
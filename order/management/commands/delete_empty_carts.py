@@ -0,0 +1,22 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from order.cart import delete_empty_carts
+
+
+class Command(BaseCommand):
+    help = 'Delete carts without items, in chunks'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--min-age', type=int, default=60 * 60,
+            help='Seconds since the last change, keeps carts a visitor is emptying and filling again'
+        )
+        parser.add_argument('--chunk-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        older_than = timezone.now() - timedelta(seconds=options['min_age'])
+        deleted = delete_empty_carts(older_than, options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} empty carts'))
@@ -0,0 +1,23 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from order.cart import delete_expired_carts
+
+
+class Command(BaseCommand):
+    help = 'Delete anonymous carts whose session has expired, in chunks'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--max-age', type=int, default=settings.SESSION_COOKIE_AGE,
+            help='Seconds since the last change, defaults to the session lifetime'
+        )
+        parser.add_argument('--chunk-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        older_than = timezone.now() - timedelta(seconds=options['max_age'])
+        deleted = delete_expired_carts(older_than, options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} expired carts'))
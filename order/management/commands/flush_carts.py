@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from order.cart import flush_dirty_carts
+
+
+class Command(BaseCommand):
+    help = 'Write pending cached cart changes to the database'
+
+    def handle(self, *args, **options):
+        flushed = flush_dirty_carts()
+        self.stdout.write(self.style.SUCCESS(f'Flushed {flushed} carts'))
@@ -1,4 +1,6 @@
 from django.db import models
+from django.db.models import DecimalField, ExpressionWrapper, F, Sum
+from django.db.models.functions import Coalesce
 from django.contrib.auth import get_user_model
 from django.utils import timezone
 
@@ -26,12 +28,46 @@ class Cart(models.Model):
 
 
 
+class CartItemQuerySet(models.QuerySet):
+    def with_totals(self):
+        # Join the product and compute each line total in the database
+        return self.select_related('product').annotate(
+            total_price=ExpressionWrapper(
+                F('product__price') * F('quantity'),
+                output_field=DecimalField(max_digits=12, decimal_places=2)
+            )
+        )
+
+    def summary_aggregates(self):
+        return {
+            'subtotal': Coalesce(
+                Sum(F('product__price') * F('quantity'), output_field=DecimalField(max_digits=12, decimal_places=2)),
+                0,
+                output_field=DecimalField(max_digits=12, decimal_places=2)
+            ),
+            'item_count': Coalesce(Sum('quantity'), 0),
+        }
+
+    def summary(self):
+        return self.aggregate(**self.summary_aggregates())
+
+    async def asummary(self):
+        return await self.aaggregate(**self.summary_aggregates())
+
+
 class CartItem(models.Model):
     cart = models.ForeignKey(Cart, related_name='items', on_delete=models.CASCADE)
     product = models.ForeignKey('store.Product', on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(default=1)
     created_at = models.DateTimeField(default=timezone.now)
 
+    objects = CartItemQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['cart', 'product'], name='cartitem_unique_product')
+        ]
+
     def __str__(self):
         return f"{self.quantity}x {self.product.name}"
 
@@ -1,10 +1,25 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
-from django.contrib.auth.models import User
-from .models import Cart
+from django.contrib.auth.signals import user_logged_in
+from store.popularity import record_added, record_removed
+from .cart import is_deleting_in_bulk, merge_session_cart
+from .models import CartItem
 
 
-@receiver(post_save, sender=User)
-def create_user_cart(sender, instance, created, **kwargs):
+@receiver(user_logged_in)
+def merge_anonymous_cart(sender, request, user, **kwargs):
+    if request is not None and hasattr(request, 'session'):
+        merge_session_cart(request, user)
+
+
+@receiver(post_save, sender=CartItem)
+def count_cart_item(sender, instance, created, **kwargs):
     if created:
-        Cart.objects.create(user=instance)
+        record_added([instance.product_id], instance.created_at)
+
+
+@receiver(post_delete, sender=CartItem)
+def uncount_cart_item(sender, instance, **kwargs):
+    # delete_cart_items() uncounts its items together
+    if not is_deleting_in_bulk():
+        record_removed([(instance.product_id, instance.created_at)])
@@ -1,3 +1,531 @@
-from django.test import TestCase
+import json
+import os
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock, skipIf
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.backends.db import SessionStore
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.db import DatabaseError, connection
+from django.test import RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import path, reverse
+from django.utils import timezone
+
+from djangoProject import urls
+from order.cart import (
+    CART_KEY, INLINE_FLUSH_SIZE, AsyncCartBackendMixin, CartStore, delete_empty_carts, delete_expired_carts,
+    flush_carts_if_due, flush_dirty_carts, merge_carts, persist_cart,
+)
+from order.models import Cart, CartItem
+from order.views import AsyncAddToCartView, AsyncCartListView
+from store.models import Product, ProductPopularity
+from store.tests import CatalogTestCase
+from store.views import cart_processor
+
+# The project URLs plus the async cart views, for AsyncViewTests
+urlpatterns = [
+    path('async/cart/', AsyncCartListView.as_view(), name='async_cart_list'),
+    path('async/add-to-cart/', AsyncAddToCartView.as_view(), name='async_add_to_cart'),
+    *urls.urlpatterns,
+]
+
+
+class SharedCartBackend(AsyncCartBackendMixin):
+    """Stands in for RedisCartBackend: the shared cache holds the live carts, changes are written behind"""
+
+    def __init__(self):
+        self.carts = {}
+        self.dirty = set()
+
+    def load(self, owner, lines):
+        self.carts.setdefault(owner, dict(lines))
+
+    def get(self, owner):
+        lines = self.carts.get(owner)
+        return None if lines is None else dict(lines)
+
+    def count(self, owner):
+        lines = self.carts.get(owner)
+        return None if lines is None else len(lines)
+
+    def incr(self, owner, product_id, delta):
+        return self.apply(owner, {product_id: delta}).get(product_id, 0)
+
+    def apply(self, owner, deltas):
+        lines = self.carts.setdefault(owner, {})
+        for product_id, delta in deltas.items():
+            quantity = lines.get(product_id, 0) + delta
+            if quantity > 0:
+                lines[product_id] = quantity
+            else:
+                lines.pop(product_id, None)
+        return dict(lines)
+
+    def remove(self, owner, product_id):
+        return self.carts.get(owner, {}).pop(product_id, None) is not None
+
+    def delete(self, owner):
+        self.carts.pop(owner, None)
+
+    def delete_many(self, owners):
+        for owner in owners:
+            self.delete(owner)
+
+    def mark_dirty(self, owner):
+        self.dirty.add(owner)
+
+    def pop_dirty(self, owner=None, count=1000):
+        if owner is None:
+            dirty = set(sorted(self.dirty)[:count])
+            self.dirty -= dirty
+            return dirty
+        if owner not in self.dirty:
+            return set()
+        self.dirty.discard(owner)
+        return {owner}
+
+    def dirty_among(self, owners):
+        return self.dirty & set(owners)
+
+
+class SharedCartMixin:
+    def setUp(self):
+        super().setUp()
+        self.backend = SharedCartBackend()
+        patcher = mock.patch('order.cart._backend', self.backend)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class CartTestCase(CatalogTestCase):
+    def stored(self):
+        return dict(CartItem.objects.values_list('product_id', 'quantity'))
+
+
+def make_request(user=None):
+    request = RequestFactory().get('/')
+    request.session = SessionStore()
+    request.user = user or AnonymousUser()
+    return request
+
+
+class CartStoreTests(CartTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.apple, cls.pear = cls.create_product('Apple'), cls.create_product('Pear')
+
+    def test_changes_are_written_through_without_a_shared_cache(self):
+        store = CartStore(make_request())
+        store.add(self.apple.id, 2)
+        self.assertEqual(self.stored(), {self.apple.id: 2})
+        store.apply([(self.pear.id, 1), (self.apple.id, -1)])
+        self.assertEqual(self.stored(), {self.apple.id: 1, self.pear.id: 1})
+        self.assertTrue(store.remove(self.apple.id))
+        self.assertEqual(self.stored(), {self.pear.id: 1})
+        self.assertEqual(store.lines(), {self.pear.id: 1})
+
+    def test_a_stale_copy_in_another_worker_keeps_the_stored_lines(self):
+        request = make_request()
+        store = CartStore(request)
+        store.add(self.apple.id)
+        # What a worker that cached the cart before the apple was added still holds
+        cache.set(CART_KEY.format(owner=store.get_owner()), {}, 60)
+        CartStore(request).add(self.pear.id)
+        self.assertEqual(self.stored(), {self.apple.id: 1, self.pear.id: 1})
+        self.assertEqual(store.lines(), {self.apple.id: 1, self.pear.id: 1})
+
+
+class SharedCartStoreTests(SharedCartMixin, CartTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.apple, cls.pear = cls.create_product('Apple'), cls.create_product('Pear')
+
+    def test_changes_are_written_behind(self):
+        store = CartStore(make_request())
+        store.add(self.apple.id, 2)
+        self.assertEqual(self.stored(), {})
+        self.assertEqual(flush_dirty_carts(), 1)
+        self.assertEqual(self.stored(), {self.apple.id: 2})
+        self.assertEqual(flush_dirty_carts(), 0)
+
+    def test_every_owner_is_flushed(self):
+        user = get_user_model().objects.create_user(username='shopper', password='secret-password')
+        anonymous, member = CartStore(make_request()), CartStore(make_request(user))
+        anonymous.add(self.apple.id)
+        member.add(self.pear.id, 3)
+        self.assertEqual(flush_dirty_carts(), 2)
+        self.assertEqual(
+            {(cart.user_id, item.product_id, item.quantity) for cart in Cart.objects.all() for item in cart.items.all()},
+            {(None, self.apple.id, 1), (user.pk, self.pear.id, 3)},
+        )
+
+        # Reading one persisted cart writes only its own pending changes
+        anonymous.add(self.pear.id)
+        member.remove(self.pear.id)
+        self.assertEqual([item.product_id for item in anonymous.items()], [self.apple.id, self.pear.id])
+        self.assertTrue(CartItem.objects.filter(cart__user=user).exists())
+        self.assertEqual(self.backend.dirty, {member.get_owner()})
+
+    @mock.patch('order.cart.is_flush_due', return_value=True)
+    def test_a_request_flushes_a_few_carts(self, is_flush_due):
+        for i in range(INLINE_FLUSH_SIZE + 5):
+            CartStore(make_request()).add(self.apple.id)
+        self.assertEqual(flush_carts_if_due(), INLINE_FLUSH_SIZE)
+        self.assertEqual(len(self.backend.dirty), 5)
+
+    @mock.patch('order.cart.is_flush_due', return_value=True)
+    def test_a_failed_flush_does_not_fail_the_change(self, is_flush_due):
+        other = CartStore(make_request())
+        other.add(self.pear.id)
+        with mock.patch('order.cart.persist_cart', side_effect=DatabaseError), self.assertLogs('order.cart', 'ERROR'):
+            response = self.client.post(
+                reverse('add_to_cart'), {'product_id': self.apple.id}, headers={'x-requested-with': 'XMLHttpRequest'}
+            )
+        self.assertEqual(response.json()['cart_count'], 1)
+        # Both carts are still pending for the next flush
+        self.assertEqual(len(self.backend.dirty), 2)
+
+
+class CartListViewTests(CatalogTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.products = [cls.create_product(f'Product {i}', '2.50') for i in range(25)]
+
+    def get_cart_page(self, item_count):
+        user = get_user_model().objects.create_user(
+            username=f'shopper-{item_count}', password='secret-password', last_active_datetime=timezone.now()
+        )
+        cart = Cart.objects.create(user=user)
+        CartItem.objects.bulk_create([
+            CartItem(cart=cart, product=product, quantity=2) for product in self.products[:item_count]
+        ])
+        self.client.force_login(user)
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('cart_list'))
+        return response, len(queries)
+
+    def test_totals_are_computed_in_the_database(self):
+        response, _ = self.get_cart_page(3)
+        self.assertEqual(response.context['subtotal'], Decimal('15.00'))
+        self.assertEqual(response.context['item_count'], 6)
+        self.assertEqual(response.context['total'], Decimal('18.00'))
+        self.assertEqual(response.context['cart_items'][0].total_price, Decimal('5.00'))
+        # The cart:updated handler finds its rows by product
+        self.assertContains(response, f'data-cart-row="{self.products[0].id}"')
+
+    def test_query_count_does_not_depend_on_cart_size(self):
+        _, small_cart_queries = self.get_cart_page(1)
+        _, large_cart_queries = self.get_cart_page(25)
+        self.assertEqual(small_cart_queries, large_cart_queries)
+
+
+class MergeCartsTests(CatalogTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.apple, cls.pear, cls.plum = [cls.create_product(name) for name in ('Apple', 'Pear', 'Plum')]
+        cls.user = get_user_model().objects.create_user(username='shopper', password='secret-password')
+
+    def test_merge_adds_overlapping_quantities_and_moves_the_rest(self):
+        src = Cart.objects.create(session_id='anonymous')
+        dst = Cart.objects.get_or_create(user=self.user)[0]
+        CartItem.objects.create(cart=dst, product=self.apple, quantity=1)
+        CartItem.objects.create(cart=dst, product=self.pear, quantity=1)
+        CartItem.objects.create(cart=src, product=self.apple, quantity=2)
+        CartItem.objects.create(cart=src, product=self.plum, quantity=3)
+
+        merge_carts(src, dst)
+
+        self.assertFalse(Cart.objects.filter(pk=src.pk).exists())
+        self.assertEqual(
+            dict(dst.items.values_list('product__name', 'quantity')),
+            {'Apple': 3, 'Pear': 1, 'Plum': 3}
+        )
+
+    def test_overlapping_items_do_not_add_statements(self):
+        products = Product.objects.bulk_create([
+            Product(name=f'Product {i}', category=self.category, price=Decimal('1.00'), slug=f'product-{i}')
+            for i in range(20)
+        ])
+        src = Cart.objects.create(session_id='anonymous')
+        dst = Cart.objects.get_or_create(user=self.user)[0]
+        for cart in (src, dst):
+            for product in products:
+                CartItem.objects.create(cart=cart, product=product, quantity=1)
+
+        # The same statements as for one item, not one popularity update per item
+        with self.assertNumQueries(11):
+            merge_carts(src, dst)
+
+        self.assertEqual(set(dst.items.values_list('quantity', flat=True)), {2})
+        self.assertEqual(
+            set(ProductPopularity.objects.filter(product__in=products).values_list('carts', flat=True)), {1}
+        )
+
+    def test_login_merges_the_session_cart(self):
+        self.client.post(reverse('add_to_cart'), {'product_id': self.apple.id, 'quantity': 2})
+        self.client.login(username='shopper', password='secret-password')
+
+        self.assertFalse(Cart.objects.filter(session_id__isnull=False).exists())
+        self.assertEqual(dict(CartItem.objects.filter(cart__user=self.user).values_list('product_id', 'quantity')),
+                         {self.apple.id: 2})
+
+
+@override_settings(ROOT_URLCONF='order.tests')
+class AsyncViewTests(CatalogTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.apple = cls.create_product('Apple', '2.50')
+
+    async def test_add_to_cart_and_cart_page(self):
+        response = await self.async_client.post(
+            reverse('async_add_to_cart'), {'product_id': self.apple.id, 'quantity': 2},
+            headers={'x-requested-with': 'XMLHttpRequest'}
+        )
+        self.assertEqual(response.json()['cart_count'], 1)
+
+        response = await self.async_client.get(reverse('async_cart_list'))
+        self.assertEqual(response.context['subtotal'], Decimal('5.00'))
+        self.assertEqual(response.context['item_count'], 2)
+        self.assertEqual([item.quantity for item in response.context['cart_items']], [2])
+
+    async def test_removing_an_item(self):
+        url = reverse('async_add_to_cart')
+        await self.async_client.post(url, {'product_id': self.apple.id})
+        response = await self.async_client.post(
+            url, {'product_id': self.apple.id, 'quantity': 0}, headers={'x-requested-with': 'XMLHttpRequest'}
+        )
+        self.assertEqual(response.json()['cart_count'], 0)
+
+    async def test_unknown_product_is_an_error(self):
+        response = await self.async_client.post(
+            reverse('async_add_to_cart'), {'product_id': 0}, headers={'x-requested-with': 'XMLHttpRequest'}
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_sync_and_async_views_share_the_cart(self):
+        self.client.post(reverse('async_add_to_cart'), {'product_id': self.apple.id, 'quantity': 3})
+        response = self.client.get(reverse('cart_list'))
+        self.assertEqual(response.context['item_count'], 3)
+
+
+class CartBatchTests(SharedCartMixin, CatalogTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.apple, cls.pear = cls.create_product('Apple', '1.50'), cls.create_product('Pear', '2.00')
+
+    def update(self, *changes):
+        return self.client.post(
+            reverse('cart_update'),
+            json.dumps({'changes': [{'product_id': pk, 'quantity': quantity} for pk, quantity in changes]}),
+            content_type='application/json'
+        )
+
+    def test_changes_are_coalesced_and_summarized(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.update((self.apple.id, 1), (self.pear.id, 2), (self.apple.id, 2))
+        self.assertEqual(len([query for query in queries if 'FROM "store_product"' in query['sql']]), 1)
+
+        data = response.json()
+        self.assertEqual(data['cart_count'], 2)
+        self.assertEqual(data['item_count'], 5)
+        self.assertEqual(data['subtotal'], '8.50')
+        self.assertEqual(
+            {item['product_id']: item['quantity'] for item in data['items']}, {self.apple.id: 3, self.pear.id: 2}
+        )
+
+        flush_dirty_carts()
+        self.assertEqual(
+            dict(CartItem.objects.values_list('product_id', 'quantity')), {self.apple.id: 3, self.pear.id: 2}
+        )
+
+    def test_negative_delta_removes_the_line(self):
+        self.update((self.apple.id, 2), (self.pear.id, 1))
+        data = self.update((self.apple.id, -2)).json()
+        self.assertEqual([item['product_id'] for item in data['items']], [self.pear.id])
+        self.assertEqual(data['cart_count'], 1)
+
+    def test_unknown_product_rejects_the_whole_batch(self):
+        self.update((self.apple.id, 1))
+        response = self.update((self.apple.id, 5), (0, 1))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['product_ids'], [0])
+        self.assertEqual(self.update().json()['item_count'], 1)
+
+    def test_malformed_body(self):
+        response = self.client.post(reverse('cart_update'), '{"changes": [{}]}', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+class SessionStorageTests(CatalogTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.apple = cls.create_product('Apple')
+
+    @skipIf(os.environ.get('REDIS_URL'), 'Sessions are cached with redis')
+    def test_sessions_are_stored_in_the_database_without_redis(self):
+        self.assertEqual(settings.SESSION_ENGINE, 'django.contrib.sessions.backends.db')
+        self.client.post(reverse('add_to_cart'), {'product_id': self.apple.id})
+        self.assertEqual(Session.objects.count(), 1)
+
+    # What REDIS_URL sets up, with the local cache standing in
+    @override_settings(SESSION_ENGINE='django.contrib.sessions.backends.cached_db', SESSION_CACHE_ALIAS='default')
+    def test_sessions_are_read_from_the_cache(self):
+        self.client.post(reverse('add_to_cart'), {'product_id': self.apple.id})
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('cart_list'))
+        self.assertFalse([query for query in queries if 'django_session' in query['sql']])
+
+
+class ExpiredCartTests(CatalogTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.apple = cls.create_product('Apple')
+        cls.user = get_user_model().objects.create_user(username='shopper', password='secret-password')
+
+    def test_only_stale_anonymous_carts_are_deleted(self):
+        stale = [persist_cart(f'sstale-{i}', {self.apple.id: 1}) for i in range(3)]
+        fresh = persist_cart('sfresh', {self.apple.id: 1})
+        user_cart = persist_cart(f'u{self.user.pk}', {self.apple.id: 1})
+        long_ago = timezone.now() - timedelta(days=30)
+        Cart.objects.filter(pk__in=[cart.pk for cart in [*stale, user_cart]]).update(updated_at=long_ago)
+
+        deleted = delete_expired_carts(timezone.now() - timedelta(days=14), chunk_size=2)
+
+        self.assertEqual(deleted, 3)
+        self.assertEqual(set(Cart.objects.values_list('pk', flat=True)), {fresh.pk, user_cart.pk})
+        self.assertEqual(CartItem.objects.count(), 2)
+        self.assertEqual(ProductPopularity.objects.get(product=self.apple, period='all').carts, 2)
+
+    def test_items_do_not_add_statements(self):
+        products = Product.objects.bulk_create([
+            Product(name=f'Product {i}', category=self.category, price=Decimal('1.00'), slug=f'product-{i}')
+            for i in range(20)
+        ])
+        cart = persist_cart('sstale', {product.id: 1 for product in products})
+        Cart.objects.filter(pk=cart.pk).update(updated_at=timezone.now() - timedelta(days=30))
+
+        # The statements of one chunk, not a popularity update per item
+        with self.assertNumQueries(12):
+            self.assertEqual(delete_expired_carts(timezone.now() - timedelta(days=14)), 1)
+        self.assertFalse(CartItem.objects.exists())
+        self.assertEqual(
+            set(ProductPopularity.objects.filter(product__in=products).values_list('carts', flat=True)), {0}
+        )
+
+
+class SharedExpiredCartTests(SharedCartMixin, CatalogTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.apple = cls.create_product('Apple')
+        cls.long_ago = timezone.now() - timedelta(days=30)
+
+    def stale_cart(self, owner):
+        cart = persist_cart(owner, {self.apple.id: 1})
+        Cart.objects.filter(pk=cart.pk).update(updated_at=self.long_ago)
+        self.backend.load(owner, {self.apple.id: 1})
+        return cart
+
+    def test_pending_changes_are_flushed_first(self):
+        self.stale_cart('sidle')
+        active = self.stale_cart('sactive')
+        self.backend.apply('sactive', {self.apple.id: 2})
+        self.backend.mark_dirty('sactive')
+
+        self.assertEqual(delete_expired_carts(timezone.now() - timedelta(days=14)), 1)
+        self.assertEqual(list(Cart.objects.values_list('pk', flat=True)), [active.pk])
+        self.assertEqual(CartItem.objects.get().quantity, 3)
+        self.assertIsNone(self.backend.get('sidle'))
+
+    def test_carts_changed_during_the_run_are_skipped(self):
+        changed = self.stale_cart('schanged')
+        self.stale_cart('sidle')
+        with mock.patch('order.cart.flush_dirty_carts'):
+            self.backend.mark_dirty('schanged')
+            self.assertEqual(delete_expired_carts(timezone.now() - timedelta(days=14)), 1)
+        self.assertEqual(list(Cart.objects.values_list('pk', flat=True)), [changed.pk])
+        self.assertEqual(self.backend.get('schanged'), {self.apple.id: 1})
+
+
+class CartCountTests(CatalogTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.apple, cls.pear = cls.create_product('Apple'), cls.create_product('Pear')
+
+    def test_count_is_read_lazily_and_once(self):
+        request = RequestFactory().get('/')
+        request.session = SessionStore()
+        request.user = AnonymousUser()
+        with mock.patch.object(CartStore, 'count', return_value=3) as count:
+            context = cart_processor(request)
+            cart_processor(request)
+            self.assertEqual(count.call_count, 0)
+            self.assertEqual(str(context['cart_count']), '3')
+            self.assertEqual(str(context['cart_count']), '3')
+            self.assertEqual(count.call_count, 1)
+
+    def test_badge_follows_cart_changes(self):
+        for product in (self.apple, self.pear, self.apple):
+            self.client.post(reverse('add_to_cart'), {'product_id': product.id})
+        self.assertEqual(str(self.client.get(reverse('home')).context['cart_count']), '2')
+
+        self.client.post(reverse('add_to_cart'), {'product_id': self.pear.id, 'quantity': 0})
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('home'))
+        self.assertEqual(str(response.context['cart_count']), '1')
+        self.assertFalse([query for query in queries if 'order_cart' in query['sql']])
+
+
+class LazyCartTests(SharedCartMixin, CatalogTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.apple = cls.create_product('Apple')
+        cls.user = get_user_model().objects.create_user(
+            username='shopper', password='secret-password', last_active_datetime=timezone.now()
+        )
+
+    def test_registration_creates_no_cart(self):
+        self.assertFalse(Cart.objects.exists())
+
+    def test_cart_page_without_a_cart(self):
+        self.client.force_login(self.user)
+        self.client.get(reverse('cart_list'))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('cart_list'))
+        self.assertEqual(response.context['item_count'], 0)
+        self.assertFalse([query for query in queries if 'order_cart' in query['sql']])
+        self.assertFalse(Cart.objects.exists())
+
+    def test_emptied_cart_is_not_created(self):
+        self.client.force_login(self.user)
+        self.client.post(reverse('add_to_cart'), {'product_id': self.apple.id})
+        self.client.post(reverse('add_to_cart'), {'product_id': self.apple.id, 'quantity': 0})
+        flush_dirty_carts()
+        self.assertFalse(Cart.objects.exists())
+
+    def test_empty_carts_are_deleted(self):
+        empty = Cart.objects.create(user=self.user)
+        Cart.objects.create(session_id='recent')
+        filled = persist_cart('sfilled', {self.apple.id: 1})
+        Cart.objects.exclude(session_id='recent').update(updated_at=timezone.now() - timedelta(days=1))
+
+        self.assertEqual(delete_empty_carts(timezone.now() - timedelta(hours=1), chunk_size=1), 1)
+        self.assertFalse(Cart.objects.filter(pk=empty.pk).exists())
+        self.assertEqual(Cart.objects.count(), 2)
+        self.assertTrue(CartItem.objects.filter(cart=filled).exists())
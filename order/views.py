@@ -1,11 +1,135 @@
-import uuid
+import json
+
 from django.http import HttpResponseRedirect, JsonResponse
 from django.views.generic import ListView, View
 from django.utils.translation import gettext_lazy as _
 from django.contrib import messages
-from order.models import CartItem, Cart
-from django.shortcuts import render, get_object_or_404
-from store.models import Product
+from order.models import CartItem
+from order.cart import (
+    CartStore, InvalidCartChange, aflush_carts_if_due, aget_product_name, flush_carts_if_due, get_product_name,
+    merge_session_cart
+)
+from store.labels import get_labels
+
+# The sync views serve WSGI and the Async* views serve ASGI, see ASYNC_VIEWS in
+# settings. Both go through CartStore and the helpers below, only the I/O calls
+# differ.
+SHIPPING = 3  # You might want to make this configurable
+
+
+def build_cart_context(summary):
+    """Totals for the cart and checkout pages from CartItemQuerySet.summary()"""
+    subtotal = summary['subtotal']
+    return {
+        'item_count': summary['item_count'],
+        'subtotal': subtotal,
+        'shipping': SHIPPING,
+        'total': subtotal + SHIPPING,
+        'page_title': _('Shopping Cart'),
+        'cart_labels': get_labels('cart_labels')
+    }
+
+
+def is_ajax(request):
+    return request.headers.get('x-requested-with') == 'XMLHttpRequest'
+
+
+def get_cart_change(request):
+    return int(request.POST.get('product_id')), int(request.POST.get('quantity', 1))
+
+
+def check_product(product_id, product_name):
+    if product_name is None:
+        raise InvalidCartChange('Unknown product', [product_id])
+    return product_name
+
+
+def cart_updated(request, product_name, added, removed, cart_count):
+    if added:
+        messages.success(request, _('%(product)s added to cart successfully') % {'product': product_name})
+    elif removed:
+        messages.info(request, _('%(product)s removed from cart') % {'product': product_name})
+
+    if is_ajax(request):
+        return JsonResponse({
+            'status': 'success',
+            'cart_count': cart_count,
+            'message': _('Cart updated successfully')
+        })
+    return HttpResponseRedirect(request.POST.get('current_url', '/'))
+
+
+def parse_cart_batch(body):
+    """[(product_id, delta), ...] from {"changes": [{"product_id": 1, "quantity": 2}, ...]}"""
+    try:
+        changes = json.loads(body)['changes']
+        return [(int(change['product_id']), int(change['quantity'])) for change in changes]
+    except (ValueError, TypeError, KeyError):
+        raise InvalidCartChange('Malformed cart update')
+
+
+def cart_summary_json(summary, cart_count):
+    return {
+        'status': 'success',
+        'cart_count': cart_count,
+        'item_count': summary['item_count'],
+        'subtotal': str(summary['subtotal']),
+        'shipping': str(SHIPPING),
+        'total': str(summary['subtotal'] + SHIPPING),
+        'items': [
+            {
+                'product_id': item['product'].id,
+                'name': item['product'].name,
+                'price': str(item['product'].price),
+                'quantity': item['quantity'],
+                'total_price': str(item['total_price']),
+            }
+            for item in summary['items']
+        ],
+    }
+
+
+def cart_update_failed(request):
+    if is_ajax(request):
+        return JsonResponse({
+            'status': 'error',
+            'message': _('Error updating cart')
+        }, status=400)
+    messages.error(request, _('Error updating cart'))
+    return HttpResponseRedirect(request.POST.get('current_url', '/'))
+
+
+def change_cart(request):
+    """Apply one add-to-cart click and answer it, a positive quantity adds and anything else removes"""
+    try:
+        product_id, quantity = get_cart_change(request)
+        product_name = check_product(product_id, get_product_name(product_id))
+        # Cart changes only touch the cache, Cart/CartItem rows are written in batches
+        cart = CartStore(request)
+        removed = False
+        if quantity > 0:
+            cart.add(product_id, quantity)
+        else:
+            removed = cart.remove(product_id)
+        return cart_updated(request, product_name, quantity > 0, removed, cart.count())
+    except Exception:
+        return cart_update_failed(request)
+
+
+async def achange_cart(request):
+    """change_cart() for the async views"""
+    try:
+        product_id, quantity = get_cart_change(request)
+        product_name = check_product(product_id, await aget_product_name(product_id))
+        cart = CartStore(request)
+        removed = False
+        if quantity > 0:
+            await cart.aadd(product_id, quantity)
+        else:
+            removed = await cart.aremove(product_id)
+        return cart_updated(request, product_name, quantity > 0, removed, await cart.acount())
+    except Exception:
+        return cart_update_failed(request)
 
 
 class CartListView(ListView):
@@ -14,98 +138,62 @@ class CartListView(ListView):
     context_object_name = 'cart_items'
 
     def get_cart(self):
-        if self.request.user.is_authenticated:
-            cart, _ = Cart.objects.get_or_create(user=self.request.user)
-            return cart
-
-        session_id = self.request.session.get('cart_session_id')
-        if not session_id:
-            session_id = str(uuid.uuid4())
-            self.request.session['cart_session_id'] = session_id
-
-        cart, _ = Cart.objects.get_or_create(session_id=session_id)
-        return cart
+        return CartStore(self.request).get_cart()
 
     def get_context_data(self, **kwargs):
+        # Async views pass the summary in, totals are computed by the database
+        summary = kwargs.pop('summary', None)
+        if summary is None:
+            summary = self.object_list.summary()
         context = super().get_context_data(**kwargs)
         context['users'] = self.request.user
-        cart_items = self.get_queryset()
-        subtotal = sum(item.get_total() for item in cart_items)
-        shipping = 3  # You might want to make this configurable
-
-        context.update({
-            'subtotal': subtotal,
-            'shipping': shipping,
-            'total': subtotal + shipping,
-            'page_title': _('Shopping Cart'),
-            'cart_labels': {
-                'product': _('Product'),
-                'price': _('Price'),
-                'quantity': _('Quantity'),
-                'total': _('Total'),
-                'subtotal': _('Subtotal'),
-                'shipping': _('Shipping'),
-                'grand_total': _('Grand Total'),
-                'empty_cart': _('Your cart is empty'),
-                'continue_shopping': _('Continue Shopping'),
-                'proceed_to_checkout': _('Proceed to Checkout')
-            }
-        })
+        context.update(build_cart_context(summary))
         return context
 
     def get_queryset(self):
-        cart = self.get_cart()
-        return cart.items.all() if cart else []
+        return CartStore(self.request).items()
+
+
+class AsyncCartListView(CartListView):
+    async def get(self, request, *args, **kwargs):
+        self.object_list = await CartStore(request).aitems()
+        summary = await self.object_list.asummary()
+        # The items are read when the template renders, which Django runs in a thread
+        return self.render_to_response(self.get_context_data(summary=summary))
 
 
 class AddToCartView(View):
     def post(self, request, *args, **kwargs):
-        product_id = request.POST.get('product_id')
-        quantity = int(request.POST.get('quantity', 1))
+        response = change_cart(request)
+        flush_carts_if_due()
+        return response
+
+
+class AsyncAddToCartView(View):
+    async def post(self, request, *args, **kwargs):
+        response = await achange_cart(request)
+        await aflush_carts_if_due()
+        return response
+
 
+class CartBatchView(View):
+    """
+    JSON endpoint applying many quantity changes in one request, so the front
+    end can coalesce clicks and edits. Answers with the whole updated cart.
+    """
+
+    def post(self, request, *args, **kwargs):
+        cart = CartStore(request)
         try:
-            # Get or create cart based on user's authentication status
-            if request.user.is_authenticated:
-                cart, _ = Cart.objects.get_or_create(user=request.user)
-            else:
-                session_id = request.session.get('cart_session_id')
-                if not session_id:
-                    session_id = str(uuid.uuid4())
-                    request.session['cart_session_id'] = session_id
-                cart, _ = Cart.objects.get_or_create(session_id=session_id)
-
-            product = get_object_or_404(Product, id=product_id)
-            cart_item, created = CartItem.objects.get_or_create(cart=cart, product=product)
-
-            if quantity > 0:
-                if not created:
-                    cart_item.quantity += quantity
-                else:
-                    cart_item.quantity = quantity
-                cart_item.save()
-                messages.success(request, _('%(product)s added to cart successfully') % {'product': product.name})
-            else:
-                if not created:
-                    cart_item.delete()
-                    messages.info(request, _('%(product)s removed from cart') % {'product': product.name})
-
-            if request.headers.get('x-requested-with') == 'XMLHttpRequest':
-                return JsonResponse({
-                    'status': 'success',
-                    'cart_count': cart.items.count(),
-                    'message': _('Cart updated successfully')
-                })
-
-            return HttpResponseRedirect(request.POST.get('current_url', '/'))
-
-        except Exception as e:
-            if request.headers.get('x-requested-with') == 'XMLHttpRequest':
-                return JsonResponse({
-                    'status': 'error',
-                    'message': _('Error updating cart')
-                }, status=400)
-            messages.error(request, _('Error updating cart'))
-            return HttpResponseRedirect(request.POST.get('current_url', '/'))
+            summary = cart.apply(parse_cart_batch(request.body))
+        except InvalidCartChange as e:
+            return JsonResponse({
+                'status': 'error',
+                'message': _('Error updating cart'),
+                'product_ids': e.product_ids
+            }, status=400)
+        flush_carts_if_due()
+        return JsonResponse(cart_summary_json(summary, len(summary['items'])))
 
 
 class CheckoutView(CartListView):
@@ -116,17 +204,7 @@ class CheckoutView(CartListView):
         context = super().get_context_data(**kwargs)
         context.update({
             'page_title': _('Checkout'),
-            'checkout_labels': {
-                'payment_method': _('Payment Method'),
-                'first_name': _('First Name'),
-                'last_name': _('Last Name'),
-                'email': _('Email'),
-                'phone': _('Phone'),
-                'address': _('Address'),
-                'same_as_billing': _('Same as billing address'),
-                'place_order': _('Place Order'),
-                'order_summary': _('Order Summary')
-            }
+            'checkout_labels': get_labels('checkout_labels')
         })
         return context
 
@@ -136,22 +214,7 @@ class CheckoutView(CartListView):
             return HttpResponseRedirect(self.login_url)
 
         # If user was anonymous, transfer their cart items to their authenticated cart
-        session_id = request.session.get('cart_session_id')
-        if session_id:
-            anonymous_cart = Cart.objects.filter(session_id=session_id).first()
-            if anonymous_cart:
-                user_cart, _ = Cart.objects.get_or_create(user=request.user)
-                # Transfer items from anonymous cart to user's cart
-                for item in anonymous_cart.items.all():
-                    existing_item = user_cart.items.filter(product=item.product).first()
-                    if existing_item:
-                        existing_item.quantity += item.quantity
-                        existing_item.save()
-                    else:
-                        item.cart = user_cart
-                        item.save()
-                anonymous_cart.delete()
-                del request.session['cart_session_id']
-                messages.success(request, _('Your cart has been transferred to your account'))
+        if merge_session_cart(request, request.user):
+            messages.success(request, _('Your cart has been transferred to your account'))
 
         return super().get(request, *args, **kwargs)
\ No newline at end of file
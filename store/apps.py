@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class StoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'store'
+
+    def ready(self):
+        import store.signals
+        from store.labels import warm_up
+        warm_up()
@@ -0,0 +1,112 @@
+import time
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Max
+from django.utils.translation import get_language
+
+from .models import Category, Product
+
+# Catalog pages are cached and invalidated by bumping version counters from
+# the Product/Category signals instead of waiting for a TTL:
+#   catalog          - any category change (sidebar, page titles)
+#   all              - any product change (unfiltered listing, sidebar counts)
+#   category:<id>    - product changes inside one category
+# The counters live in the cache too. Only a shared cache (redis) lets every
+# worker see a bump, so entries are kept for hours only there, see
+# settings.CATALOG_TIMEOUT.
+VERSION_KEY = 'catalog_version:{name}'
+
+
+def _initial_version():
+    # Versions start from the clock so an evicted counter never reuses an old value
+    return int(time.time() * 1000)
+
+
+def is_cache_shared():
+    # django_redis backends (also the metrics subclass) expose their client
+    return hasattr(cache, 'client')
+
+
+def get_catalog_state():
+    """
+    What any product or category change moves, read with one query. Stands in
+    for the version counters where they are per process.
+    """
+    return list(Category.objects.aggregate(
+        Count('id', distinct=True), Max('updated_at'), Count('products'), Max('products__updated_at')
+    ).values())
+
+
+def get_catalog_timeout():
+    return getattr(settings, 'CATALOG_TIMEOUT', 60 * 15)
+
+
+def get_versions(*names):
+    keys = {VERSION_KEY.format(name=name): name for name in names}
+    versions = {keys[key]: value for key, value in cache.get_many(keys).items()}
+    for name in names:
+        if name not in versions:
+            cache.add(VERSION_KEY.format(name=name), _initial_version(), None)
+            versions[name] = cache.get(VERSION_KEY.format(name=name))
+    return versions
+
+
+async def aget_versions(*names):
+    keys = {VERSION_KEY.format(name=name): name for name in names}
+    versions = {keys[key]: value for key, value in (await cache.aget_many(keys)).items()}
+    for name in names:
+        if name not in versions:
+            await cache.aadd(VERSION_KEY.format(name=name), _initial_version(), None)
+            versions[name] = await cache.aget(VERSION_KEY.format(name=name))
+    return versions
+
+
+def bump_version(name):
+    """Invalidate what is cached under a version once the current transaction commits"""
+    # Bumped before the commit, a concurrent request could cache the old rows under the new version
+    transaction.on_commit(partial(_bump_version, name))
+
+
+def _bump_version(name):
+    key = VERSION_KEY.format(name=name)
+    if not cache.add(key, _initial_version(), None):
+        try:
+            cache.incr(key)
+        except ValueError:
+            # Evicted between add() and incr()
+            cache.add(key, _initial_version(), None)
+
+
+def bump_category(category_id):
+    bump_version(f'category:{category_id}')
+    bump_version('all')
+
+
+def get_sidebar_categories():
+    """Categories with their product counts, shared by every listing page in a language"""
+    versions = get_versions('catalog', 'all')
+    cache_key = f"category_sidebar:{get_language()}:{versions['catalog']}.{versions['all']}"
+    categories = cache.get(cache_key)
+    if categories is None:
+        categories = list(Category.objects.all())
+        cache.set(cache_key, categories, get_catalog_timeout())
+    return categories
+
+
+def get_listing_cache_key(slug, category, sort, page, filters='any'):
+    """Cache key for one page of the product listing, category is None for unknown slugs"""
+    if not slug:
+        scope = 'all'
+    elif category is not None:
+        scope = f'category:{category.id}'
+    else:
+        # Unknown slugs only change when a category is created or renamed
+        scope = 'catalog'
+    versions = get_versions('catalog', scope)
+    return (
+        f"product_list:{get_language()}:{slug or 'all'}:{sort}:{filters}:{page}:"
+        f"{versions['catalog']}.{versions[scope]}"
+    )
@@ -0,0 +1,55 @@
+import hashlib
+
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.core.cache import cache
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+from django.utils.translation import get_language
+
+from .labels import TRANSLATIONS_VERSION_KEY
+
+# Conditional GET for catalog pages. The ETag is built from the catalog
+# version counters (store.cache), the translations version and what the
+# header shows for the visitor: language, login and cart badge. All of it
+# comes from the cache, so a 304 costs no rendering and at most the query a
+# page needs to find its object. Without a shared cache the counters are per
+# process, the listing reads one aggregate of the catalog rows instead.
+
+
+def make_etag(*parts):
+    return hashlib.md5(':'.join(str(part) for part in parts).encode()).hexdigest()
+
+
+def has_pending_messages(request):
+    # A 304 would keep them from being shown
+    return CookieStorage.cookie_name in request.COOKIES
+
+
+def get_page_state(request, cart_count):
+    return [get_language(), request.user.pk, cart_count, cache.get(TRANSLATIONS_VERSION_KEY)]
+
+
+async def aget_page_state(request, cart_count):
+    user = await request.auser()
+    return [get_language(), user.pk, cart_count, await cache.aget(TRANSLATIONS_VERSION_KEY)]
+
+
+def conditional_response(request, etag, last_modified=None):
+    """A 304 (or 412) response if the client's copy is current, else None"""
+    if etag is None:
+        return None
+    response = get_conditional_response(
+        request, etag=quote_etag(etag), last_modified=int(last_modified.timestamp()) if last_modified else None
+    )
+    return None if response is None else set_validators(response, etag, last_modified)
+
+
+def set_validators(response, etag, last_modified=None):
+    if etag is None or response.status_code not in (200, 304):
+        return response
+    response.headers['ETag'] = quote_etag(etag)
+    if last_modified is not None:
+        response.headers['Last-Modified'] = http_date(last_modified.timestamp())
+    # The header is per visitor, and every view should check the validators
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
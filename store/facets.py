@@ -0,0 +1,110 @@
+import bisect
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.db.models import Case, F, IntegerField, Q, Value, When
+from django.utils.translation import gettext_lazy as _
+
+from .cache import get_catalog_timeout, get_versions
+from .models import ProductFacet
+
+# Lower bounds of the price buckets, each bucket runs up to the next bound
+PRICE_BOUNDS = [Decimal(bound) for bound in (0, 5, 10, 25, 50, 100)]
+STOCK_CHOICES = {'in': True, 'out': False}
+STOCK_LABELS = {True: _('In Stock'), False: _('Out of Stock')}
+
+
+def get_price_bucket(price):
+    if price is None:
+        return None
+    return max(bisect.bisect_right(PRICE_BOUNDS, Decimal(str(price))) - 1, 0)
+
+
+def get_price_range(bucket):
+    """(low, high) of a bucket, high is None for the last one"""
+    high = PRICE_BOUNDS[bucket + 1] if bucket + 1 < len(PRICE_BOUNDS) else None
+    return PRICE_BOUNDS[bucket], high
+
+
+def get_price_label(bucket):
+    low, high = get_price_range(bucket)
+    if high is None:
+        return f'${low}+'
+    return f'${low} - ${high}'
+
+
+def price_bucket_expression():
+    """SQL CASE computing the price bucket of each product row"""
+    return Case(
+        *[When(price__gte=low, then=Value(bucket)) for bucket, low in reversed(list(enumerate(PRICE_BOUNDS)))],
+        default=Value(0),
+        output_field=IntegerField(),
+    )
+
+
+def get_facet_key(category_id, price, stock):
+    """The cell a product with these values is counted in, None if it is incomplete"""
+    bucket = get_price_bucket(price)
+    if category_id is None or bucket is None:
+        return None
+    return category_id, bucket, (stock or 0) > 0
+
+
+def adjust_facet(key, delta):
+    if key is None:
+        return
+    category_id, price_bucket, in_stock = key
+    cells = ProductFacet.objects.filter(category_id=category_id, price_bucket=price_bucket, in_stock=in_stock)
+    if delta > 0:
+        ProductFacet.objects.bulk_create(
+            [ProductFacet(category_id=category_id, price_bucket=price_bucket, in_stock=in_stock)],
+            ignore_conflicts=True,
+        )
+    else:
+        # Never go negative if the stored count has drifted
+        cells = cells.filter(count__gte=-delta)
+    cells.update(count=F('count') + delta)
+
+
+def get_facet_cells():
+    """Every non-empty (category_id, price_bucket, in_stock, count) cell, read with one cache lookup"""
+    versions = get_versions('all')
+    cache_key = f"product_facets:{versions['all']}"
+    cells = cache.get(cache_key)
+    if cells is None:
+        cells = list(
+            ProductFacet.objects.filter(count__gt=0).values_list('category_id', 'price_bucket', 'in_stock', 'count')
+        )
+        cache.set(cache_key, cells, get_catalog_timeout())
+    return cells
+
+
+def get_facet_counts(category_id=None, price_bucket=None, in_stock=None):
+    """
+    Counts for every facet value. Each facet is counted under the filters of the
+    other facets, so picking a price keeps the other price buckets visible.
+    """
+    categories, prices, stock = {}, {}, {True: 0, False: 0}
+    for cell_category, cell_bucket, cell_in_stock, count in get_facet_cells():
+        category_match = category_id is None or cell_category == category_id
+        price_match = price_bucket is None or cell_bucket == price_bucket
+        stock_match = in_stock is None or cell_in_stock == in_stock
+        if price_match and stock_match:
+            categories[cell_category] = categories.get(cell_category, 0) + count
+        if category_match and stock_match:
+            prices[cell_bucket] = prices.get(cell_bucket, 0) + count
+        if category_match and price_match:
+            stock[cell_in_stock] += count
+    return {'categories': categories, 'prices': prices, 'stock': stock}
+
+
+def filter_products(queryset, price_bucket=None, in_stock=None):
+    if price_bucket is not None:
+        low, high = get_price_range(price_bucket)
+        queryset = queryset.filter(price__gte=low)
+        if high is not None:
+            queryset = queryset.filter(price__lt=high)
+    if in_stock is not None:
+        queryset = queryset.filter(Q(stock__gt=0) if in_stock else Q(stock=0))
+    return queryset
+
@@ -0,0 +1,111 @@
+import hashlib
+import io
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections
+from django.utils import timezone
+from PIL import Image, ImageOps
+
+from .cache import bump_category
+from .models import Product
+
+logger = logging.getLogger(__name__)
+
+# Pages never serve the uploaded original. Every product image is resized to
+# each width in IMAGE_WIDTHS for the srcset of cards and detail pages, plus a
+# square THUMBNAIL_SIZE crop for the cart, each as WebP and JPEG. Variants are
+# named after the content hash of the original, so their URLs can be cached
+# forever and a new upload never reuses them. Uploads are processed by a thread
+# pool once the save commits, existing media by the generate_thumbnails command.
+IMAGE_WIDTHS = (300, 600, 900)
+THUMBNAIL_SIZE = 160
+FORMATS = {'webp': 'WEBP', 'jpg': 'JPEG'}
+QUALITY = 80
+DERIVED_DIR = 'products/derived'
+
+_executor = None
+
+
+def get_variants():
+    """Names of every variant, widths first"""
+    return [*(f'{width}w' for width in IMAGE_WIDTHS), 'thumb']
+
+
+def get_variant_name(image_hash, variant, extension):
+    return f'{DERIVED_DIR}/{image_hash[:2]}/{image_hash}-{variant}.{extension}'
+
+
+def get_variant_url(image_hash, variant, extension='jpg'):
+    return default_storage.url(get_variant_name(image_hash, variant, extension))
+
+
+def render_variant(image, variant):
+    if variant == 'thumb':
+        return ImageOps.fit(image, (THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+    width = int(variant[:-1])
+    if image.width <= width:
+        # Never upscale, the browser does that just as well
+        return image
+    return image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+
+
+def generate_variants(name):
+    """Write the missing variants of a stored image, returns its content hash"""
+    with default_storage.open(name, 'rb') as file:
+        data = file.read()
+    image_hash = hashlib.sha1(data).hexdigest()
+
+    pending = [
+        (variant, extension) for variant in get_variants() for extension in FORMATS
+        if not default_storage.exists(get_variant_name(image_hash, variant, extension))
+    ]
+    if pending:
+        with Image.open(io.BytesIO(data)) as original:
+            image = ImageOps.exif_transpose(original).convert('RGB')
+        for variant, extension in pending:
+            output = io.BytesIO()
+            render_variant(image, variant).save(output, FORMATS[extension], quality=QUALITY)
+            default_storage.save(get_variant_name(image_hash, variant, extension), ContentFile(output.getvalue()))
+    return image_hash
+
+
+def process_product_image(product_id, category_id, name):
+    """Generate the variants of one upload and publish them on the product"""
+    try:
+        image_hash = generate_variants(name)
+    except Exception:
+        logger.exception('Could not create the variants of %s', name)
+        return
+    # Skipped if the image was replaced in the meantime, its own task publishes it
+    if Product.objects.filter(pk=product_id, image=name).update(image_hash=image_hash, updated_at=timezone.now()):
+        bump_category(category_id)
+
+
+def _run_in_worker(*args):
+    # Pool threads keep their connection between tasks, like a request would
+    close_old_connections()
+    try:
+        process_product_image(*args)
+    finally:
+        close_old_connections()
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, 'IMAGE_WORKERS', 2), thread_name_prefix='product-images'
+        )
+    return _executor
+
+
+def schedule_variants(product_id, category_id, name):
+    """Process an upload in the background, or right away when IMAGE_WORKERS is 0"""
+    if getattr(settings, 'IMAGE_WORKERS', 2) == 0:
+        process_product_image(product_id, category_id, name)
+    else:
+        get_executor().submit(_run_in_worker, product_id, category_id, name)
@@ -0,0 +1,159 @@
+import gettext as gettext_module
+import os
+import threading
+import time
+from types import MappingProxyType
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import translation
+from django.utils.translation import gettext_lazy as _
+from django.utils.translation import trans_real
+
+# Static label dicts handed to templates. They are resolved once per language
+# at startup into read-only dicts instead of being rebuilt from lazy strings on
+# every request. The .mo files are built on deploy by the compile_translations
+# command, startup only reads them. A rosetta save bumps TRANSLATIONS_VERSION_KEY, every process
+# notices within LABELS_CHECK_INTERVAL seconds and reloads its catalogs.
+LABEL_BUNDLES = {
+    'cart_labels': {
+        'product': _('Product'),
+        'price': _('Price'),
+        'quantity': _('Quantity'),
+        'total': _('Total'),
+        'subtotal': _('Subtotal'),
+        'shipping': _('Shipping'),
+        'grand_total': _('Grand Total'),
+        'empty_cart': _('Your cart is empty'),
+        'continue_shopping': _('Continue Shopping'),
+        'proceed_to_checkout': _('Proceed to Checkout')
+    },
+    'checkout_labels': {
+        'payment_method': _('Payment Method'),
+        'first_name': _('First Name'),
+        'last_name': _('Last Name'),
+        'email': _('Email'),
+        'phone': _('Phone'),
+        'address': _('Address'),
+        'same_as_billing': _('Same as billing address'),
+        'place_order': _('Place Order'),
+        'order_summary': _('Order Summary')
+    },
+    'product_details': {
+        'category': _('Category'),
+        'price': _('Price'),
+        'in_stock': _('In Stock'),
+        'out_of_stock': _('Out of Stock'),
+        'description': _('Description')
+    },
+}
+TRANSLATIONS_VERSION_KEY = 'translations_version'
+LABELS_CHECK_INTERVAL = 5
+
+_bundles = {}
+_loaded_version = None
+_last_check = 0.0
+_reload_lock = threading.Lock()
+
+
+def compile_catalogs():
+    """Compile every .po file in LOCALE_PATHS whose .mo is missing or older, returns the files compiled"""
+    # Only needed where catalogs are compiled, not by the running site
+    import polib
+
+    compiled = []
+    for locale_path in settings.LOCALE_PATHS:
+        for directory, _dirs, files in os.walk(locale_path):
+            for name in files:
+                if not name.endswith('.po'):
+                    continue
+                po_path = os.path.join(directory, name)
+                mo_path = po_path[:-3] + '.mo'
+                if os.path.exists(mo_path) and os.path.getmtime(mo_path) >= os.path.getmtime(po_path):
+                    continue
+                polib.pofile(po_path).save_as_mofile(mo_path)
+                compiled.append(mo_path)
+    return compiled
+
+
+def build_bundles():
+    """Resolve every label bundle in every language into read-only dicts"""
+    bundles = {}
+    for language, _name in settings.LANGUAGES:
+        # override() loads and caches the catalog of the language
+        with translation.override(language):
+            bundles[language] = {
+                name: MappingProxyType({key: str(label) for key, label in labels.items()})
+                for name, labels in LABEL_BUNDLES.items()
+            }
+    return bundles
+
+
+def warm_up():
+    """Load the catalogs and resolve the label bundles, run from AppConfig.ready()"""
+    global _bundles, _loaded_version, _last_check
+    _bundles = build_bundles()
+    _loaded_version = cache.get(TRANSLATIONS_VERSION_KEY)
+    _last_check = time.monotonic()
+
+
+def reload_translations():
+    """Read this process' catalogs again from the .mo files"""
+    global _bundles
+    with _reload_lock:
+        # Private API: Django keeps the loaded catalogs in trans_real._translations
+        # and _default, the gettext module caches the parsed .mo files by path.
+        # Other threads read both without a lock, so _default is never None and
+        # no language ever leaves _translations, each one is replaced in place.
+        # Requests already running keep their catalog, the next activate() gets the new one.
+        gettext_module._translations.clear()
+        default = trans_real.DjangoTranslation(settings.LANGUAGE_CODE)
+        trans_real._translations = {**trans_real._translations, settings.LANGUAGE_CODE: default}
+        trans_real._default = default
+        # Built after the default is swapped in, they fall back to the new one
+        for language in list(trans_real._translations):
+            if language != settings.LANGUAGE_CODE:
+                trans_real._translations[language] = trans_real.DjangoTranslation(language)
+        _bundles = build_bundles()
+
+
+def bump_translations_version():
+    if not cache.add(TRANSLATIONS_VERSION_KEY, 1, None):
+        try:
+            cache.incr(TRANSLATIONS_VERSION_KEY)
+        except ValueError:
+            cache.add(TRANSLATIONS_VERSION_KEY, 1, None)
+
+
+def translations_saved():
+    """Reload here right away and tell the other processes through the version key"""
+    global _loaded_version
+    bump_translations_version()
+    _loaded_version = cache.get(TRANSLATIONS_VERSION_KEY)
+    reload_translations()
+
+
+def check_for_updates():
+    """Reload the catalogs if another process saved translations, at most every LABELS_CHECK_INTERVAL"""
+    global _loaded_version, _last_check
+    if time.monotonic() - _last_check < LABELS_CHECK_INTERVAL:
+        return False
+    _last_check = time.monotonic()
+    version = cache.get(TRANSLATIONS_VERSION_KEY)
+    if version == _loaded_version:
+        return False
+    _loaded_version = version
+    reload_translations()
+    return True
+
+
+def get_labels(name, language=None):
+    """A label bundle in the given or active language"""
+    check_for_updates()
+    language = language or translation.get_language() or settings.LANGUAGE_CODE
+    bundles = _bundles.get(language)
+    if bundles is None:
+        # Unknown language or warm_up() has not run, e.g. a regional variant
+        with translation.override(language):
+            return MappingProxyType({key: str(label) for key, label in LABEL_BUNDLES[name].items()})
+    return bundles[name]
@@ -0,0 +1,99 @@
+import random
+import shutil
+import statistics
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connections
+
+from order.cart import persist_cart, session_owner
+from store.models import Category, Product
+
+
+def _setup(name, profile):
+    django.setup()
+    # Before the worker's first query, so its connection opens with the profile
+    connections['default'].settings_dict.update({'OPTIONS': {}, 'CONN_MAX_AGE': 0, **profile, 'NAME': name})
+
+
+def _run(worker, duration, write_ratio, category_ids, product_ids):
+    rng = random.Random(worker)
+    reads, writes, locked = [], [], 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        try:
+            if rng.random() < write_ratio:
+                # One visitor out of a small pool changes their cart, like a flush would write it
+                owner = session_owner(f'benchmark-{worker}-{rng.randrange(50)}')
+                persist_cart(owner, {product_id: rng.randint(1, 5) for product_id in rng.sample(product_ids, 3)})
+                writes.append(time.perf_counter() - started)
+            else:
+                # A listing page and a product page
+                list(Product.objects.filter(category_id=rng.choice(category_ids)).order_by('-created_at')[:9])
+                Product.objects.get(pk=rng.choice(product_ids))
+                reads.append(time.perf_counter() - started)
+        except OperationalError as e:
+            if 'locked' not in str(e):
+                raise
+            locked += 1
+    connections.close_all()
+    return reads, writes, locked
+
+
+class Command(BaseCommand):
+    help = 'Compare read and write throughput of the SQLite profiles under concurrent catalog reads and cart writes'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--profiles', nargs='+', choices=list(settings.SQLITE_PROFILES), default=list(settings.SQLITE_PROFILES)
+        )
+        parser.add_argument('--workers', type=int, default=8, help='Concurrent processes')
+        parser.add_argument('--duration', type=float, default=10, help='Seconds per profile')
+        parser.add_argument('--write-ratio', type=float, default=0.1, help='Share of operations that write a cart')
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1 or not 0 <= options['write_ratio'] <= 1:
+            raise CommandError('--workers must be positive and --write-ratio between 0 and 1')
+        product_ids = list(Product.objects.values_list('id', flat=True))
+        category_ids = list(Category.objects.values_list('id', flat=True))
+        if len(product_ids) < 3:
+            raise CommandError('Not enough products to benchmark, run populate_db first')
+
+        source = Path(connections['default'].settings_dict['NAME'])
+        connections.close_all()
+        with tempfile.TemporaryDirectory() as directory:
+            for profile in options['profiles']:
+                # A fresh copy each, WAL mode stays with the file once set
+                name = Path(directory) / f'{profile}.sqlite3'
+                shutil.copyfile(source, name)
+                self.run_profile(profile, str(name), category_ids, product_ids, options)
+
+    def run_profile(self, profile, name, category_ids, product_ids, options):
+        workers = options['workers']
+        with ProcessPoolExecutor(
+            max_workers=workers, initializer=_setup, initargs=(name, settings.SQLITE_PROFILES[profile])
+        ) as executor:
+            started = time.perf_counter()
+            results = list(executor.map(
+                _run, range(workers), [options['duration']] * workers, [options['write_ratio']] * workers,
+                [category_ids] * workers, [product_ids] * workers,
+            ))
+            elapsed = time.perf_counter() - started
+
+        reads = sorted(latency for result in results for latency in result[0])
+        writes = sorted(latency for result in results for latency in result[1])
+        locked = sum(result[2] for result in results)
+        self.stdout.write(
+            f'{profile:<12} reads {len(reads) / elapsed:8.1f}/s (p99 {self.p99(reads):7.1f} ms)   '
+            f'writes {len(writes) / elapsed:7.1f}/s (p99 {self.p99(writes):7.1f} ms, '
+            f'median {statistics.median(writes or [0]) * 1000:.1f} ms)   locked errors {locked}'
+        )
+
+    def p99(self, latencies):
+        return latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0
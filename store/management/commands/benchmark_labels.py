@@ -0,0 +1,65 @@
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import translation
+from django.utils.translation import trans_real
+
+from store.labels import LABEL_BUNDLES, build_bundles, compile_catalogs, get_labels
+
+
+class Command(BaseCommand):
+    help = 'Measure startup warm-up time and the per-request cost of the label bundles'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=20_000, help='Simulated requests per language')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        compile_catalogs()
+        compile_time = time.perf_counter() - started
+
+        trans_real._translations = {}
+        trans_real._default = None
+        started = time.perf_counter()
+        build_bundles()
+        warm_time = time.perf_counter() - started
+        self.stdout.write(
+            f'warm-up: catalog check {compile_time * 1000:.1f} ms, '
+            f'load catalogs and resolve bundles {warm_time * 1000:.1f} ms'
+        )
+
+        started = time.perf_counter()
+        subprocess.run(
+            [sys.executable, '-c', 'import django; django.setup()'],
+            check=True, env={'DJANGO_SETTINGS_MODULE': settings.SETTINGS_MODULE, 'PATH': ''},
+        )
+        self.stdout.write(f'cold start of a new process: {(time.perf_counter() - started) * 1000:.0f} ms')
+
+        count = options['requests']
+        for language, _name in settings.LANGUAGES:
+            with translation.override(language):
+                lazy = self.timed(count, self.resolve_lazy)
+                frozen = self.timed(count, self.resolve_frozen)
+            self.stdout.write(
+                f'{language}: lazy dicts {lazy * 1e6:.1f} us/request, frozen bundles {frozen * 1e6:.1f} us/request'
+            )
+
+    def resolve_lazy(self):
+        # What the views did before: build the dicts and let the template resolve every label
+        for labels in LABEL_BUNDLES.values():
+            for label in dict(labels).values():
+                str(label)
+
+    def resolve_frozen(self):
+        for name in LABEL_BUNDLES:
+            for label in get_labels(name).values():
+                str(label)
+
+    def timed(self, count, func):
+        started = time.perf_counter()
+        for _ in range(count):
+            func()
+        return (time.perf_counter() - started) / count
@@ -0,0 +1,58 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.core.paginator import Paginator
+from django.db import transaction
+
+from store.models import Category, Product
+from store.pagination import KeysetPaginator
+
+
+class Command(BaseCommand):
+    help = 'Compare OFFSET and keyset pagination on a deep page of a large catalog'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=1_000_000, help='Number of products to generate')
+        parser.add_argument('--page', type=int, default=10_000, help='Page number to fetch')
+        parser.add_argument('--per-page', type=int, default=9, help='Products per page')
+        parser.add_argument('--batch-size', type=int, default=10_000, help='Rows per INSERT')
+
+    def handle(self, *args, **options):
+        per_page = options['per_page']
+        # Everything runs inside a transaction that is rolled back afterwards
+        with transaction.atomic():
+            self.generate(options['products'], options['batch_size'])
+            queryset = Product.objects.all()
+
+            for ordering in ('price', '-price', 'name_en', '-name_en', 'created_at', '-created_at'):
+                offset_time = self.timed(
+                    lambda: list(Paginator(queryset.order_by(ordering, 'id'), per_page).page(options['page']))
+                )
+
+                # The cursor a visitor would hold after reaching the previous page
+                paginator = KeysetPaginator(queryset, per_page, ordering)
+                boundary = paginator.queryset.order_by(*paginator.order_by())[(options['page'] - 1) * per_page - 1]
+                cursor = paginator.encode_cursor(boundary, 'next')
+                keyset_time = self.timed(lambda: list(paginator.page(cursor)))
+
+                self.stdout.write(
+                    f'{ordering:>12}: offset {offset_time * 1000:8.1f} ms, keyset {keyset_time * 1000:6.1f} ms'
+                )
+            transaction.set_rollback(True)
+
+    def generate(self, total, batch_size):
+        self.stdout.write(f'Generating {total} products...')
+        category = Category.objects.create(name='Benchmark', description='Benchmark category')
+        for start in range(0, total, batch_size):
+            Product.objects.bulk_create([
+                Product(
+                    name=f'Product {i:07d}', name_en=f'Product {i:07d}', name_ka=f'პროდუქტი {i:07d}',
+                    category=category, price=(i * 7919) % 10000 / 100, stock=i % 50, slug=f'benchmark-{i}'
+                )
+                for i in range(start, min(start + batch_size, total))
+            ])
+
+    def timed(self, func):
+        started = time.perf_counter()
+        func()
+        return time.perf_counter() - started
@@ -0,0 +1,113 @@
+import itertools
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from store.models import Category, Product
+from store.search import SearchPaginator, is_supported, rebuild_index
+
+
+CONSONANTS_EN = 'bcdfghjklmnprstvz'
+VOWELS_EN = 'aeiou'
+CONSONANTS_KA = 'ბგდვზთკლმნპჟრსტფქღყშჩცძწჭხჯჰ'
+VOWELS_KA = 'აეიოუ'
+
+
+class Command(BaseCommand):
+    help = 'Measure p50/p99 latency of product search on a large generated catalog'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=1_000_000, help='Number of products to generate')
+        parser.add_argument('--queries', type=int, default=500, help='Number of searches to time')
+        parser.add_argument('--per-page', type=int, default=9, help='Results per page')
+        parser.add_argument('--batch-size', type=int, default=10_000, help='Rows per INSERT')
+        parser.add_argument('--vocabulary', type=int, default=5000, help='Distinct words per language')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        if not is_supported():
+            raise CommandError('Product search needs SQLite with FTS5')
+        self.random = random.Random(options['seed'])
+        self.build_vocabulary(options['vocabulary'])
+        # Everything runs inside a transaction that is rolled back afterwards
+        with transaction.atomic():
+            self.generate(options['products'], options['batch_size'])
+            started = time.perf_counter()
+            rebuild_index()
+            self.stdout.write(f'Indexed in {time.perf_counter() - started:.1f}s')
+
+            queries = [self.query() for _ in range(options['queries'])]
+            first_pages, next_pages = [], []
+            for query in queries:
+                paginator = SearchPaginator(query, options['per_page'])
+                elapsed, page = self.timed(paginator.page)
+                first_pages.append(elapsed)
+                if page.has_next():
+                    elapsed, _ = self.timed(lambda: paginator.page(page.next_cursor))
+                    next_pages.append(elapsed)
+
+            self.report('first page', first_pages)
+            self.report('next page', next_pages)
+            transaction.set_rollback(True)
+
+    def build_vocabulary(self, size):
+        """Paired English and Georgian pseudo-words drawn with Zipf frequencies, like real text"""
+        english, georgian = set(), []
+        while len(english) < size:
+            length = self.random.randrange(2, 5)
+            word = ''.join(
+                self.random.choice(CONSONANTS_EN) + self.random.choice(VOWELS_EN) for _ in range(length)
+            )
+            if word not in english:
+                english.add(word)
+                georgian.append(''.join(
+                    self.random.choice(CONSONANTS_KA) + self.random.choice(VOWELS_KA) for _ in range(length)
+                ))
+        self.words_en = sorted(english)
+        self.words_ka = georgian
+        self.weights = list(itertools.accumulate(1 / rank for rank in range(1, size + 1)))
+
+    def words(self, count):
+        return self.random.choices(range(len(self.words_en)), cum_weights=self.weights, k=count)
+
+    def generate(self, total, batch_size):
+        self.stdout.write(f'Generating {total} products...')
+        category = Category.objects.create(name='Benchmark', description='Benchmark category')
+        for start in range(0, total, batch_size):
+            products = []
+            for _ in range(start, min(start + batch_size, total)):
+                name, description = self.words(3), self.words(12)
+                products.append(Product(
+                    name=' '.join(self.words_en[i] for i in name),
+                    name_ka=' '.join(self.words_ka[i] for i in name),
+                    description=' '.join(self.words_en[i] for i in description),
+                    description_ka=' '.join(self.words_ka[i] for i in description),
+                    category=category, price=1,
+                ))
+            Product.objects.bulk_create(products)
+
+    def query(self):
+        """One or two words in either language, sometimes cut short as typed"""
+        words = self.words_en if self.random.random() < 0.5 else self.words_ka
+        terms = [words[i] for i in self.words(self.random.choice([1, 2]))]
+        if self.random.random() < 0.3:
+            terms[-1] = terms[-1][:max(3, len(terms[-1]) // 2)]
+        return ' '.join(terms)
+
+    def timed(self, func):
+        started = time.perf_counter()
+        result = func()
+        return time.perf_counter() - started, result
+
+    def report(self, label, timings):
+        if len(timings) < 2:
+            self.stdout.write(f'{label}: not enough searches')
+            return
+        percentiles = statistics.quantiles(timings, n=100)
+        self.stdout.write(
+            f'{label}: p50 {percentiles[49] * 1000:.1f} ms, p99 {percentiles[98] * 1000:.1f} ms '
+            f'over {len(timings)} searches'
+        )
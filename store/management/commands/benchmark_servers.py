@@ -0,0 +1,173 @@
+import http.client
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode, urlsplit
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.crypto import get_random_string
+
+from store.models import Product
+
+# Each server is started from the project directory against the same database
+# and settings. 'asgi-sync' serves the sync views under ASGI, which is what the
+# project did before the async views: every request hops into a thread.
+SERVERS = {
+    'wsgi': ('gunicorn', '0'),
+    'asgi-sync': (None, '0'),
+    'asgi': (None, '1'),
+}
+ASGI_SERVERS = ('uvicorn', 'daphne')
+
+
+class Client:
+    """One keep-alive connection with its own cookies, like one browser tab"""
+
+    def __init__(self, host, port):
+        self.connection = http.client.HTTPConnection(host, port, timeout=30)
+        # Any 32 character token is a valid CSRF secret when the cookie and header match
+        token = get_random_string(32)
+        self.cookies = {'csrftoken': token}
+        self.csrf_token = token
+
+    def request(self, method, path, body=None):
+        headers = {
+            'Cookie': '; '.join(f'{name}={value}' for name, value in self.cookies.items()),
+            'X-Requested-With': 'XMLHttpRequest',
+        }
+        if body is not None:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+            headers['X-CSRFToken'] = self.csrf_token
+        self.connection.request(method, path, body=body, headers=headers)
+        response = self.connection.getresponse()
+        response.read()
+        for header in response.headers.get_all('Set-Cookie') or []:
+            for name, morsel in SimpleCookie(header).items():
+                self.cookies[name] = morsel.value
+        return response.status
+
+
+class Command(BaseCommand):
+    help = 'Compare requests per second of the WSGI and ASGI servers on the product, cart and add-to-cart views'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--servers', nargs='+', choices=list(SERVERS), default=list(SERVERS), help='Servers to start and compare'
+        )
+        parser.add_argument('--asgi-server', choices=ASGI_SERVERS, default='uvicorn')
+        parser.add_argument('--url', help='Benchmark an already running server instead of starting them')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--workers', type=int, default=1, help='Server worker processes')
+        parser.add_argument('--threads', type=int, default=8, help='Threads per gunicorn worker')
+        parser.add_argument('--concurrency', type=int, default=16, help='Concurrent client connections')
+        parser.add_argument('--duration', type=float, default=10, help='Seconds per scenario')
+
+    def handle(self, *args, **options):
+        product = Product.objects.order_by('id').first()
+        if product is None:
+            raise CommandError('No products to request, run populate_db first')
+        self.scenarios = {
+            'product': ('GET', f'/product/{product.slug}/', None),
+            'cart': ('GET', '/cart/', None),
+            'add-to-cart': ('POST', '/add-to-cart/', urlencode({'product_id': product.id, 'quantity': 1})),
+        }
+
+        if options['url']:
+            url = urlsplit(options['url'])
+            self.run_scenarios(options['url'], url.hostname, url.port or 80, options)
+            return
+
+        for name in options['servers']:
+            command = self.get_command(name, options)
+            env = {**os.environ, 'DJANGO_SETTINGS_MODULE': settings.SETTINGS_MODULE,
+                   'DJANGO_ASYNC_VIEWS': SERVERS[name][1]}
+            server = subprocess.Popen(
+                command, cwd=settings.BASE_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+            )
+            try:
+                self.wait_for_port(server, '127.0.0.1', options['port'])
+                self.run_scenarios(f'{name} ({command[0]})', '127.0.0.1', options['port'], options)
+            finally:
+                server.terminate()
+                server.wait(timeout=30)
+
+    def get_command(self, name, options):
+        executable = SERVERS[name][0] or options['asgi_server']
+        if shutil.which(executable) is None:
+            raise CommandError(f'{executable} is not installed, run "pip install {executable}" or pick other --servers')
+
+        port, workers = str(options['port']), str(options['workers'])
+        if executable == 'gunicorn':
+            return [
+                'gunicorn', 'djangoProject.wsgi:application', '--bind', f'127.0.0.1:{port}', '--workers', workers,
+                '--threads', str(options['threads']), '--log-level', 'warning',
+            ]
+        if executable == 'uvicorn':
+            return [
+                'uvicorn', 'djangoProject.asgi:application', '--port', port, '--workers', workers,
+                '--no-access-log', '--log-level', 'warning',
+            ]
+        # daphne has no worker option, run one process per core behind a balancer instead
+        return ['daphne', '--port', port, '--verbosity', '0', 'djangoProject.asgi:application']
+
+    def wait_for_port(self, server, host, port, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                raise CommandError(f'Server exited with code {server.returncode}:\n{server.stderr.read().decode()}')
+            try:
+                socket.create_connection((host, port), timeout=1).close()
+                return
+            except OSError:
+                time.sleep(0.1)
+        raise CommandError(f'Server did not start listening on {host}:{port} within {timeout} seconds')
+
+    def run_scenarios(self, label, host, port, options):
+        self.stdout.write(label)
+        for name, (method, path, body) in self.scenarios.items():
+            # Warm up the caches and the server's imports before measuring
+            Client(host, port).request(method, path, body)
+            requests, latencies, errors, elapsed = self.load(host, port, method, path, body, options)
+            latencies.sort()
+            p99 = latencies[int(len(latencies) * 0.99)] if latencies else 0
+            self.stdout.write(
+                f'  {name:<12} {requests / elapsed:8.1f} req/s   '
+                f'p50 {statistics.median(latencies or [0]) * 1000:6.1f} ms   p99 {p99 * 1000:6.1f} ms   '
+                f'errors {errors}'
+            )
+
+    def load(self, host, port, method, path, body, options):
+        lock = threading.Lock()
+        latencies, errors = [], [0]
+        started = time.perf_counter()
+        deadline = started + options['duration']
+
+        def worker():
+            client = Client(host, port)
+            local_latencies, local_errors = [], 0
+            while time.perf_counter() < deadline:
+                request_started = time.perf_counter()
+                try:
+                    status = client.request(method, path, body)
+                except (OSError, http.client.HTTPException):
+                    client = Client(host, port)
+                    status = None
+                if status is None or status >= 400:
+                    local_errors += 1
+                else:
+                    local_latencies.append(time.perf_counter() - request_started)
+            with lock:
+                latencies.extend(local_latencies)
+                errors[0] += local_errors
+
+        with ThreadPoolExecutor(options['concurrency']) as executor:
+            for _ in range(options['concurrency']):
+                executor.submit(worker)
+        return len(latencies), latencies, errors[0], time.perf_counter() - started
@@ -0,0 +1,42 @@
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import models
+from django.utils.text import slugify
+
+from store.models import Category, Product
+
+
+class Command(BaseCommand):
+    help = 'Measure product inserts per second with the old two-write slug and with id reservation'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--objects', type=int, default=2000, help='Products to insert per method')
+
+    def handle(self, *args, **options):
+        count = options['objects']
+        category = Category.objects.create(name='Slug benchmark', description='Benchmark category')
+        try:
+            self.report('INSERT then UPDATE slug', count, lambda: self.insert_then_update(category, count))
+            self.report('save() with reserved id', count, lambda: [
+                Product.objects.create(name=f'Benchmark {i}', category=category, price=1) for i in range(count)
+            ])
+            self.report('bulk_create with reserved ids', count, lambda: Product.objects.bulk_create(
+                [Product(name=f'Benchmark {i}', category=category, price=1) for i in range(count)], batch_size=500
+            ))
+        finally:
+            category.delete()
+
+    def insert_then_update(self, category, count):
+        for i in range(count):
+            product = Product(name=f'Benchmark {i}', category=category, price=1, slug=uuid.uuid4().hex)
+            # Plain Model.save lets the database assign the id, the slug needs a second write
+            models.Model.save(product)
+            Product.objects.filter(pk=product.pk).update(slug=f'{product.pk}-{slugify(product.name)}')
+
+    def report(self, label, count, func):
+        started = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f'{label}: {count / elapsed:.0f} inserts/s')
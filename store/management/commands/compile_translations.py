@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from store.labels import compile_catalogs
+
+
+class Command(BaseCommand):
+    help = 'Compile the .po files of LOCALE_PATHS that changed into .mo files, run on deploy'
+
+    def handle(self, *args, **options):
+        # compilemessages does the same but needs GNU gettext installed
+        try:
+            compiled = compile_catalogs()
+        except OSError as e:
+            raise CommandError(f'Could not write the compiled catalogs: {e}')
+        for path in compiled:
+            self.stdout.write(f'Compiled {path}')
+        self.stdout.write(self.style.SUCCESS(f'Compiled {len(compiled)} catalogs'))
@@ -0,0 +1,65 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import RequestFactory
+from django.utils import timezone, translation
+
+from store.models import Category
+from store.pagination import KeysetPaginator
+from store.views import ProductListView
+
+# Plan fragments that mean every row is read or sorted
+FULL_SCAN_MARKERS = (
+    'USE TEMP B-TREE FOR ORDER BY',  # SQLite sorting the whole result
+    'Seq Scan',  # PostgreSQL
+    'Sort Key',  # PostgreSQL
+)
+
+
+def is_full_scan(plan):
+    for line in plan.splitlines():
+        if any(marker in line for marker in FULL_SCAN_MARKERS):
+            return True
+        # SQLite: "SCAN store_product" without an index walks the table
+        if 'SCAN ' in line and 'USING' not in line:
+            return True
+    return False
+
+
+class Command(BaseCommand):
+    help = 'EXPLAIN every shop listing sort/filter combination and fail on full scans'
+
+    def handle(self, *args, **options):
+        category = Category.objects.exclude(slug=None).first()
+        slugs = [None, category.slug if category else 'missing-category']
+        factory = RequestFactory()
+        failures = []
+
+        for language, _ in settings.LANGUAGES:
+            with translation.override(language):
+                for slug in slugs:
+                    for sort in ProductListView.sort_keys:
+                        view = ProductListView()
+                        view.setup(factory.get('/', {'sort': sort}), slug=slug)
+                        for mode, queryset in self.get_queries(view):
+                            plan = queryset.explain()
+                            label = f"{language} {slug or 'all'} {sort} {mode}"
+                            if is_full_scan(plan):
+                                failures.append(label)
+                                self.stdout.write(self.style.ERROR(f'FULL SCAN {label}\n{plan}'))
+                            else:
+                                self.stdout.write(f"ok {label}: {' | '.join(plan.splitlines())}")
+
+        if failures:
+            raise CommandError(f'{len(failures)} listing queries fall back to a full scan')
+        self.stdout.write(self.style.SUCCESS('All listing queries use an index'))
+
+    def get_queries(self, view):
+        queryset = view.get_queryset()
+        yield 'offset', queryset[view.paginate_by * 10:view.paginate_by * 11]
+
+        paginator = KeysetPaginator(queryset, view.paginate_by, view.get_sort_field())
+        value = paginator.field.to_python(timezone.now() if paginator.field_name == 'created_at' else '1')
+        yield 'keyset-next', queryset.filter(paginator.after(value, 1)).order_by(*paginator.order_by())[:10]
+        yield 'keyset-previous', queryset.filter(paginator.before(value, 1)).order_by(
+            *paginator.order_by(reverse=True)
+        )[:10]
@@ -0,0 +1,197 @@
+import csv
+import itertools
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime
+
+import django
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+from django.db.models import Max, Min
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Exported tables and their columns, foreign keys are exported as ids
+DATASETS = {
+    'cart': ('order.Cart', ['id', 'user_id', 'session_id', 'created_at', 'updated_at']),
+    'cartitem': ('order.CartItem', ['id', 'cart_id', 'product_id', 'quantity', 'created_at']),
+    'product': ('store.Product', [
+        'id', 'name_en', 'name_ka', 'category_id', 'price', 'stock', 'created_at', 'updated_at'
+    ]),
+    'user': ('users.CustomUser', ['id', 'last_active_datetime']),
+}
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+def encode_value(value):
+    # Full precision ISO 8601 in both formats, DjangoJSONEncoder would cut to milliseconds
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def iter_rows(dataset, start=None, end=None, chunk_size=2000):
+    """Rows of one dataset as tuples, streamed from the database chunk_size rows at a time"""
+    label, fields = DATASETS[dataset]
+    queryset = apps.get_model(label)._base_manager.order_by('pk')
+    if start is not None:
+        queryset = queryset.filter(pk__gte=start, pk__lt=end)
+    return queryset.values_list(*fields).iterator(chunk_size=chunk_size)
+
+
+def iter_lines(dataset, rows, file_format, chunk_size, header=True):
+    """Encode rows in batches of chunk_size, yielding one string per batch"""
+    fields = DATASETS[dataset][1]
+    encoder = DjangoJSONEncoder(ensure_ascii=False)
+    if file_format == 'csv':
+        buffer = _LineBuffer()
+        writer = csv.writer(buffer)
+        if header:
+            writer.writerow(fields)
+            yield buffer.pop()
+        for batch in batched(rows, chunk_size):
+            writer.writerows([[encode_value(value) for value in row] for row in batch])
+            yield buffer.pop()
+    else:
+        for batch in batched(rows, chunk_size):
+            yield ''.join(
+                encoder.encode({field: encode_value(value) for field, value in zip(fields, row)}) + '\n'
+                for row in batch
+            )
+
+
+class _LineBuffer:
+    """File-like target for csv.writer that hands back what was written"""
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, value):
+        self.parts.append(value)
+
+    def pop(self):
+        value = ''.join(self.parts)
+        self.parts = []
+        return value
+
+
+def export(dataset, path, file_format, chunk_size, start=None, end=None, header=True):
+    """Write one dataset (or one pk range of it) to path, returns the number of rows"""
+    count = 0
+
+    def counted(rows):
+        nonlocal count
+        for row in rows:
+            count += 1
+            yield row
+
+    rows = counted(iter_rows(dataset, start, end, chunk_size))
+    with open(path, 'w', encoding='utf-8', newline='') as output:
+        for chunk in iter_lines(dataset, rows, file_format, chunk_size, header):
+            output.write(chunk)
+    return count
+
+
+def _export_range(args):
+    # Runs in a worker process, each one opens its own database connection
+    count = export(*args)
+    connections.close_all()
+    return count
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process and of its finished workers"""
+    if resource is None:
+        return None, None
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return own, children
+
+
+class Command(BaseCommand):
+    help = 'Stream carts, cart items, products and user activity to NDJSON or CSV files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('datasets', nargs='*', help=f"Datasets to export ({', '.join(DATASETS)}), all by default")
+        parser.add_argument('--format', dest='file_format', choices=['ndjson', 'csv'], default='ndjson')
+        parser.add_argument('--output-dir', default='export', help='Directory for the exported files')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Rows fetched and encoded per batch')
+        parser.add_argument(
+            '--workers', type=int, default=1, help='Processes that export primary key ranges in parallel'
+        )
+
+    def handle(self, *args, **options):
+        unknown = set(options['datasets']) - set(DATASETS)
+        if unknown:
+            raise CommandError(f"Unknown datasets: {', '.join(sorted(unknown))}")
+        if options['workers'] < 1 or options['chunk_size'] < 1:
+            raise CommandError('--workers and --chunk-size must be positive')
+
+        os.makedirs(options['output_dir'], exist_ok=True)
+        started = time.perf_counter()
+        total = 0
+        for dataset in options['datasets'] or DATASETS:
+            path = os.path.join(options['output_dir'], f"{dataset}.{options['file_format']}")
+            dataset_started = time.perf_counter()
+            if options['workers'] > 1:
+                count = self.export_parallel(dataset, path, options)
+            else:
+                count = export(dataset, path, options['file_format'], options['chunk_size'])
+            elapsed = time.perf_counter() - dataset_started
+            total += count
+            self.stdout.write(
+                f'{path}: {count} rows in {elapsed:.1f}s ({count / elapsed if elapsed else 0:.0f} rows/s)'
+            )
+
+        elapsed = time.perf_counter() - started
+        own, children = peak_rss_mb()
+        memory = 'n/a' if own is None else f'{own:.0f} MB'
+        if children:
+            memory += f', workers {children:.0f} MB'
+        self.stdout.write(self.style.SUCCESS(
+            f'Exported {total} rows in {elapsed:.1f}s ({total / elapsed if elapsed else 0:.0f} rows/s), '
+            f'peak RSS {memory}'
+        ))
+
+    def export_parallel(self, dataset, path, options):
+        """Split the table into primary key ranges, export them in worker processes and join the parts"""
+        workers = options['workers']
+        model = apps.get_model(DATASETS[dataset][0])
+        bounds = model._base_manager.aggregate(first=Min('pk'), last=Max('pk'))
+        if bounds['first'] is None:
+            return export(dataset, path, options['file_format'], options['chunk_size'])
+
+        step = (bounds['last'] - bounds['first']) // workers + 1
+        ranges = [
+            (bounds['first'] + index * step, bounds['first'] + (index + 1) * step)
+            for index in range(workers)
+        ]
+        parts = [f'{path}.part{index}' for index in range(workers)]
+        tasks = [
+            (dataset, part, options['file_format'], options['chunk_size'], start, end, index == 0)
+            for index, (part, (start, end)) in enumerate(zip(parts, ranges))
+        ]
+
+        # Connections must not be shared with forked workers
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=workers, initializer=django.setup) as executor:
+            count = sum(executor.map(_export_range, tasks))
+
+        with open(path, 'wb') as output:
+            for part in parts:
+                with open(part, 'rb') as source:
+                    shutil.copyfileobj(source, output)
+                os.remove(part)
+        return count
@@ -1,12 +1,12 @@
 from django.core.management.base import BaseCommand
-from django.db.models import Count
 from django.utils.translation import gettext_lazy as _
-from order.models import CartItem, Cart
+from order.models import Cart
 from store.models import Product
+from store.popularity import ALL_TIME, PERIODS, get_bucket_start, top_products
 
 
 class Command(BaseCommand):
-    help = 'Find the three most popular products in users\' carts'
+    help = 'Find the most popular products in users\' carts'
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -14,43 +14,52 @@ class Command(BaseCommand):
             action='store_true',
             help=_('Show the number of carts for each product')
         )
+        parser.add_argument(
+            '--period',
+            choices=[ALL_TIME, *PERIODS],
+            default=ALL_TIME,
+            help=_(
+                'Only count carts that added the product in the current calendar hour, day or week (UTC), '
+                'not a sliding window'
+            )
+        )
+        parser.add_argument('--limit', type=int, default=3, help=_('Number of products to show'))
 
     def handle(self, *args, **options):
         self.stdout.write(self.style.SUCCESS(_('Finding most popular products...')))
 
-        # Get all products in carts with their cart count
-        popular_products = Product.objects.filter(
-            cartitem__cart__isnull=False  # Only include products that are in carts
-        ).annotate(
-            cart_count=Count('cartitem__cart', distinct=True)  # Count unique carts
-        ).order_by(
-            '-cart_count'  # Order by number of carts, descending
-        )[:3]  # Get top 3
+        # Read from the maintained popularity counters instead of counting cart items
+        popular_products = top_products(options['period'], options['limit'])
 
         if not popular_products:
             self.stdout.write(self.style.WARNING(_('No products found in any carts.')))
             return
 
         # Print results
-        self.stdout.write(self.style.SUCCESS('\n' + _('Top 3 most popular products:') + '\n'))
+        self.stdout.write(self.style.SUCCESS(
+            '\n' + _('Top %(limit)s most popular products:') % {'limit': len(popular_products)} + '\n'
+        ))
+        if options['period'] != ALL_TIME:
+            self.stdout.write(_(
+                'Counted since %(start)s UTC, the start of the current calendar %(period)s'
+            ) % {'start': get_bucket_start(options['period']).strftime('%Y-%m-%d %H:%M'), 'period': options['period']})
 
-        for index, product in enumerate(popular_products, 1):
+        for index, popularity in enumerate(popular_products, 1):
+            product = popularity.product
             # Get basic product info
             product_info = f"{index}. {product.name}"
 
             # Add cart count if requested
             if options['show_count']:
-                cart_count = product.cart_count
+                cart_count = popularity.carts
                 cart_text = _('cart') if cart_count == 1 else _('carts')
                 product_info += f" ({cart_count} {cart_text})"
 
             # Add price
             product_info += f" - {product.price} USD"
 
-            # Get categories
-            categories = ", ".join([cat.name for cat in product.category.all()])
-            if categories:
-                product_info += f" [{categories}]"
+            # Add category
+            product_info += f" [{product.category.name}]"
 
             # Style and print the line
             if index == 1:
@@ -0,0 +1,64 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.utils import timezone
+
+from store.cache import bump_version
+from store.images import generate_variants
+from store.models import Product
+
+
+def _generate(name):
+    try:
+        return name, generate_variants(name), None
+    except Exception as e:
+        return name, None, str(e)
+
+
+class Command(BaseCommand):
+    help = 'Create the resized and WebP variants of existing product images in parallel'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Worker processes')
+        parser.add_argument('--all', action='store_true', help='Also check images that already have variants')
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1:
+            raise CommandError('--workers must be positive')
+
+        products = Product.objects.exclude(image='')
+        if not options['all']:
+            products = products.filter(image_hash='')
+        names = sorted(set(products.values_list('image', flat=True)))
+        if not names:
+            self.stdout.write('No images to process')
+            return
+
+        started = time.perf_counter()
+        hashes = {}
+        # Connections must not be shared with forked workers
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=options['workers'], initializer=django.setup) as executor:
+            for name, image_hash, error in executor.map(_generate, names, chunksize=8):
+                if error is None:
+                    hashes[name] = image_hash
+                else:
+                    self.stderr.write(f'{name}: {error}')
+        elapsed = time.perf_counter() - started
+
+        with transaction.atomic():
+            for name, image_hash in hashes.items():
+                Product.objects.filter(image=name).exclude(image_hash=image_hash).update(
+                    image_hash=image_hash, updated_at=timezone.now()
+                )
+        # Cached listings and related products hold the old instances
+        bump_version('catalog')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Processed {len(hashes)} of {len(names)} images in {elapsed:.1f}s '
+            f'({len(names) / elapsed if elapsed else 0:.1f} images/s)'
+        ))
@@ -1,96 +1,169 @@
-from django.core.management.base import BaseCommand
-from store.models import Category, Product
-from django.db import transaction
+import itertools
 import random
+import time
+import uuid
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max
+
+from order.models import Cart, CartItem
+from store.cache import bump_version
+from store.models import Category, Product, ProductFacet, ProductPopularity, Sequence
+from store.search import is_supported
+
+User = get_user_model()
+
+USERNAME_PREFIX = 'loadtest_'
+
+WORDS_EN = [
+    'fresh', 'organic', 'sweet', 'green', 'red', 'golden', 'wild', 'juicy', 'crisp', 'ripe',
+    'apple', 'pear', 'plum', 'grape', 'cherry', 'melon', 'tomato', 'pepper', 'carrot', 'onion',
+]
+WORDS_KA = [
+    'ახალი', 'ორგანული', 'ტკბილი', 'მწვანე', 'წითელი', 'ოქროსფერი', 'ველური', 'წვნიანი', 'ხრაშუნა', 'მწიფე',
+    'ვაშლი', 'მსხალი', 'ქლიავი', 'ყურძენი', 'ალუბალი', 'ნესვი', 'პომიდორი', 'წიწაკა', 'სტაფილო', 'ხახვი',
+]
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+def next_id(model):
+    return (model.objects.aggregate(last=Max('pk'))['last'] or 0) + 1
 
 
 class Command(BaseCommand):
-    help = 'Populate the database with sample data'
+    help = 'Populate the database with generated data for load testing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--categories', type=int, default=20)
+        parser.add_argument('--products', type=int, default=10_000)
+        parser.add_argument('--users', type=int, default=1_000)
+        parser.add_argument('--carts', type=int, default=2_000, help='Carts to create, half of them anonymous')
+        parser.add_argument('--items-per-cart', type=int, default=5)
+        parser.add_argument('--batch-size', type=int, default=5_000, help='Rows per INSERT')
+        parser.add_argument('--seed', type=int, default=0, help='Seed for reproducible data')
+        parser.add_argument(
+            '--clear', action='store_true',
+            help='Delete the catalog, all carts and previously generated users first'
+        )
 
     @transaction.atomic
-    def handle(self, *args, **kwargs):
-        # Clear existing data
+    def handle(self, *args, **options):
+        self.random = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+
+        if options['clear']:
+            self.clear()
+
+        started = time.perf_counter()
+        total = 0
+        categories = self.insert(Category, self.generate_categories(options['categories']))
+        total += categories
+        product_ids = Sequence.objects.reserve(Product, options['products'])
+        total += self.insert(Product, self.generate_products(product_ids, options['categories']))
+        user_ids = self.reserve_ids(User, options['users'])
+        total += self.insert(User, self.generate_users(user_ids))
+        cart_ids = self.reserve_ids(Cart, options['carts'])
+        total += self.insert(Cart, self.generate_carts(cart_ids, user_ids))
+        total += self.insert(CartItem, self.generate_cart_items(cart_ids, product_ids, options['items_per_cart']))
+
+        # Explicit primary keys bypass the sequences on databases that have them
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [User, Cart]):
+                cursor.execute(sql)
+
+        # bulk_create skips the signals that keep counters and listing caches up to date
+        call_command('recount_categories', stdout=self.stdout)
+        call_command('recount_popularity', stdout=self.stdout)
+        call_command('recount_facets', stdout=self.stdout)
+        if is_supported():
+            call_command('rebuild_search_index', stdout=self.stdout)
+        bump_version('all')
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Successfully populated the database: {total} rows in {elapsed:.1f}s ({total / elapsed:.0f} rows/s)'
+        ))
+
+    def clear(self):
         self.stdout.write('Deleting old data...')
-        Category.objects.all().delete()
-        Product.objects.all().delete()
-
-        # Create categories
-        # self.stdout.write('Creating categories...')
-        # categories = [
-        #     Category.objects.create(name="Electronics"),
-        #     Category.objects.create(name="Books"),
-        #     Category.objects.create(name="Clothing"),
-        #     Category.objects.create(name="Home & Kitchen"),
-        #     Category.objects.create(name="Sports & Outdoors"),
-        # ]
-        #
-        # # Create subcategories
-        # electronics_subs = [
-        #     Category.objects.create(name="Smartphones", parent=categories[0]),
-        #     Category.objects.create(name="Laptops", parent=categories[0]),
-        #     Category.objects.create(name="Accessories", parent=categories[0]),
-        # ]
-        #
-        # books_subs = [
-        #     Category.objects.create(name="Fiction", parent=categories[1]),
-        #     Category.objects.create(name="Non-Fiction", parent=categories[1]),
-        # ]
-        #
-        # # Create products
-        # self.stdout.write('Creating products...')
-        # products = [
-        #     # Electronics
-        #     Product.objects.create(name="iPhone 13", description="Latest iPhone model", price=999.99, quantity=50),
-        #     Product.objects.create(name="Samsung Galaxy S21", description="Flagship Android phone", price=899.99,
-        #                            quantity=40),
-        #     Product.objects.create(name="MacBook Pro", description="Powerful laptop for professionals", price=1999.99,
-        #                            quantity=25),
-        #     Product.objects.create(name="Dell XPS 15", description="High-performance Windows laptop", price=1799.99,
-        #                            quantity=30),
-        #     Product.objects.create(name="AirPods Pro", description="Noise-cancelling earbuds", price=249.99,
-        #                            quantity=100),
-        #
-        #     # Books
-        #     Product.objects.create(name="The Great Gatsby", description="Classic novel by F. Scott Fitzgerald",
-        #                            price=15.99, quantity=200),
-        #     Product.objects.create(name="To Kill a Mockingbird", description="Harper Lee's masterpiece", price=14.99,
-        #                            quantity=150),
-        #     Product.objects.create(name="A Brief History of Time", description="Stephen Hawking's cosmology book",
-        #                            price=18.99, quantity=75),
-        #
-        #     # Clothing
-        #     Product.objects.create(name="Denim Jeans", description="Classic blue jeans", price=49.99, quantity=300),
-        #     Product.objects.create(name="Cotton T-Shirt", description="Comfortable everyday tee", price=19.99,
-        #                            quantity=500),
-        #
-        #     # Home & Kitchen
-        #     Product.objects.create(name="Coffee Maker", description="Programmable drip coffee maker", price=79.99,
-        #                            quantity=60),
-        #     Product.objects.create(name="Microwave Oven", description="Countertop microwave", price=129.99,
-        #                            quantity=40),
-        #
-        #     # Sports & Outdoors
-        #     Product.objects.create(name="Yoga Mat", description="Non-slip exercise mat", price=29.99, quantity=150),
-        #     Product.objects.create(name="Dumbbells Set", description="Adjustable weight set", price=199.99,
-        #                            quantity=30),
-        # ]
-        #
-        # # Assign categories to products
-        # for product in products[:5]:
-        #     product.categories.add(categories[0])
-        #     product.categories.add(random.choice(electronics_subs))
-        #
-        # for product in products[5:8]:
-        #     product.categories.add(categories[1])
-        #     product.categories.add(random.choice(books_subs))
-        #
-        # for product in products[8:10]:
-        #     product.categories.add(categories[2])
-        #
-        # for product in products[10:12]:
-        #     product.categories.add(categories[3])
-        #
-        # for product in products[12:]:
-        #     product.categories.add(categories[4])
-        #
-        # self.stdout.write(self.style.SUCCESS('Successfully populated the database!'))
\ No newline at end of file
+        # Plain DELETEs, the ORM would load every row to run the cascades and signals
+        with connection.cursor() as cursor:
+            for model in (ProductFacet, ProductPopularity, CartItem, Cart, Product, Category):
+                cursor.execute(f'DELETE FROM {connection.ops.quote_name(model._meta.db_table)}')
+        User.objects.filter(username__startswith=USERNAME_PREFIX).delete()
+
+    def reserve_ids(self, model, count):
+        # Explicit primary keys let foreign keys be set before the INSERT
+        first = next_id(model)
+        return range(first, first + count)
+
+    def insert(self, model, objects):
+        self.stdout.write(f'Creating {model._meta.verbose_name_plural}...')
+        started = time.perf_counter()
+        count = 0
+        for batch in batched(objects, self.batch_size):
+            model.objects.bulk_create(batch)
+            count += len(batch)
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f'  {count} rows in {elapsed:.1f}s ({count / elapsed if elapsed else 0:.0f} rows/s)')
+        return count
+
+    def words(self, count):
+        indexes = [self.random.randrange(len(WORDS_EN)) for _ in range(count)]
+        return ' '.join(WORDS_EN[i] for i in indexes), ' '.join(WORDS_KA[i] for i in indexes)
+
+    def generate_categories(self, count):
+        # Ids and slugs are allocated by Category.objects.bulk_create
+        for _ in range(count):
+            name_en, name_ka = self.words(2)
+            yield Category(
+                name=name_en, name_en=name_en.title(), name_ka=name_ka, description=f'{name_en} products'
+            )
+
+    def generate_products(self, product_ids, category_count):
+        category_ids = list(Category.objects.order_by('-pk').values_list('pk', flat=True)[:category_count])
+        for product_id in product_ids:
+            name_en, name_ka = self.words(3)
+            description_en, description_ka = self.words(12)
+            yield Product(
+                id=product_id,
+                name=name_en, name_en=name_en.capitalize(), name_ka=name_ka,
+                description=description_en, description_en=description_en, description_ka=description_ka,
+                category_id=self.random.choice(category_ids),
+                price=Decimal(self.random.randrange(50, 50_000)) / 100,
+                stock=self.random.choice([0, self.random.randrange(1, 500)]),
+            )
+
+    def generate_users(self, user_ids):
+        # Hashing is slow on purpose, every generated user shares one password
+        password = make_password('loadtest-password')
+        for user_id in user_ids:
+            yield User(
+                id=user_id, username=f'{USERNAME_PREFIX}{user_id}', email=f'{USERNAME_PREFIX}{user_id}@example.com',
+                password=password
+            )
+
+    def generate_carts(self, cart_ids, user_ids):
+        users = iter(user_ids)
+        for cart_id in cart_ids:
+            user_id = next(users, None) if self.random.random() < 0.5 else None
+            if user_id is not None:
+                yield Cart(id=cart_id, user_id=user_id)
+            else:
+                yield Cart(id=cart_id, session_id=str(uuid.UUID(int=self.random.getrandbits(128))))
+
+    def generate_cart_items(self, cart_ids, product_ids, items_per_cart):
+        for cart_id in cart_ids:
+            for product_id in self.random.sample(product_ids, min(items_per_cart, len(product_ids))):
+                yield CartItem(cart_id=cart_id, product_id=product_id, quantity=self.random.randrange(1, 5))
@@ -0,0 +1,17 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from store.search import is_supported, rebuild_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text product search index'
+
+    def handle(self, *args, **options):
+        if not is_supported():
+            raise CommandError('Product search needs SQLite with FTS5')
+        started = time.perf_counter()
+        indexed = rebuild_index()
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(f'Indexed {indexed} products in {elapsed:.1f}s'))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from store.cache import bump_version
+from store.models import Category, Product
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the stored product_count of every category'
+
+    def handle(self, *args, **options):
+        counts = Product.objects.filter(category=OuterRef('pk')).order_by().values('category').annotate(
+            count=Count('pk')
+        ).values('count')
+        # One UPDATE for the whole table
+        updated = Category.objects.update(product_count=Coalesce(Subquery(counts), 0))
+        bump_version('catalog')
+        self.stdout.write(self.style.SUCCESS(f'Recounted products for {updated} categories'))
@@ -0,0 +1,45 @@
+from datetime import datetime, timezone
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+
+from order.models import CartItem
+from store.models import ProductPopularity
+from store.popularity import ALL_TIME, PERIODS, get_bucket, prune_buckets
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the product popularity counters from the cart items'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--prune', action='store_true', help='Only delete the counters of buckets that have ended'
+        )
+
+    def handle(self, *args, **options):
+        if options['prune']:
+            deleted = prune_buckets()
+            self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} expired popularity counters'))
+            return
+
+        with transaction.atomic():
+            ProductPopularity.objects.all().delete()
+            rows = self.count(ALL_TIME, CartItem.objects.all())
+            for period, seconds in PERIODS.items():
+                # Only the current bucket of each period, earlier ones are never read
+                started = datetime.fromtimestamp(get_bucket(period) * seconds, tz=timezone.utc)
+                rows += self.count(period, CartItem.objects.filter(created_at__gte=started))
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {rows} popularity counters'))
+
+    def count(self, period, items):
+        # (cart, product) is unique, so counting items counts distinct carts
+        counts = items.order_by().values('product').annotate(carts=Count('pk')).values_list('product', 'carts')
+        return len(ProductPopularity.objects.bulk_create(
+            [
+                ProductPopularity(product_id=product_id, period=period, bucket=get_bucket(period), carts=carts)
+                for product_id, carts in counts.iterator()
+            ],
+            batch_size=5000,
+        ))
+
@@ -0,0 +1,20 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from store.models import Category
+from store.related import warm_related_products
+
+
+class Command(BaseCommand):
+    help = 'Fill the related-products cache for every category'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Categories loaded per in_bulk query')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        category_ids = list(Category.objects.order_by('pk').values_list('pk', flat=True))
+        warmed = warm_related_products(category_ids, options['batch_size'])
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(f'Cached related products for {warmed} categories in {elapsed:.2f}s'))
@@ -1,38 +1,260 @@
-from django.db import models
+import threading
+
+from django.conf import settings
+from django.db import IntegrityError, connections, models, router, transaction
+from django.db.models import F, Max
 from django.utils.text import slugify
 
 
-class Category(models.Model):
+class SequenceManager(models.Manager):
+    def reserve(self, model, count):
+        """Reserve count consecutive primary keys for model, returns them as a range"""
+        name = model._meta.label_lower
+        connection = connections[self.db]
+        if connection.vendor in ('postgresql', 'sqlite') and connection.features.can_return_columns_from_insert:
+            # One statement instead of a savepoint, the UPDATE and a SELECT, which
+            # matters inside transactions where every insert reserves its own id
+            table = connection.ops.quote_name(self.model._meta.db_table)
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'UPDATE {table} SET last_value = last_value + %s WHERE name = %s RETURNING last_value',
+                    [count, name]
+                )
+                row = cursor.fetchone()
+            if row is not None:
+                return range(row[0] - count + 1, row[0] + 1)
+        with transaction.atomic(using=self.db):
+            # UPDATE first so the row is locked before its new value is read
+            if not self.filter(name=name).update(last_value=F('last_value') + count):
+                last = model._base_manager.using(self.db).aggregate(last=Max('pk'))['last'] or 0
+                try:
+                    with transaction.atomic(using=self.db):
+                        self.create(name=name, last_value=last + count)
+                except IntegrityError:
+                    # Another process created the row first
+                    self.filter(name=name).update(last_value=F('last_value') + count)
+            last_value = self.filter(name=name).values_list('last_value', flat=True).get()
+        return range(last_value - count + 1, last_value + 1)
+
+    def advance(self, model, value):
+        """Move the sequence of model up to value, for ids inserted without reserve()"""
+        self.filter(name=model._meta.label_lower, last_value__lt=value).update(last_value=value)
+
+    def resync(self, model):
+        """Move the sequence of model past every stored id (loaddata, raw inserts)"""
+        last = model._base_manager.using(self.db).aggregate(last=Max('pk'))['last']
+        if last is not None:
+            self.advance(model, last)
+
+
+class Sequence(models.Model):
+    """
+    Hands out primary keys before the INSERT, so slugs that contain the id can
+    be written with the row itself (also by bulk_create) instead of a second save.
+    """
+    name = models.CharField(max_length=100, primary_key=True)
+    last_value = models.BigIntegerField(default=0)
+
+    objects = SequenceManager()
+
+    def __str__(self):
+        return f'{self.name}: {self.last_value}'
+
+
+_id_blocks = {}
+_id_blocks_lock = threading.Lock()
+
+
+def allocate_id(model):
+    """Next primary key for model, from a per-process block when running in autocommit"""
+    using = router.db_for_write(model)
+    if connections[using].in_atomic_block:
+        # A block reserved here would be handed out again if the transaction rolls back
+        return Sequence.objects.db_manager(using).reserve(model, 1)[0]
+
+    with _id_blocks_lock:
+        key = (using, model._meta.label_lower)
+        block = _id_blocks.get(key)
+        if not block:
+            block = _id_blocks[key] = list(
+                Sequence.objects.db_manager(using).reserve(model, getattr(settings, 'ID_BLOCK_SIZE', 20))
+            )[::-1]
+        return block.pop()
+
+
+def discard_id_block(using, model):
+    with _id_blocks_lock:
+        _id_blocks.pop((using, model._meta.label_lower), None)
+
+
+class IdSlugQuerySet(models.QuerySet):
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        sequences = Sequence.objects.db_manager(self.db)
+        # Given ids must not be handed out again
+        given = [obj.pk for obj in objs if obj.pk is not None]
+        if given:
+            sequences.advance(self.model, max(given))
+        # Give every new object its id up front so IdSlugField can build the slug
+        new_objs = [obj for obj in objs if obj.pk is None]
+        if new_objs:
+            for obj, pk in zip(new_objs, sequences.reserve(self.model, len(new_objs))):
+                obj.pk = pk
+        return super().bulk_create(objs, *args, **kwargs)
+
+
+class IdSlugField(models.SlugField):
+    """Slug combining the id and the name, filled in on save() and bulk_create()"""
+
+    def pre_save(self, model_instance, add):
+        slug = getattr(model_instance, self.attname)
+        if not slug and model_instance.pk is not None:
+            slug = f"{model_instance.pk}-{slugify(model_instance.name)}"
+            setattr(model_instance, self.attname, slug)
+        return slug
+
+
+class IdSlugModel(models.Model):
+    objects = IdSlugQuerySet.as_manager()
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        if self.pk is not None:
+            if self._state.adding:
+                Sequence.objects.db_manager(router.db_for_write(type(self))).advance(type(self), self.pk)
+            return super().save(*args, **kwargs)
+
+        model = type(self)
+        using = router.db_for_write(model)
+        self.pk = allocate_id(model)
+        kwargs.setdefault('force_insert', True)
+        if connections[using].in_atomic_block:
+            # A failed INSERT breaks the transaction, there is nothing to retry
+            return super().save(*args, **kwargs)
+        slugs = {
+            field.attname: getattr(self, field.attname)
+            for field in self._meta.concrete_fields if isinstance(field, IdSlugField)
+        }
+        try:
+            super().save(*args, **kwargs)
+        except IntegrityError:
+            # The sequence fell behind ids inserted without it, catch up and retry once
+            if not model._base_manager.using(using).filter(pk=self.pk).exists():
+                raise
+            Sequence.objects.db_manager(using).resync(model)
+            discard_id_block(using, model)
+            self.pk = allocate_id(model)
+            # Built from the id that was taken
+            for attname, slug in slugs.items():
+                setattr(self, attname, slug)
+            super().save(*args, **kwargs)
+
+
+class Category(IdSlugModel):
     name = models.CharField(max_length=255)
     description = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
-    slug = models.SlugField(blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    slug = IdSlugField(unique=True, blank=True)
+    # Maintained by store.signals, rebuilt by the recount_categories command
+    product_count = models.PositiveIntegerField(default=0, editable=False)
+
+    class Meta:
+        verbose_name_plural = 'categories'
 
     def save(self, *args, **kwargs):
-        # Generate slug combining ID and name
-        if not self.slug and self.id is not None:
-            self.slug = f"{self.id}-{slugify(self.name)}"
+        if not self._state.adding and not kwargs.get('update_fields'):
+            # product_count is only changed with F() updates, never written back from a stale instance
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != 'product_count'
+            ]
         super().save(*args, **kwargs)
 
     def __str__(self):
         return self.name
 
 
-class Product(models.Model):
+class Product(IdSlugModel):
     name = models.CharField(max_length=100)
     description = models.TextField(blank=True)
-    category = models.ForeignKey(Category, related_name='products', on_delete=models.CASCADE, blank=False)
+    # Indexed through the (category, ...) composite indexes below
+    category = models.ForeignKey(
+        Category, related_name='products', on_delete=models.CASCADE, blank=False, db_index=False
+    )
     price = models.DecimalField(max_digits=10, decimal_places=2, blank=False)
     stock = models.PositiveIntegerField(default=0, blank=False)
     image = models.ImageField(upload_to='products/', blank=True)
+    # Content hash naming the resized variants of the image, set by store.images
+    # once they exist, empty until then
+    image_hash = models.CharField(max_length=40, blank=True, editable=False)
     updated_at = models.DateTimeField(auto_now=True)
     created_at = models.DateTimeField(auto_now_add=True)
-    slug = models.SlugField(unique=True, blank=True)
+    slug = IdSlugField(unique=True, blank=True)
 
-    def save(self, *args, **kwargs):
-        if not self.slug and self.id is not None:
-            self.slug = f"{self.id}-{slugify(self.name)}"
-        super().save(*args, **kwargs)
+    class Meta:
+        # One index per shop sort order, unfiltered and within a category, with
+        # the id as tiebreaker for keyset pagination. Checked by explain_catalog.
+        indexes = [
+            models.Index(fields=['price', 'id'], name='product_price_id_idx'),
+            models.Index(fields=['created_at', 'id'], name='product_created_id_idx'),
+            models.Index(fields=['name_en', 'id'], name='product_name_en_id_idx'),
+            models.Index(fields=['name_ka', 'id'], name='product_name_ka_id_idx'),
+            models.Index(fields=['category', 'price', 'id'], name='product_category_price_idx'),
+            models.Index(fields=['category', 'created_at', 'id'], name='product_category_created_idx'),
+            models.Index(fields=['category', 'name_en', 'id'], name='product_category_name_en_idx'),
+            models.Index(fields=['category', 'name_ka', 'id'], name='product_category_name_ka_idx'),
+        ]
 
     def __str__(self):
         return self.name
+
+
+class ProductPopularity(models.Model):
+    """
+    Number of distinct carts holding a product, overall (period 'all', bucket 0)
+    and for the carts that added it in the current hour, day or week. Kept up to
+    date by store.popularity, rebuilt by the recount_popularity command.
+    """
+    PERIOD_CHOICES = [('all', 'All time'), ('hour', 'Hour'), ('day', 'Day'), ('week', 'Week')]
+
+    product = models.ForeignKey(Product, related_name='popularity', on_delete=models.CASCADE, db_index=False)
+    period = models.CharField(max_length=10, choices=PERIOD_CHOICES)
+    # Unix time divided by the period length, 0 for 'all'
+    bucket = models.PositiveIntegerField(default=0)
+    carts = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'period', 'bucket'], name='popularity_unique_bucket')
+        ]
+        indexes = [
+            # Top-K for a bucket is a backward scan over its first K entries
+            models.Index(fields=['period', 'bucket', 'carts'], name='popularity_top_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.product_id} {self.period}:{self.bucket} = {self.carts}'
+
+
+class ProductFacet(models.Model):
+    """
+    Number of products per (category, price bucket, in stock) cell. Every facet
+    count of the shop sidebar is a sum over these cells. Kept up to date by
+    store.signals, rebuilt by the recount_facets command.
+    """
+    category = models.ForeignKey(Category, related_name='facets', on_delete=models.CASCADE, db_index=False)
+    # Index into store.facets.PRICE_BUCKETS
+    price_bucket = models.PositiveSmallIntegerField()
+    in_stock = models.BooleanField()
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['category', 'price_bucket', 'in_stock'], name='facet_unique_cell')
+        ]
+
+    def __str__(self):
+        return f'{self.category_id}/{self.price_bucket}/{self.in_stock} = {self.count}'
@@ -0,0 +1,127 @@
+from django.core import signing
+from django.core.paginator import InvalidPage
+from django.db.models import F, Q
+
+CURSOR_SALT = 'store.pagination.cursor'
+
+
+class InvalidCursor(InvalidPage):
+    pass
+
+
+class KeysetPage:
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class KeysetPaginator:
+    """
+    Seek pagination over one sort field with the primary key as tiebreaker.
+
+    Pages are fetched with WHERE (field, id) > (value, id) ... LIMIT per_page + 1,
+    so the cost of a page does not grow with its depth and no COUNT(*) is needed.
+    Cursors are signed tokens holding the boundary row and the direction.
+    """
+
+    def __init__(self, queryset, per_page, ordering):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.ordering = ordering
+        self.descending = ordering.startswith('-')
+        self.field_name = ordering.lstrip('-')
+        self.field = queryset.model._meta.get_field(self.field_name)
+
+    def encode_cursor(self, obj, direction):
+        value = getattr(obj, self.field.attname)
+        return signing.dumps(
+            [self.ordering, direction, None if value is None else str(value), obj.pk],
+            salt=CURSOR_SALT
+        )
+
+    def decode_cursor(self, cursor):
+        try:
+            ordering, direction, value, pk = signing.loads(cursor, salt=CURSOR_SALT)
+        except (signing.BadSignature, ValueError, TypeError):
+            raise InvalidCursor('Invalid cursor')
+        if ordering != self.ordering or direction not in ('next', 'previous'):
+            raise InvalidCursor('Cursor does not match the current sort')
+        if value is not None:
+            value = self.field.to_python(value)
+        return direction, value, pk
+
+    def order_by(self, reverse=False):
+        # NULLs sort first ascending and last descending, which is SQLite's
+        # native order, so the (field, id) index can serve both directions
+        descending = self.descending != reverse
+        if descending:
+            return [F(self.field_name).desc(nulls_last=True), F('pk').desc()]
+        return [F(self.field_name).asc(nulls_first=True), F('pk').asc()]
+
+    def after(self, value, pk):
+        """Rows that come after (value, pk) in ascending order"""
+        field = self.field_name
+        if value is None:
+            return Q(**{f'{field}__isnull': True, 'pk__gt': pk}) | Q(**{f'{field}__isnull': False})
+        # The redundant >= bound lets the database seek into the (field, id) index
+        return Q(**{f'{field}__gte': value}) & (Q(**{f'{field}__gt': value}) | Q(pk__gt=pk))
+
+    def before(self, value, pk):
+        """Non-NULL rows that come before (value, pk) in ascending order"""
+        field = self.field_name
+        if value is None:
+            return Q(**{f'{field}__isnull': True, 'pk__lt': pk})
+        return Q(**{f'{field}__lte': value}) & (Q(**{f'{field}__lt': value}) | Q(pk__lt=pk))
+
+    def page(self, cursor=None):
+        limit = self.per_page + 1
+        ordering = self.order_by()
+        rows = None
+        backwards = False
+        if cursor:
+            direction, value, pk = self.decode_cursor(cursor)
+            backwards = direction == 'previous'
+            ordering = self.order_by(reverse=backwards)
+            # Moving forward in a descending sort means moving backward in ascending order
+            if backwards == self.descending:
+                rows = list(self.queryset.filter(self.after(value, pk)).order_by(*ordering)[:limit])
+            else:
+                rows = list(self.queryset.filter(self.before(value, pk)).order_by(*ordering)[:limit])
+                # NULLs come first in ascending order, they are fetched separately
+                # once the non-NULL values run out so both queries stay index seeks
+                if len(rows) < limit and value is not None and self.field.null:
+                    nulls = self.queryset.filter(**{f'{self.field_name}__isnull': True}).order_by(*ordering)
+                    rows += list(nulls[:limit - len(rows)])
+        if rows is None:
+            rows = list(self.queryset.order_by(*ordering)[:limit])
+
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if backwards:
+            rows.reverse()
+
+        if not rows:
+            return KeysetPage(rows)
+
+        next_cursor = previous_cursor = None
+        if has_more or backwards:
+            next_cursor = self.encode_cursor(rows[-1], 'next')
+        if cursor and (has_more or not backwards):
+            previous_cursor = self.encode_cursor(rows[0], 'previous')
+        return KeysetPage(rows, next_cursor, previous_cursor)
@@ -0,0 +1,122 @@
+from collections import Counter, defaultdict
+from datetime import datetime, timezone as dt_timezone
+
+from django.core.cache import cache
+from django.db.models import F, Q
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from .models import ProductPopularity
+
+# Popularity is the number of distinct carts holding a product. CartItem has a
+# unique (cart, product) constraint, so every created or deleted item moves one
+# product's counters by exactly one. Besides the all-time counter each item is
+# counted in the hour, day and week bucket it was created in; deleting the item
+# only takes it out of those buckets again, older buckets are left alone.
+# Buckets are calendar periods of Unix time, not sliding windows: an hour
+# starts on the hour, a day at midnight UTC and a week on a Thursday (the
+# weekday of the epoch). Just after a bucket starts its ranking covers minutes.
+ALL_TIME = 'all'
+PERIODS = {
+    'hour': 60 * 60,
+    'day': 60 * 60 * 24,
+    'week': 60 * 60 * 24 * 7,
+}
+POPULAR_TIMEOUT = 60
+# Counter cells per UPDATE, keeps the OR condition within SQLite's expression depth
+REMOVE_BATCH_SIZE = 200
+
+
+def get_bucket(period, when=None):
+    if period == ALL_TIME:
+        return 0
+    when = when or timezone.now()
+    return int(when.timestamp()) // PERIODS[period]
+
+
+def get_bucket_start(period, when=None):
+    """When the current bucket of `period` started, None for all time"""
+    if period == ALL_TIME:
+        return None
+    return datetime.fromtimestamp(get_bucket(period, when) * PERIODS[period], tz=dt_timezone.utc)
+
+
+def get_buckets(when=None):
+    """(period, bucket) pairs an item created at `when` is counted in"""
+    return [(period, get_bucket(period, when)) for period in [ALL_TIME, *PERIODS]]
+
+
+def _bucket_filter(buckets):
+    condition = Q()
+    for period, bucket in buckets:
+        condition |= Q(period=period, bucket=bucket)
+    return condition
+
+
+def record_added(product_ids, when=None):
+    """Count one more cart for each product, in every bucket of `when`"""
+    product_ids = list(product_ids)
+    if not product_ids:
+        return
+    buckets = get_buckets(when)
+    # Create missing rows at zero, then increment them all with a single UPDATE
+    ProductPopularity.objects.bulk_create(
+        [
+            ProductPopularity(product_id=product_id, period=period, bucket=bucket)
+            for product_id in product_ids
+            for period, bucket in buckets
+        ],
+        ignore_conflicts=True,
+    )
+    ProductPopularity.objects.filter(_bucket_filter(buckets), product_id__in=product_ids).update(
+        carts=F('carts') + 1
+    )
+
+
+def record_removed(items):
+    """Count one cart less for each (product_id, created_at) pair"""
+    counts = Counter(
+        (product_id, period, bucket)
+        for product_id, created_at in items
+        for period, bucket in get_buckets(created_at)
+    )
+    # Cells losing the same number of carts share an UPDATE
+    cells_by_count = defaultdict(list)
+    for cell, count in counts.items():
+        cells_by_count[count].append(cell)
+
+    for count, cells in cells_by_count.items():
+        for start in range(0, len(cells), REMOVE_BATCH_SIZE):
+            condition = Q()
+            for product_id, period, bucket in cells[start:start + REMOVE_BATCH_SIZE]:
+                condition |= Q(product_id=product_id, period=period, bucket=bucket)
+            # Never go negative if the stored counters have drifted
+            ProductPopularity.objects.filter(condition).update(carts=Greatest(F('carts') - count, 0))
+
+
+def prune_buckets(now=None):
+    """Delete the counters of buckets that have ended, returns the number of rows deleted"""
+    condition = Q()
+    for period in PERIODS:
+        condition |= Q(period=period, bucket__lt=get_bucket(period, now))
+    deleted, _ = ProductPopularity.objects.filter(condition).delete()
+    return deleted
+
+
+def top_products(period=ALL_TIME, limit=3):
+    """The `limit` products in the most carts for the current bucket of `period`"""
+    return list(
+        ProductPopularity.objects.filter(period=period, bucket=get_bucket(period), carts__gt=0)
+        .select_related('product__category')
+        .order_by('-carts')[:limit]
+    )
+
+
+def get_popular_products(period=ALL_TIME, limit=4):
+    """top_products() for page rendering, shared across requests for a minute"""
+    cache_key = f'popular_products:{period}:{get_bucket(period)}:{limit}'
+    popular = cache.get(cache_key)
+    if popular is None:
+        popular = top_products(period, limit)
+        cache.set(cache_key, popular, POPULAR_TIMEOUT)
+    return popular
@@ -0,0 +1,98 @@
+from django.core.cache import cache
+
+from .cache import get_catalog_timeout, aget_versions, get_versions
+from .models import Product
+
+# Related products are the newest products of the same category. Every product
+# of a category shares one cached pool of RELATED_LIMIT + 1 ids, so removing the
+# product itself still leaves RELATED_LIMIT. The pool objects are cached next to
+# the ids; they carry every translated field, so all languages share them. Both
+# entries are keyed by the category version, bumped on any product change there,
+# and by the catalog version since the objects carry their category.
+RELATED_LIMIT = 4
+POOL_SIZE = RELATED_LIMIT + 1
+
+
+def _get_version(versions, category_id):
+    return f"{versions['catalog']}.{versions[f'category:{category_id}']}"
+
+
+def _keys(category_id, version):
+    return f'related_ids:{category_id}:{version}', f'related_objects:{category_id}:{version}'
+
+
+def pool_queryset(category_id):
+    return Product.objects.filter(category_id=category_id).order_by('-created_at', '-id').values_list(
+        'id', flat=True
+    )[:POOL_SIZE]
+
+
+def get_pool_ids(category_id):
+    return list(pool_queryset(category_id))
+
+
+def load_objects(ids):
+    return Product.objects.select_related('category').in_bulk(ids)
+
+
+def pick_related(product, ids, objects, limit):
+    related_ids = [pk for pk in ids if pk != product.pk][:limit]
+    return [objects[pk] for pk in related_ids if pk in objects]
+
+
+def get_related_products(product, limit=RELATED_LIMIT):
+    """Up to `limit` other products from the product's category"""
+    category_id = product.category_id
+    version = _get_version(get_versions('catalog', f'category:{category_id}'), category_id)
+    ids_key, objects_key = _keys(category_id, version)
+
+    cached = cache.get_many([ids_key, objects_key])
+    ids = cached.get(ids_key)
+    objects = cached.get(objects_key)
+    # An empty list is a valid pool, only a missing key is a miss
+    if ids is None:
+        ids = get_pool_ids(category_id)
+        cache.set(ids_key, ids, get_catalog_timeout())
+        objects = None
+    if objects is None:
+        objects = load_objects(ids)
+        cache.set(objects_key, objects, get_catalog_timeout())
+    return pick_related(product, ids, objects, limit)
+
+
+async def aget_related_products(product, limit=RELATED_LIMIT):
+    """Async get_related_products(), reads the same cache entries"""
+    category_id = product.category_id
+    version = _get_version(await aget_versions('catalog', f'category:{category_id}'), category_id)
+    ids_key, objects_key = _keys(category_id, version)
+
+    cached = await cache.aget_many([ids_key, objects_key])
+    ids = cached.get(ids_key)
+    objects = cached.get(objects_key)
+    if ids is None:
+        ids = [pk async for pk in pool_queryset(category_id)]
+        await cache.aset(ids_key, ids, get_catalog_timeout())
+        objects = None
+    if objects is None:
+        objects = await Product.objects.select_related('category').ain_bulk(ids)
+        await cache.aset(objects_key, objects, get_catalog_timeout())
+    return pick_related(product, ids, objects, limit)
+
+
+def warm_related_products(category_ids, batch_size=500):
+    """Fill the pools of many categories with one in_bulk per batch, returns the number cached"""
+    versions = get_versions('catalog', *[f'category:{category_id}' for category_id in category_ids])
+    warmed = 0
+    for start in range(0, len(category_ids), batch_size):
+        batch = category_ids[start:start + batch_size]
+        pools = {category_id: get_pool_ids(category_id) for category_id in batch}
+        objects = load_objects([pk for ids in pools.values() for pk in ids])
+
+        entries = {}
+        for category_id, ids in pools.items():
+            ids_key, objects_key = _keys(category_id, _get_version(versions, category_id))
+            entries[ids_key] = ids
+            entries[objects_key] = {pk: objects[pk] for pk in ids if pk in objects}
+        cache.set_many(entries, get_catalog_timeout())
+        warmed += len(batch)
+    return warmed
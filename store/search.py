@@ -0,0 +1,147 @@
+import re
+
+from django.core import signing
+from django.db import connection, transaction
+
+from .models import Product
+from .pagination import InvalidCursor, KeysetPage
+
+# Product names and descriptions in both languages are indexed in an SQLite
+# FTS5 table whose rowid is the product id. The unicode61 tokenizer splits
+# Georgian and English text alike, porter adds English stemming and leaves
+# Georgian words untouched. The table is created after migrate, kept in sync
+# by the Product signals and rebuilt by the rebuild_search_index command.
+SEARCH_TABLE = 'store_product_search'
+SEARCH_COLUMNS = ['name_en', 'name_ka', 'description_en', 'description_ka']
+# bm25 weights in SEARCH_COLUMNS order, a match in the name counts ten times more
+SEARCH_WEIGHTS = [10.0, 10.0, 1.0, 1.0]
+CURSOR_SALT = 'store.search.cursor'
+MAX_TERMS = 8
+# bm25 has to score every match before sorting. A query matching more products
+# than this only ranks the newest ones, which keeps broad one-word searches from
+# costing seconds on a large catalog.
+MAX_RANKED = 10_000
+
+TERM_RE = re.compile(r'\w+')
+
+
+def is_supported():
+    return connection.vendor == 'sqlite'
+
+
+def create_search_table():
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5("
+            f"{', '.join(SEARCH_COLUMNS)}, tokenize='porter unicode61 remove_diacritics 2')"
+        )
+
+
+def _values(product):
+    return [getattr(product, column) or '' for column in SEARCH_COLUMNS]
+
+
+def index_products(products):
+    """Add or replace the index entries of the given products"""
+    rows = [[product.pk, *_values(product)] for product in products]
+    if not rows:
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(f'DELETE FROM {SEARCH_TABLE} WHERE rowid = %s', [[row[0]] for row in rows])
+        cursor.executemany(
+            f"INSERT INTO {SEARCH_TABLE} (rowid, {', '.join(SEARCH_COLUMNS)}) VALUES (%s, %s, %s, %s, %s)", rows
+        )
+
+
+def unindex_product(product_id):
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {SEARCH_TABLE} WHERE rowid = %s', [product_id])
+
+
+def rebuild_index():
+    """Recreate the index from the product table, returns the number of products indexed"""
+    columns = ', '.join(SEARCH_COLUMNS)
+    values = ', '.join(f"COALESCE({column}, '')" for column in SEARCH_COLUMNS)
+    # SQLite DDL is transactional: searches and product saves keep using the old
+    # table until the new one is committed, and a failed rebuild leaves it in place
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP TABLE IF EXISTS {SEARCH_TABLE}')
+        create_search_table()
+        with connection.cursor() as cursor:
+            # Copied inside the database, the rows never pass through Python
+            cursor.execute(
+                f'INSERT INTO {SEARCH_TABLE} (rowid, {columns}) SELECT id, {values} FROM {Product._meta.db_table}'
+            )
+            cursor.execute(f"INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}) VALUES ('optimize')")
+            cursor.execute(f'SELECT COUNT(*) FROM {SEARCH_TABLE}')
+            return cursor.fetchone()[0]
+
+
+def build_match(query):
+    """FTS5 query matching every word of the user's input, None if there are no words"""
+    terms = TERM_RE.findall(query.lower())[:MAX_TERMS]
+    if not terms:
+        return None
+    # Quoted so user input can never be read as FTS5 syntax. Only the last word
+    # may still be being typed, prefix matching every word is much slower.
+    return ' '.join([*(f'"{term}"' for term in terms[:-1]), f'"{terms[-1]}"*'])
+
+
+class SearchPaginator:
+    """
+    Keyset pagination over (rank, product id) for one search query. The rank is
+    the bm25 score, lower is better, and the cursor holds the last row shown.
+    """
+
+    def __init__(self, query, per_page):
+        self.query = query
+        self.match = build_match(query)
+        self.per_page = per_page
+
+    def encode_cursor(self, rank, pk):
+        return signing.dumps([self.query, rank, pk], salt=CURSOR_SALT)
+
+    def decode_cursor(self, cursor):
+        try:
+            query, rank, pk = signing.loads(cursor, salt=CURSOR_SALT)
+        except (signing.BadSignature, ValueError, TypeError):
+            raise InvalidCursor('Invalid cursor')
+        if query != self.query:
+            raise InvalidCursor('Cursor does not match the current query')
+        return float(rank), int(pk)
+
+    def ranked_ids(self, after=None):
+        weights = ', '.join(str(weight) for weight in SEARCH_WEIGHTS)
+        sql = (
+            f'SELECT rowid, score FROM ('
+            f'SELECT rowid, bm25({SEARCH_TABLE}, {weights}) AS score FROM {SEARCH_TABLE} '
+            f'WHERE {SEARCH_TABLE} MATCH %s ORDER BY rowid DESC LIMIT %s)'
+        )
+        params = [self.match, MAX_RANKED]
+        if after is not None:
+            sql += ' WHERE score > %s OR (score = %s AND rowid > %s)'
+            params += [after[0], after[0], after[1]]
+        sql += ' ORDER BY score, rowid LIMIT %s'
+        params.append(self.per_page + 1)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+
+    def page(self, cursor=None):
+        if self.match is None:
+            return KeysetPage([])
+        after = self.decode_cursor(cursor) if cursor else None
+        rows = self.ranked_ids(after)
+
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        products = Product.objects.select_related('category').in_bulk([pk for pk, _ in rows])
+        # A product deleted after the index was read is skipped
+        object_list = [products[pk] for pk, _ in rows if pk in products]
+
+        next_cursor = None
+        if has_more:
+            last_pk, last_rank = rows[-1]
+            next_cursor = self.encode_cursor(last_rank, last_pk)
+        return KeysetPage(object_list, next_cursor)
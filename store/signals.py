@@ -0,0 +1,172 @@
+from functools import partial
+
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import F, QuerySet
+from django.db.models.signals import post_delete, post_init, post_migrate, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from rosetta.signals import post_save as rosetta_post_save
+
+from .cache import bump_category, bump_version
+from .facets import adjust_facet, get_facet_key
+from .images import schedule_variants
+from .labels import translations_saved
+from .models import Category, Product, Sequence
+from .search import create_search_table, index_products, is_supported, unindex_product
+
+
+# Stands in for a field that was deferred when the product was loaded
+UNKNOWN = object()
+
+
+def get_product_state(instance):
+    # Read __dict__ rather than the attributes: a deferred field would be loaded, and
+    # the instance loaded for it sends post_init again for the next deferred field
+    state = {name: instance.__dict__.get(name, UNKNOWN) for name in ('category_id', 'price', 'stock')}
+    image = instance.__dict__.get('image', UNKNOWN)
+    state['image'] = getattr(image, 'name', image)
+    return state
+
+
+@receiver(post_init, sender=Product)
+def remember_product_state(sender, instance, **kwargs):
+    # Keep the category the product was loaded with so a move can invalidate both listings,
+    # the price and stock so the facet counts can be moved to the right cell
+    # and the image so a new upload gets its variants generated
+    instance._original_state = get_product_state(instance)
+
+
+def load_original_state(instance, names, using):
+    row = Product._base_manager.using(using).filter(pk=instance.pk).values(*names).first()
+    if row is not None:
+        instance._original_state.update(row)
+
+
+@receiver(pre_save, sender=Product)
+def load_saved_state(sender, instance, raw=False, using=DEFAULT_DB_ALIAS, **kwargs):
+    # A deferred field loaded or assigned since post_init is saved now, so fetch what it was
+    original = instance._original_state
+    current = get_product_state(instance)
+    missing = [name for name, value in original.items() if value is UNKNOWN and current[name] is not UNKNOWN]
+    if missing and not raw and not instance._state.adding:
+        load_original_state(instance, missing, using)
+
+
+@receiver(pre_delete, sender=Product)
+def load_deleted_state(sender, instance, using=DEFAULT_DB_ALIAS, **kwargs):
+    # The row is gone by post_delete, too late to load a deferred field
+    missing = [name for name, value in instance._original_state.items() if value is UNKNOWN]
+    if missing:
+        load_original_state(instance, missing, using)
+
+
+def adjust_product_count(category_id, delta):
+    categories = Category.objects.filter(pk=category_id)
+    if delta < 0:
+        # Never go negative if the stored count has drifted
+        categories = categories.filter(product_count__gte=-delta)
+    categories.update(product_count=F('product_count') + delta)
+
+
+def get_original(instance, name):
+    value = instance._original_state[name]
+    # A field that was never loaded has not been saved either
+    return getattr(instance, name) if value is UNKNOWN else value
+
+
+def get_original_facet_key(instance):
+    return get_facet_key(*(get_original(instance, name) for name in ('category_id', 'price', 'stock')))
+
+
+@receiver(post_save, sender=Product)
+def product_saved(sender, instance, created, **kwargs):
+    original = instance._original_state
+    current = get_product_state(instance)
+    changed = set() if created else {name for name, value in current.items() if value != original[name]}
+    moved_from = original['category_id'] if 'category_id' in changed else None
+    if created:
+        adjust_product_count(instance.category_id, 1)
+    elif moved_from not in (None, UNKNOWN):
+        adjust_product_count(moved_from, -1)
+        adjust_product_count(instance.category_id, 1)
+
+    if created or changed & {'category_id', 'price', 'stock'}:
+        facet = get_facet_key(instance.category_id, instance.price, instance.stock)
+        original_facet = None if created else get_original_facet_key(instance)
+        if facet != original_facet:
+            adjust_facet(original_facet, -1)
+            adjust_facet(facet, 1)
+
+    if instance.image.name if created else 'image' in changed:
+        # The old variants no longer match, pages use the original until the new ones exist
+        if instance.image_hash:
+            Product.objects.filter(pk=instance.pk).update(image_hash='')
+            instance.image_hash = ''
+        if instance.image:
+            transaction.on_commit(
+                partial(schedule_variants, instance.pk, instance.category_id, instance.image.name)
+            )
+
+    bump_category(instance.category_id)
+    if is_supported():
+        index_products([instance])
+    if moved_from not in (None, UNKNOWN):
+        bump_category(moved_from)
+    remember_product_state(sender, instance)
+
+
+def is_category_cascade(instance, origin):
+    """Whether the product is deleted along with its own category"""
+    if isinstance(origin, Category):
+        return origin.pk == get_original(instance, 'category_id')
+    return isinstance(origin, QuerySet) and origin.model is Category
+
+
+@receiver(post_delete, sender=Product)
+def product_deleted(sender, instance, origin=None, **kwargs):
+    # The category row and its facet cells go away with the category, which
+    # bumps the versions once in category_deleted instead of once per product
+    category_id = get_original(instance, 'category_id')
+    if not is_category_cascade(instance, origin):
+        adjust_product_count(category_id, -1)
+        adjust_facet(get_original_facet_key(instance), -1)
+        bump_category(category_id)
+    if is_supported():
+        unindex_product(instance.pk)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_category_listings(sender, instance, **kwargs):
+    bump_version('catalog')
+
+
+@receiver(post_delete, sender=Category)
+def category_deleted(sender, instance, **kwargs):
+    bump_category(instance.pk)
+
+
+@receiver(post_migrate)
+def create_search_index(sender, app_config=None, **kwargs):
+    if app_config is not None and app_config.label == 'store' and is_supported():
+        create_search_table()
+
+
+@receiver(post_migrate)
+def resync_sequences(sender, app_config=None, using=DEFAULT_DB_ALIAS, **kwargs):
+    # Data migrations insert ids without the sequence
+    if app_config is not None and app_config.label == 'store':
+        for model in (Category, Product):
+            Sequence.objects.db_manager(using).resync(model)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_save, sender=Product)
+def advance_sequence(sender, instance, raw=False, using=DEFAULT_DB_ALIAS, **kwargs):
+    # loaddata saves with raw=True and the ids of the fixture
+    if raw:
+        Sequence.objects.db_manager(using).advance(sender, instance.pk)
+
+
+@receiver(rosetta_post_save)
+def reload_label_bundles(sender, language_code=None, **kwargs):
+    translations_saved()
@@ -0,0 +1,35 @@
+from django import template
+
+from store.images import IMAGE_WIDTHS, get_variant_url
+
+register = template.Library()
+
+
+def get_srcset(image_hash, extension):
+    return ', '.join(f'{get_variant_url(image_hash, f"{width}w", extension)} {width}w' for width in IMAGE_WIDTHS)
+
+
+@register.inclusion_tag('store/includes/product_picture.html')
+def product_picture(product, sizes='100vw', css_class='img-fluid'):
+    """
+    <picture> with WebP and JPEG srcsets of the resized variants, or the
+    original image while the variants are still being generated
+    """
+    context = {'product': product, 'sizes': sizes, 'css_class': css_class}
+    if product.image and product.image_hash:
+        context.update({
+            'webp_srcset': get_srcset(product.image_hash, 'webp'),
+            'srcset': get_srcset(product.image_hash, 'jpg'),
+            'src': get_variant_url(product.image_hash, f'{IMAGE_WIDTHS[0]}w'),
+        })
+    return context
+
+
+@register.simple_tag
+def product_thumbnail_url(product, extension='jpg'):
+    """URL of the square thumbnail, the original until it exists, empty without an image"""
+    if not product.image:
+        return ''
+    if not product.image_hash:
+        return product.image.url
+    return get_variant_url(product.image_hash, 'thumb', extension)
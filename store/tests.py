@@ -1,3 +1,876 @@
-from django.test import TestCase
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+from decimal import Decimal
+from pathlib import Path
 
-# Create your tests here.
+from unittest import mock
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.management.sql import emit_post_migrate_signal
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connection, transaction
+from django.db.models import F, Max, QuerySet
+from django.template import Context, Template
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse, reverse_lazy
+from django.utils import translation
+from PIL import Image
+
+from djangoProject import metrics
+from djangoProject.database import PIN_COOKIE, PrimaryPinMiddleware, PrimaryReplicaRouter
+from order.cart import merge_carts, persist_cart
+from order.models import Cart, CartItem
+from . import labels, models
+from .cache import get_sidebar_categories, get_versions
+from .facets import get_facet_counts
+from .images import get_variant_name
+from .management.commands.explain_catalog import is_full_scan
+from .models import Category, Product
+from .pagination import InvalidCursor, KeysetPaginator
+from .popularity import get_bucket_start, top_products
+from .related import aget_related_products, get_related_products
+from .search import SearchPaginator, rebuild_index
+
+
+class CatalogTestCase(TestCase):
+    """A 'Fruit' category for the whole class and an empty cache for every test"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Fruit', description='Fruit')
+
+    @classmethod
+    def create_product(cls, name, price='1.00', **fields):
+        return Product.objects.create(name=name, category=cls.category, price=Decimal(price), **fields)
+
+    def setUp(self):
+        super().setUp()
+        # Catalog versions, cached pages and carts of the previous test
+        cache.clear()
+
+
+class PopularityTests(CatalogTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.apple, cls.pear = cls.create_product('Apple'), cls.create_product('Pear')
+
+    def carts(self, period='all'):
+        return {popularity.product: popularity.carts for popularity in top_products(period, limit=10)}
+
+    def test_counts_distinct_carts(self):
+        persist_cart('sfirst', {self.apple.pk: 1, self.pear.pk: 2})
+        persist_cart('sfirst', {self.apple.pk: 3, self.pear.pk: 2})
+        persist_cart('ssecond', {self.apple.pk: 1})
+        self.assertEqual(self.carts(), {self.apple: 2, self.pear: 1})
+        self.assertEqual(self.carts('hour'), {self.apple: 2, self.pear: 1})
+        self.assertEqual(top_products(limit=1)[0].product, self.apple)
+
+    def test_removed_and_merged_items_are_uncounted(self):
+        persist_cart('sfirst', {self.apple.pk: 1, self.pear.pk: 1})
+        persist_cart('ssecond', {self.apple.pk: 1})
+        persist_cart('sfirst', {self.apple.pk: 1})
+        self.assertEqual(self.carts(), {self.apple: 2})
+
+        merge_carts(Cart.objects.get(session_id='second'), Cart.objects.get(session_id='first'))
+        self.assertEqual(self.carts(), {self.apple: 1})
+
+        CartItem.objects.filter(product=self.apple).delete()
+        self.assertEqual(self.carts(), {})
+
+    def test_periods_are_calendar_buckets(self):
+        when = datetime(2024, 3, 5, 10, 5, tzinfo=dt_timezone.utc)
+        self.assertEqual(get_bucket_start('hour', when), datetime(2024, 3, 5, 10, tzinfo=dt_timezone.utc))
+        self.assertEqual(get_bucket_start('day', when), datetime(2024, 3, 5, tzinfo=dt_timezone.utc))
+        # Weeks of Unix time start on Thursdays
+        self.assertEqual(get_bucket_start('week', when), datetime(2024, 2, 29, tzinfo=dt_timezone.utc))
+        self.assertIsNone(get_bucket_start('all', when))
+
+    def test_command_states_where_the_period_starts(self):
+        persist_cart('sfirst', {self.apple.pk: 1})
+        output = io.StringIO()
+        call_command('find_popular_products', '--period', 'day', stdout=output)
+        start = get_bucket_start('day').strftime('%Y-%m-%d %H:%M')
+        self.assertIn(f'Counted since {start} UTC, the start of the current calendar day', output.getvalue())
+        self.assertIn('Apple', output.getvalue())
+
+
+class RelatedProductsTests(CatalogTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.apple = cls.create_product('Apple')
+
+    def test_empty_result_is_cached(self):
+        self.assertEqual(get_related_products(self.apple), [])
+        with self.assertNumQueries(0):
+            self.assertEqual(get_related_products(self.apple), [])
+
+    def test_new_product_invalidates_category(self):
+        get_related_products(self.apple)
+        with self.captureOnCommitCallbacks(execute=True):
+            pear = self.create_product('Pear', '2.00')
+        self.assertEqual(get_related_products(self.apple), [pear])
+        self.assertEqual(get_related_products(pear), [self.apple])
+
+    def test_async_lookup_shares_the_pool(self):
+        pear = self.create_product('Pear', '2.00')
+        self.assertEqual(async_to_sync(aget_related_products)(self.apple), [pear])
+        with self.assertNumQueries(0):
+            self.assertEqual(get_related_products(pear), [self.apple])
+
+
+class SearchTests(CatalogTestCase):
+    def create(self, name_en, name_ka, description=''):
+        return self.create_product(name_en, name_en=name_en, name_ka=name_ka, description_en=description)
+
+    def search(self, query, per_page=10, cursor=None):
+        return SearchPaginator(query, per_page).page(cursor)
+
+    def test_ranks_name_matches_first_in_both_languages(self):
+        in_description = self.create('Pear', 'მსხალი', 'Tastes like a green apple')
+        in_name = self.create('Green apple', 'მწვანე ვაშლი')
+        self.assertEqual(list(self.search('apple')), [in_name, in_description])
+        self.assertEqual(list(self.search('ვაშ')), [in_name])
+        self.assertEqual(list(self.search('"apple" (')), [in_name, in_description])
+
+    def test_keyset_pages_cover_every_result_once(self):
+        products = [self.create(f'Apple {i}', f'ვაშლი {i}') for i in range(7)]
+        seen = []
+        page = self.search('apple', per_page=3)
+        seen += page
+        while page.has_next():
+            page = self.search('apple', per_page=3, cursor=page.next_cursor)
+            seen += page
+        self.assertCountEqual(seen, products)
+        self.assertEqual(len(seen), len(products))
+
+    def test_index_follows_product_changes(self):
+        product = self.create('Plum', 'ქლიავი')
+        product.name_en = 'Cherry'
+        product.save()
+        self.assertEqual(list(self.search('plum')), [])
+        self.assertEqual(list(self.search('cherry')), [product])
+        product.delete()
+        self.assertEqual(list(self.search('cherry')), [])
+
+    def test_failed_rebuild_keeps_the_index(self):
+        product = self.create('Plum', 'ქლიავი')
+        with mock.patch('store.search.create_search_table', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                rebuild_index()
+        self.assertEqual(list(self.search('plum')), [product])
+        self.assertEqual(rebuild_index(), 1)
+
+
+class FacetTests(CatalogTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.vegetables = Category.objects.create(name='Vegetables', description='Vegetables')
+
+    def create(self, category, price, stock):
+        return Product.objects.create(
+            name='Product', category=category, price=Decimal(price), stock=stock, image='products/product.jpg'
+        )
+
+    def test_counts_follow_product_changes(self):
+        apple = self.create(self.category, '3.00', 10)
+        self.create(self.category, '30.00', 0)
+        self.create(self.vegetables, '4.00', 5)
+
+        counts = get_facet_counts()
+        self.assertEqual(counts['categories'], {self.category.id: 2, self.vegetables.id: 1})
+        self.assertEqual(counts['prices'], {0: 2, 3: 1})
+        self.assertEqual(counts['stock'], {True: 2, False: 1})
+
+        apple.price = Decimal('60.00')
+        apple.stock = 0
+        apple.category = self.vegetables
+        with self.captureOnCommitCallbacks(execute=True):
+            apple.save()
+        counts = get_facet_counts(in_stock=False)
+        self.assertEqual(counts['categories'], {self.category.id: 1, self.vegetables.id: 1})
+        self.assertEqual(counts['prices'], {3: 1, 4: 1})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            apple.delete()
+        self.assertEqual(get_facet_counts()['stock'], {True: 1, False: 1})
+
+    def test_deferred_products_keep_the_counts(self):
+        apple = self.create(self.category, '3.00', 10)
+        self.create(self.vegetables, '4.00', 5)
+        self.assertEqual(len(Product.objects.only('id', 'name')), 2)
+
+        cheap = Product.objects.defer('price').get(pk=apple.pk)
+        cheap.price = Decimal('60.00')
+        with self.captureOnCommitCallbacks(execute=True):
+            cheap.save()
+        self.assertEqual(get_facet_counts()['prices'], {0: 1, 4: 1})
+
+        moved = Product.objects.only('id', 'name', 'category').get(pk=apple.pk)
+        moved.category = self.vegetables
+        moved.name = 'Apple'
+        with self.captureOnCommitCallbacks(execute=True):
+            moved.save()
+        counts = get_facet_counts()
+        self.assertEqual(counts['categories'], {self.vegetables.id: 2})
+        self.assertEqual(counts['prices'], {0: 1, 4: 1})
+        self.assertEqual(
+            dict(Category.objects.values_list('name', 'product_count')), {'Fruit': 0, 'Vegetables': 2}
+        )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.only('id').get(pk=apple.pk).delete()
+        self.assertEqual(get_facet_counts()['categories'], {self.vegetables.id: 1})
+
+    def test_listing_filters_by_facets(self):
+        self.create(self.category, '3.00', 10)
+        cheap_out_of_stock = self.create(self.category, '4.00', 0)
+        self.create(self.category, '30.00', 0)
+
+        response = self.client.get('/category/', {'price': 0, 'stock': 'out'})
+        self.assertEqual(list(response.context['products']), [cheap_out_of_stock])
+        self.assertEqual([facet['count'] for facet in response.context['stock_facets']], [1, 1])
+
+
+class ProductCountTests(CatalogTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.vegetables = Category.objects.create(name='Vegetables', description='Vegetables')
+
+    def counts(self):
+        return dict(Category.objects.values_list('name', 'product_count'))
+
+    def create(self, name, category):
+        return Product.objects.create(name=name, category=category, price=Decimal('1.00'))
+
+    def test_count_follows_create_move_and_delete(self):
+        apple = self.create('Apple', self.category)
+        self.create('Pear', self.category)
+        self.assertEqual(self.counts(), {'Fruit': 2, 'Vegetables': 0})
+
+        apple.category = self.vegetables
+        apple.save()
+        self.assertEqual(self.counts(), {'Fruit': 1, 'Vegetables': 1})
+        # Saved again without a move
+        apple.save()
+        self.assertEqual(self.counts(), {'Fruit': 1, 'Vegetables': 1})
+
+        apple.delete()
+        self.assertEqual(self.counts(), {'Fruit': 1, 'Vegetables': 0})
+        Product.objects.filter(category=self.category).delete()
+        self.assertEqual(self.counts(), {'Fruit': 0, 'Vegetables': 0})
+
+    def test_stale_instance_does_not_overwrite_the_count(self):
+        stale = Category.objects.get(pk=self.category.pk)
+        self.create('Apple', self.category)
+        stale.description = 'Fresh fruit'
+        stale.save()
+        self.assertEqual(self.counts()['Fruit'], 1)
+
+    def test_category_cascade_skips_the_adjustments(self):
+        for name in ('Apple', 'Pear', 'Plum'):
+            self.create(name, self.category)
+        carrot = self.create('Carrot', self.vegetables)
+        self.assertEqual(get_facet_counts()['categories'], {self.category.id: 3, self.vegetables.id: 1})
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+            self.category.delete()
+        self.assertFalse([query['sql'] for query in queries if query['sql'].startswith('UPDATE')])
+        self.assertEqual(self.counts(), {'Vegetables': 1})
+        # The cached facet counts are invalidated all the same
+        self.assertEqual(get_facet_counts()['categories'], {self.vegetables.id: 1})
+
+        Category.objects.filter(pk=self.vegetables.pk).delete()
+        self.assertFalse(Product.objects.filter(pk=carrot.pk).exists())
+
+
+class SequenceTests(TestCase):
+    def create(self, name):
+        return Category.objects.create(name=name, description=name)
+
+    def test_slugs_contain_the_id(self):
+        fruit = self.create('Fresh Fruit')
+        self.assertEqual(fruit.slug, f'{fruit.pk}-fresh-fruit')
+        products = Product.objects.bulk_create([
+            Product(name=name, category=fruit, price=Decimal('1.00')) for name in ('Apple', 'Pear')
+        ])
+        self.assertEqual(
+            [product.slug for product in products], [f'{product.pk}-{product.name.lower()}' for product in products]
+        )
+        self.assertEqual(products[1].pk, products[0].pk + 1)
+
+    def test_one_statement_per_id_inside_transactions(self):
+        self.create('Fruit')
+        with self.assertNumQueries(2):
+            self.create('Vegetables')
+
+    def test_given_ids_are_not_handed_out_again(self):
+        fruit = self.create('Fruit')
+        Category.objects.bulk_create([Category(pk=fruit.pk + 10, name='Vegetables', description='Vegetables')])
+        self.assertEqual(self.create('Nuts').pk, fruit.pk + 11)
+        Category(pk=fruit.pk + 20, name='Herbs', description='Herbs').save()
+        self.assertEqual(self.create('Berries').pk, fruit.pk + 21)
+
+    def test_loaddata_moves_the_sequence(self):
+        fruit = self.create('Fruit')
+        fixture = [{'model': 'store.category', 'pk': fruit.pk + 50, 'fields': {
+            'name': 'Vegetables', 'name_en': 'Vegetables', 'description': 'Vegetables', 'slug': 'vegetables',
+            'created_at': '2024-01-01T00:00:00Z', 'updated_at': '2024-01-01T00:00:00Z',
+        }}]
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / 'categories.json'
+            path.write_text(json.dumps(fixture))
+            call_command('loaddata', str(path), verbosity=0)
+        self.assertEqual(self.create('Nuts').pk, fruit.pk + 51)
+
+    def test_rolled_back_ids_are_reused_without_collisions(self):
+        fruit = self.create('Fruit')
+        with self.assertRaises(DatabaseError):
+            with transaction.atomic():
+                self.create('Vegetables')
+                raise DatabaseError
+        vegetables = self.create('Vegetables')
+        self.assertEqual(vegetables.pk, fruit.pk + 1)
+        self.assertEqual(vegetables.slug, f'{vegetables.pk}-vegetables')
+
+    def test_migrate_resyncs(self):
+        fruit = self.create('Fruit')
+        Category.objects.filter(pk=fruit.pk).update(id=fruit.pk + 5)
+        emit_post_migrate_signal(0, False, DEFAULT_DB_ALIAS)
+        self.assertEqual(self.create('Nuts').pk, fruit.pk + 6)
+
+
+class SequenceCollisionTests(TransactionTestCase):
+    def tearDown(self):
+        models._id_blocks.clear()
+
+    def test_insert_retries_after_ids_taken_outside_the_sequence(self):
+        # Outside a transaction ids come from a block reserved by this process
+        fruit = Category.objects.create(name='Fruit', description='Fruit')
+        Category.objects.filter(pk=fruit.pk).update(id=fruit.pk + 1)
+        vegetables = Category.objects.create(name='Vegetables', description='Vegetables')
+        self.assertNotEqual(vegetables.pk, fruit.pk + 1)
+        self.assertEqual(vegetables.slug, f'{vegetables.pk}-vegetables')
+        self.assertEqual(Category.objects.count(), 2)
+
+
+class KeysetPaginatorTests(CatalogTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        # Repeated prices, so the id tiebreaker decides inside each price
+        cls.products = [cls.create_product(f'Product {i}', i // 2) for i in range(7)]
+
+    def walk(self, paginator):
+        """Every page forward from the first, then every page back from the last"""
+        forward, page = [], paginator.page()
+        self.assertFalse(page.has_previous())
+        forward.append(list(page))
+        while page.has_next():
+            page = paginator.page(page.next_cursor)
+            forward.append(list(page))
+        backward = [list(page)]
+        while page.has_previous():
+            page = paginator.page(page.previous_cursor)
+            backward.insert(0, list(page))
+        return forward, backward
+
+    def assertWalks(self, ordering, expected):
+        forward, backward = self.walk(KeysetPaginator(Product.objects.all(), 3, ordering))
+        self.assertEqual([product for page in forward for product in page], expected)
+        self.assertEqual([len(page) for page in forward], [3, 3, 1])
+        self.assertEqual(backward, forward)
+
+    def test_forward_and_backward(self):
+        by_price = sorted(self.products, key=lambda product: (product.price, product.pk))
+        self.assertWalks('price', by_price)
+        self.assertWalks('-price', by_price[::-1])
+
+    def test_null_sort_key(self):
+        for product in self.products[::2]:
+            product.name_ka = f'პროდუქტი {product.pk}'
+            product.save()
+        self.assertEqual(Product.objects.filter(name_ka__isnull=True).count(), 3)
+        # NULLs first ascending, last descending
+        by_name = sorted(
+            self.products, key=lambda product: (product.name_ka is not None, product.name_ka or '', product.pk)
+        )
+        self.assertWalks('name_ka', by_name)
+        self.assertWalks('-name_ka', by_name[::-1])
+
+    def test_invalid_cursor(self):
+        paginator = KeysetPaginator(Product.objects.all(), 3, 'price')
+        cursor = paginator.page().next_cursor
+        with self.assertRaises(InvalidCursor):
+            paginator.page('not-a-cursor')
+        with self.assertRaises(InvalidCursor):
+            paginator.page(cursor[:-1] + ('A' if cursor[-1] != 'A' else 'B'))
+        with self.assertRaises(InvalidCursor):
+            KeysetPaginator(Product.objects.all(), 3, '-price').page(cursor)
+
+    @override_settings(PRODUCT_LIST_PAGINATION='keyset')
+    def test_listing_uses_cursors(self):
+        self.products += [
+            self.create_product(f'Product {i}', i // 2)
+            for i in range(7, 11)
+        ]
+        url = reverse('product_list')
+        response = self.client.get(url, {'sort': 'price'})
+        self.assertTrue(response.context['keyset_pagination'])
+        self.assertEqual(list(response.context['products']), self.products[:9])
+        cursor = response.context['page_obj'].next_cursor
+        response = self.client.get(url, {'sort': 'price', 'cursor': cursor})
+        self.assertEqual(list(response.context['products']), self.products[9:])
+        self.assertEqual(self.client.get(url, {'sort': 'price', 'cursor': 'not-a-cursor'}).status_code, 404)
+
+
+class CatalogCommandTests(TestCase):
+    def test_populate_db(self):
+        output = io.StringIO()
+        options = {'categories': 3, 'products': 40, 'users': 4, 'carts': 6, 'items_per_cart': 2, 'batch_size': 7}
+        call_command('populate_db', stdout=output, **options)
+        self.assertIn('Creating categories...', output.getvalue())
+        self.assertEqual(Category.objects.count(), 3)
+        self.assertEqual(Product.objects.count(), 40)
+        self.assertEqual(Cart.objects.count(), 6)
+        self.assertEqual(CartItem.objects.count(), 12)
+        self.assertEqual(Product.objects.exclude(slug__startswith=F('id')).count(), 0)
+        # The counters that bulk_create skipped are rebuilt
+        self.assertEqual(sum(Category.objects.values_list('product_count', flat=True)), 40)
+        # Ids handed out later do not collide with the generated ones
+        category = Category.objects.create(name='Fruit', description='Fruit')
+        self.assertGreater(
+            Product.objects.create(name='Apple', category=category, price=Decimal('1.00')).pk,
+            Product.objects.exclude(category=category).aggregate(last=Max('pk'))['last']
+        )
+
+        call_command('populate_db', '--clear', stdout=io.StringIO(), **options)
+        self.assertEqual(Category.objects.count(), 3)
+        self.assertEqual(Product.objects.count(), 40)
+        self.assertEqual(get_user_model().objects.filter(username__startswith='loadtest_').count(), 4)
+
+    def test_explain_catalog(self):
+        category = Category.objects.create(name='Fruit', description='Fruit')
+        Product.objects.create(name='Apple', category=category, price=Decimal('1.00'))
+        output = io.StringIO()
+        call_command('explain_catalog', stdout=output)
+        self.assertIn('All listing queries use an index', output.getvalue())
+
+    def test_explain_catalog_detects_full_scans(self):
+        self.assertTrue(is_full_scan('SCAN store_product\nUSE TEMP B-TREE FOR ORDER BY'))
+        self.assertTrue(is_full_scan('Sort  (cost=10.0..12.0)\n  Sort Key: price\n  ->  Seq Scan on store_product'))
+        self.assertFalse(is_full_scan('SCAN store_product USING INDEX product_price_id_idx'))
+        with mock.patch.object(QuerySet, 'explain', return_value='SCAN store_product'):
+            with self.assertRaisesMessage(CommandError, 'fall back to a full scan'):
+                call_command('explain_catalog', stdout=io.StringIO())
+
+
+class LabelTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # Compiled aside, the .mo files are a deploy artifact
+        cls.locale_dir = tempfile.mkdtemp()
+        shutil.copytree(settings.LOCALE_PATHS[0], cls.locale_dir, dirs_exist_ok=True)
+        cls.enterClassContext(override_settings(LOCALE_PATHS=[cls.locale_dir]))
+        call_command('compile_translations', stdout=io.StringIO())
+        labels.reload_translations()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(cls.locale_dir)
+        labels.reload_translations()
+
+    def test_compile_only_changed_catalogs(self):
+        output = io.StringIO()
+        call_command('compile_translations', stdout=output)
+        self.assertIn('Compiled 0 catalogs', output.getvalue())
+        self.assertTrue(Path(self.locale_dir, 'ka', 'LC_MESSAGES', 'django.mo').exists())
+
+    def test_startup_does_not_compile(self):
+        with mock.patch.object(labels, 'compile_catalogs') as compile_catalogs:
+            labels.warm_up()
+        compile_catalogs.assert_not_called()
+
+    def test_bundles_are_resolved_and_read_only(self):
+        self.assertEqual(labels.get_labels('product_details', 'ka')['price'], 'ფასი')
+        self.assertEqual(labels.get_labels('product_details', 'en')['price'], 'Price')
+        with self.assertRaises(TypeError):
+            labels.get_labels('cart_labels', 'en')['price'] = 'Cost'
+
+    def test_other_process_save_reloads_catalogs(self):
+        # Another worker saved translations in rosetta
+        labels.bump_translations_version()
+        with mock.patch.object(labels, '_last_check', 0.0), \
+                mock.patch.object(labels, 'reload_translations') as reload_translations:
+            labels.get_labels('cart_labels')
+            labels.get_labels('cart_labels')
+        reload_translations.assert_called_once()
+        self.assertEqual(labels._loaded_version, cache.get(labels.TRANSLATIONS_VERSION_KEY))
+
+    def test_gettext_survives_a_concurrent_reload(self):
+        stop = threading.Event()
+        results = []
+
+        def translate():
+            # Both the active catalog of a language and the default one
+            while not stop.is_set():
+                try:
+                    with translation.override('ka'):
+                        results.append(translation.gettext('Price'))
+                    with translation.override(None):
+                        results.append(translation.gettext('Price'))
+                except Exception as e:
+                    results.append(e)
+
+        # Switch threads as often as possible to hit the window between two reads
+        self.addCleanup(sys.setswitchinterval, sys.getswitchinterval())
+        sys.setswitchinterval(1e-6)
+        threads = [threading.Thread(target=translate) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        try:
+            for _ in range(20):
+                labels.reload_translations()
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(set(results), {'ფასი', 'Price'})
+
+
+class ProductImageTests(CatalogTestCase):
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(MEDIA_ROOT=media_root, IMAGE_WORKERS=0)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def upload(self, color, size=(1200, 800)):
+        output = io.BytesIO()
+        Image.new('RGB', size, color).save(output, 'PNG')
+        return SimpleUploadedFile(f'{color}.png', output.getvalue(), content_type='image/png')
+
+    def create_uploaded_product(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            product = self.create_product('Apple', image=self.upload('red'))
+        product.refresh_from_db()
+        return product
+
+    def test_upload_creates_hashed_variants(self):
+        product = self.create_uploaded_product()
+        self.assertEqual(len(product.image_hash), 40)
+        with default_storage.open(get_variant_name(product.image_hash, '300w', 'webp')) as file:
+            self.assertEqual(Image.open(file).size, (300, 200))
+        with default_storage.open(get_variant_name(product.image_hash, 'thumb', 'jpg')) as file:
+            self.assertEqual(Image.open(file).size, (160, 160))
+
+        html = Template('{% load product_images %}{% product_picture product sizes="50vw" %}').render(
+            Context({'product': product})
+        )
+        self.assertIn('type="image/webp"', html)
+        self.assertIn(f'{product.image_hash}-900w.webp 900w', html)
+
+    def test_new_upload_replaces_the_variants(self):
+        product = self.create_uploaded_product()
+        old_hash = product.image_hash
+        with self.captureOnCommitCallbacks(execute=True):
+            product.image = self.upload('green')
+            product.save()
+            self.assertEqual(Product.objects.get(pk=product.pk).image_hash, '')
+        product.refresh_from_db()
+        self.assertNotIn(product.image_hash, ('', old_hash))
+
+
+class ConditionalGetTests(CatalogTestCase):
+    list_url = reverse_lazy('product_list')
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.apple = cls.create_product('Apple', image='products/apple.jpg')
+
+    def setUp(self):
+        super().setUp()
+        self.detail_url = reverse('product_details', kwargs={'slug': self.apple.slug})
+
+    def assertNotModified(self, url, max_queries, **headers):
+        etag = self.client.get(url).headers['ETag']
+        with self.assertNumQueries(max_queries):
+            response = self.client.get(url, headers={'if-none-match': etag, **headers})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertEqual(response.templates, [])
+        return etag
+
+    def test_detail_answers_304_with_one_query(self):
+        self.assertNotModified(self.detail_url, 1)
+
+    def test_listing_answers_304_with_one_query(self):
+        self.assertNotModified(self.list_url, 1)
+
+    @mock.patch('store.views.is_cache_shared', return_value=True)
+    def test_listing_answers_304_without_queries_with_a_shared_cache(self, is_cache_shared):
+        self.assertNotModified(self.list_url, 0)
+
+    def test_listing_etag_follows_changes_made_by_other_workers(self):
+        etag = self.assertNotModified(self.list_url, 1)
+        # Another worker bumps its own counters, this one only sees the row
+        Product.objects.filter(pk=self.apple.pk).update(stock=5, updated_at=datetime.now(dt_timezone.utc))
+        self.assertEqual(self.client.get(self.list_url, headers={'if-none-match': etag}).status_code, 200)
+
+    def test_detail_if_modified_since(self):
+        last_modified = self.client.get(self.detail_url).headers['Last-Modified']
+        response = self.client.get(self.detail_url, headers={'if-modified-since': last_modified})
+        self.assertEqual(response.status_code, 304)
+
+    def test_changes_invalidate_the_etag(self):
+        detail_etag = self.assertNotModified(self.detail_url, 1)
+        list_etag = self.assertNotModified(self.list_url, 1)
+        # A new product changes the related products and the listing
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_product('Pear', '2.00')
+        for url, etag in ((self.detail_url, detail_etag), (self.list_url, list_etag)):
+            response = self.client.get(url, headers={'if-none-match': etag})
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_cart_changes_invalidate_the_etag(self):
+        etag = self.client.get(self.detail_url).headers['ETag']
+        self.client.post(reverse('add_to_cart'), {'product_id': self.apple.id})
+        self.client.cookies.pop('messages', None)
+        response = self.client.get(self.detail_url, headers={'if-none-match': etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_pending_messages_are_rendered(self):
+        etag = self.client.get(self.detail_url).headers['ETag']
+        self.client.cookies['messages'] = 'pending'
+        response = self.client.get(self.detail_url, headers={'if-none-match': etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_unknown_product_is_404(self):
+        self.assertEqual(self.client.get(reverse('product_details', kwargs={'slug': 'missing'})).status_code, 404)
+
+
+class CatalogCacheTests(CatalogTestCase):
+    list_url = reverse_lazy('product_list')
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.apple = cls.create_product('Apple', image='products/apple.jpg')
+
+    def listed(self):
+        return [product.name for product in self.client.get(self.list_url).context['products']]
+
+    def sidebar(self):
+        return {category.name: category.product_count for category in get_sidebar_categories()}
+
+    def test_product_changes_invalidate_listing_and_sidebar(self):
+        self.assertEqual(self.listed(), ['Apple'])
+        self.assertEqual(self.sidebar(), {'Fruit': 1})
+        with self.captureOnCommitCallbacks(execute=True):
+            pear = self.create_product('Pear', '2.00')
+        self.assertEqual(sorted(self.listed()), ['Apple', 'Pear'])
+        self.assertEqual(self.sidebar(), {'Fruit': 2})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            pear.delete()
+        self.assertEqual(self.listed(), ['Apple'])
+        self.assertEqual(self.sidebar(), {'Fruit': 1})
+
+    def test_category_changes_invalidate_sidebar(self):
+        self.assertEqual(self.sidebar(), {'Fruit': 1})
+        with self.captureOnCommitCallbacks(execute=True):
+            self.category.name = 'Fresh fruit'
+            self.category.save()
+            Category.objects.create(name='Vegetables', description='Vegetables')
+        self.assertEqual(self.sidebar(), {'Fresh fruit': 1, 'Vegetables': 0})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.category.delete()
+        self.assertEqual(self.sidebar(), {'Vegetables': 0})
+        self.assertEqual(self.listed(), [])
+
+    def test_versions_are_bumped_on_commit(self):
+        before = get_versions('catalog', 'all')
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.apple.save()
+            self.assertEqual(get_versions('catalog', 'all'), before)
+        for callback in callbacks:
+            callback()
+        self.assertEqual(get_versions('catalog')['catalog'], before['catalog'])
+        self.assertNotEqual(get_versions('all')['all'], before['all'])
+
+
+class DatabaseRouterTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.router = PrimaryReplicaRouter()
+        patcher = mock.patch.dict(settings.DATABASES, {'replica': settings.DATABASES['default']})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def serve(self, view, cookies=None):
+        """Run view through the middleware, returns the response and the databases it read from"""
+        request = RequestFactory().get('/')
+        request.COOKIES.update(cookies or {})
+        reads = []
+
+        def get_response(request):
+            view()
+            reads.append(self.router.db_for_read(Product))
+            return HttpResponse()
+
+        return PrimaryPinMiddleware(get_response)(request), reads
+
+    def test_only_catalog_reads_use_the_replica(self):
+        self.assertEqual(self.router.db_for_read(Product), 'replica')
+        self.assertEqual(self.router.db_for_read(Cart), 'default')
+        with mock.patch.dict(settings.DATABASES):
+            del settings.DATABASES['replica']
+            self.assertEqual(self.router.db_for_read(Product), 'default')
+
+    def test_reads_after_a_write_use_the_primary(self):
+        response, reads = self.serve(lambda: self.assertEqual(self.router.db_for_write(Cart), 'default'))
+        self.assertEqual(reads, ['default'])
+        self.assertIn(PIN_COOKIE, response.cookies)
+        # Only the writer's next requests are pinned, and only with the cookie
+        response, reads = self.serve(lambda: None, {PIN_COOKIE: '1'})
+        self.assertEqual(reads, ['default'])
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+        self.assertEqual(self.serve(lambda: None)[1], ['replica'])
+        self.assertEqual(self.router.db_for_read(Product), 'replica')
+
+    def test_writes_outside_requests_pin_nothing(self):
+        # As in a management command
+        self.assertEqual(self.router.db_for_write(Cart), 'default')
+        self.assertEqual(self.router.db_for_read(Product), 'replica')
+        self.assertEqual(self.serve(lambda: None)[1], ['replica'])
+
+    def test_writes_in_sync_code_of_async_requests_pin_the_request(self):
+        async def get_response(request):
+            await sync_to_async(self.router.db_for_write)(Cart)
+            return HttpResponse(self.router.db_for_read(Product))
+
+        response = async_to_sync(PrimaryPinMiddleware(get_response))(RequestFactory().get('/'))
+        self.assertEqual(response.content, b'default')
+        self.assertIn(PIN_COOKIE, response.cookies)
+
+    def test_catalog_writes_pin_every_visitor(self):
+        self.serve(lambda: self.router.db_for_write(Product))
+        self.assertEqual(self.serve(lambda: None)[1], ['default'])
+
+
+class MetricsTests(CatalogTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.create_product('Apple')
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        settings_override = override_settings(METRICS_SAMPLE_RATE=1, METRICS_DIR=directory, METRICS_TOKEN='secret')
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        patcher = mock.patch.object(metrics, 'registry', metrics.Registry())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def scrape(self, token='secret'):
+        return self.client.get(reverse('metrics'), headers={'authorization': f'Bearer {token}'})
+
+    def test_measures_requests_by_url_name(self):
+        self.client.get(reverse('product_list'))
+        self.client.get(reverse('product_list'))
+        text = self.scrape().content.decode()
+        self.assertIn('django_request_duration_seconds_count{view="product_list"} 2', text)
+        self.assertIn('django_request_template_seconds_count{view="product_list"} 2', text)
+        self.assertIn('# TYPE django_request_queries histogram', text)
+        self.assertIn('django_request_cache_hits_total{view="product_list"}', text)
+        self.assertNotIn('view="metrics"', text)
+
+    def test_measures_async_requests(self):
+        async_to_sync(self.async_client.get)(reverse('product_list'))
+        series = metrics.registry.histograms[('request_template_seconds', 'product_list')]
+        self.assertEqual(sum(series[:-1]), 1)
+        self.assertGreater(series[-1], 0)
+
+    def test_counts_queries_duplicates_and_cache_reads(self):
+        metrics.install_query_recorder()
+        sample = metrics.Sample()
+        token = metrics._sample.set(sample)
+        try:
+            for _ in range(2):
+                Product.objects.filter(name='Apple').exists()
+            Product.objects.filter(name='Pear').exists()
+            cache.set('metrics-test', 1)
+            cache.get('metrics-test')
+            cache.get('metrics-test-missing')
+        finally:
+            metrics._sample.reset(token)
+        self.assertEqual(sum(sample.queries.values()), 3)
+        self.assertEqual(sum(count - 1 for count in sample.queries.values()), 1)
+        self.assertEqual((sample.cache_hits, sample.cache_misses), (1, 1))
+
+    def test_adds_up_the_files_of_all_workers(self):
+        for view in ('product_list', 'product_list', 'cart_list'):
+            metrics.registry.record(view, metrics.Sample(), 0.02)
+        metrics.registry.write()
+        # A live worker, this test's parent process
+        other = Path(settings.METRICS_DIR) / f'{os.getppid()}.json'
+        shutil.copy(Path(settings.METRICS_DIR) / f'{os.getpid()}.json', other)
+        text = metrics.render(*metrics.collect())
+        self.assertIn('django_request_duration_seconds_bucket{view="product_list",le="0.01"} 0', text)
+        self.assertIn('django_request_duration_seconds_bucket{view="product_list",le="0.025"} 4', text)
+        self.assertIn('django_request_duration_seconds_count{view="cart_list"} 2', text)
+
+    def test_files_of_exited_or_silent_workers_are_removed(self):
+        metrics.registry.record('product_list', metrics.Sample(), 0.02)
+        metrics.registry.write()
+        directory = Path(settings.METRICS_DIR)
+        own = directory / f'{os.getpid()}.json'
+        exited = directory / f'{2 ** 22 + 1}.json'
+        silent = directory / f'{os.getppid()}.json'
+        for file in (exited, silent):
+            shutil.copy(own, file)
+        long_ago = time.time() - settings.METRICS_FLUSH_INTERVAL * settings.METRICS_STALE_INTERVALS - 1
+        os.utime(silent, (long_ago, long_ago))
+
+        text = metrics.render(*metrics.collect())
+        self.assertIn('django_request_duration_seconds_count{view="product_list"} 1', text)
+        self.assertEqual(list(directory.glob('*.json')), [own])
+
+    def test_metrics_need_the_token(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 404)
+        self.assertEqual(self.scrape('wrong').status_code, 404)
+        self.assertEqual(self.scrape().status_code, 200)
+        with override_settings(METRICS_TOKEN=''):
+            self.assertEqual(self.scrape('').status_code, 404)
+
+    @override_settings(METRICS_SAMPLE_RATE=0)
+    def test_nothing_is_measured_with_sampling_off(self):
+        self.client.get(reverse('product_list'))
+        self.assertEqual(metrics.registry.histograms, {})
@@ -1,12 +1,32 @@
+import hashlib
+from urllib.parse import urlencode
+
 from django.views.generic import ListView, DetailView
-from django.db.models import Count
-from django.views.decorators.cache import cache_page
-from django.utils.decorators import method_decorator
+from django.conf import settings
 from django.core.cache import cache
+from django.core.paginator import InvalidPage
+from django.http import Http404, JsonResponse
 from django.shortcuts import render
+from django.utils.functional import SimpleLazyObject, cached_property
 from django.utils.translation import gettext_lazy as _
 from django.utils.translation import get_language
-from .models import Category, Product
+from order.cart import CartStore
+from .cache import (
+    aget_versions, get_catalog_state, get_catalog_timeout, get_listing_cache_key, get_sidebar_categories, get_versions,
+    is_cache_shared,
+)
+from .conditional import (
+    aget_page_state, conditional_response, get_page_state, has_pending_messages, make_etag, set_validators
+)
+from .facets import (
+    PRICE_BOUNDS, STOCK_CHOICES, STOCK_LABELS, filter_products, get_facet_counts, get_price_label
+)
+from .labels import get_labels
+from .models import Product
+from .pagination import KeysetPaginator
+from .popularity import ALL_TIME, get_bucket_start, get_popular_products
+from .related import aget_related_products, get_related_products
+from .search import SearchPaginator
 
 
 def handler404(request, exception):
@@ -21,9 +41,15 @@ def handler500(request):
     }, status=500)
 
 
+# Popularity is counted per calendar hour, day or week, see store.popularity
+HOME_POPULAR_PERIOD = ALL_TIME
+
+
 def index(request):
     return render(request, 'store/home.html', {
-        'page_title': _('Welcome to our store')
+        'page_title': _('Welcome to our store'),
+        'popular_products': get_popular_products(HOME_POPULAR_PERIOD),
+        'popular_since': get_bucket_start(HOME_POPULAR_PERIOD)
     })
 
 
@@ -38,19 +64,44 @@ def contact(request):
     })
 
 
-@method_decorator(cache_page(60 * 15), name='dispatch')
-class ProductListView(ListView):
+class ConditionalGetMixin:
+    """Answers If-None-Match and If-Modified-Since with 304 before anything is loaded or rendered"""
+
+    def get_validators(self):
+        """(etag, last modified), None for either disables it"""
+        return None, None
+
+    def get(self, request, *args, **kwargs):
+        etag, last_modified = self.get_validators()
+        response = conditional_response(request, etag, last_modified)
+        if response is None:
+            response = set_validators(super().get(request, *args, **kwargs), etag, last_modified)
+        return response
+
+
+class ProductListView(ConditionalGetMixin, ListView):
     model = Product
     context_object_name = 'products'
     template_name = 'store/shop.html'
     paginate_by = 9
+    sort_keys = ('price', '-price', 'name', '-name', 'created_at', '-created_at')
 
-    def get_queryset(self):
+    @property
+    def pagination_mode(self):
+        # 'offset' for numbered pages, 'keyset' for cursor pagination on large catalogs
+        return getattr(settings, 'PRODUCT_LIST_PAGINATION', 'offset')
+
+    def get_sort(self):
+        """The sort parameter from URL, default to '-created_at'"""
+        sort_by = self.request.GET.get('sort', '-created_at')
+        return sort_by if sort_by in self.sort_keys else '-created_at'
+
+    def get_sort_field(self):
         # Get the current language
         current_language = get_language()
 
         # Get the sort parameter from URL, default to '-created_at'
-        sort_by = self.request.GET.get('sort', '-created_at')
+        sort_by = self.get_sort()
 
         # Define allowed sort fields with translations
         allowed_sort_fields = {
@@ -63,8 +114,9 @@ class ProductListView(ListView):
         }
 
         # Get the actual sort field
-        sort_field = allowed_sort_fields.get(sort_by, ('-created_at', _('Newest First')))[0]
+        return allowed_sort_fields.get(sort_by, ('-created_at', _('Newest First')))[0]
 
+    def get_queryset(self):
         # Start with all products
         queryset = Product.objects.all()
 
@@ -72,19 +124,150 @@ class ProductListView(ListView):
         if self.kwargs.get('slug'):
             queryset = queryset.filter(category__slug=self.kwargs.get('slug'))
 
+        # Apply price and stock facets
+        queryset = filter_products(queryset, *self.facet_filters)
+
         # Apply sorting
-        return queryset.order_by(sort_field)
+        return queryset.order_by(self.get_sort_field())
+
+    @cached_property
+    def facet_filters(self):
+        """(price bucket, in stock) from the URL, None for facets that are not selected"""
+        price = self.request.GET.get('price', '')
+        price_bucket = int(price) if price.isdigit() and int(price) < len(PRICE_BOUNDS) else None
+        return price_bucket, STOCK_CHOICES.get(self.request.GET.get('stock'))
+
+    def get_validators(self):
+        if has_pending_messages(self.request):
+            return None, None
+        # Sort, page and filters are in the URL. Any product or category change
+        # bumps one of these, both are in every listing and sidebar cache key.
+        if is_cache_shared():
+            versions = get_versions('catalog', 'all')
+            catalog = [versions['catalog'], versions['all']]
+        else:
+            # The counters are per process, another worker would answer 304 for good
+            catalog = get_catalog_state()
+        return make_etag(
+            'product_list', self.pagination_mode, *catalog, *get_page_state(self.request, get_cart_count(self.request))
+        ), None
+
+    def get_filter_params(self):
+        price_bucket, in_stock = self.facet_filters
+        params = {}
+        if price_bucket is not None:
+            params['price'] = price_bucket
+        if in_stock is not None:
+            params['stock'] = 'in' if in_stock else 'out'
+        return params
+
+    def get_facet_query(self, **changes):
+        """Query string for the current sort and filters with some facets changed, None removes one"""
+        params = {'sort': self.get_sort(), **self.get_filter_params(), **changes}
+        return urlencode({key: value for key, value in params.items() if value is not None})
+
+    def get_filters_cache_key(self):
+        price_bucket, in_stock = self.facet_filters
+        return f'{price_bucket}.{in_stock}'
+
+    @cached_property
+    def category(self):
+        """The category for the slug in the URL, looked up in the cached sidebar"""
+        slug = self.kwargs.get('slug')
+        if not slug:
+            return None
+        return next((category for category in get_sidebar_categories() if category.slug == slug), None)
+
+    def paginate_queryset(self, queryset, page_size):
+        if self.pagination_mode == 'keyset':
+            return self.paginate_keyset(queryset, page_size)
+
+        # Cache the product count and the products of each page, keyed on
+        # language, category, sort and page and invalidated by version bumps
+        page_number = self.request.GET.get(self.page_kwarg) or '1'
+        if page_number != 'last' and not page_number.isdigit():
+            raise Http404(_('Invalid page'))
+        cache_key = get_listing_cache_key(
+            self.kwargs.get('slug'), self.category, self.get_sort(), page_number, self.get_filters_cache_key()
+        )
+        paginator = self.get_paginator(
+            queryset, page_size, orphans=self.get_paginate_orphans(),
+            allow_empty_first_page=self.get_allow_empty()
+        )
+        cached = cache.get(cache_key)
+        if cached is not None:
+            paginator.count = cached['count']
+        page = self.get_page(paginator, page_number)
+        if cached is None:
+            cached = {'count': paginator.count, 'products': list(page.object_list)}
+            cache.set(cache_key, cached, get_catalog_timeout())
+        page.object_list = cached['products']
+        return paginator, page, page.object_list, page.has_other_pages()
+
+    def paginate_keyset(self, queryset, page_size):
+        # Seek pagination: deep pages cost the same as the first one and no COUNT(*) is run
+        paginator = KeysetPaginator(queryset, page_size, self.get_sort_field())
+        cursor = self.request.GET.get('cursor')
+        cursor_hash = hashlib.md5(cursor.encode()).hexdigest() if cursor else 'first'
+        cache_key = get_listing_cache_key(
+            self.kwargs.get('slug'), self.category, self.get_sort(), f'cursor-{cursor_hash}',
+            self.get_filters_cache_key()
+        )
+        page = cache.get(cache_key)
+        if page is None:
+            try:
+                page = paginator.page(cursor)
+            except InvalidPage:
+                raise Http404(_('Invalid page'))
+            cache.set(cache_key, page, get_catalog_timeout())
+        return paginator, page, page.object_list, page.has_other_pages()
+
+    def get_page(self, paginator, page_number):
+        try:
+            page_number = paginator.num_pages if page_number == 'last' else int(page_number)
+            return paginator.page(page_number)
+        except (ValueError, InvalidPage):
+            raise Http404(_('Invalid page'))
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
         # Get categories with translated names and product count
-        context['categories'] = Category.objects.annotate(product_count=Count('products'))
+        context['categories'] = get_sidebar_categories()
 
-        # Add pagination context
-        context['get_elided_page_range'] = context['paginator'].get_elided_page_range(
-            self.request.GET.get(self.page_kwarg, 1)
+        # Facet counts for the sidebar, all read from one cached table
+        price_bucket, in_stock = self.facet_filters
+        counts = get_facet_counts(
+            self.category.id if self.category is not None else None, price_bucket, in_stock
         )
+        context['category_facets'] = [
+            {'category': category, 'count': counts['categories'].get(category.id, 0)}
+            for category in context['categories']
+        ]
+        context['price_facets'] = [
+            {
+                'label': get_price_label(bucket), 'count': counts['prices'].get(bucket, 0),
+                'selected': bucket == price_bucket,
+                'query': self.get_facet_query(price=None if bucket == price_bucket else bucket),
+            }
+            for bucket in range(len(PRICE_BOUNDS))
+        ]
+        context['stock_facets'] = [
+            {
+                'label': STOCK_LABELS[flag], 'count': counts['stock'][flag], 'selected': flag == in_stock,
+                'query': self.get_facet_query(stock=None if flag == in_stock else value),
+            }
+            for value, flag in STOCK_CHOICES.items()
+        ]
+        # Filters to keep when following category and page links
+        context['filter_query'] = urlencode(self.get_filter_params())
+
+        # Add pagination context
+        context['keyset_pagination'] = self.pagination_mode == 'keyset'
+        if not context['keyset_pagination']:
+            context['get_elided_page_range'] = context['paginator'].get_elided_page_range(
+                self.request.GET.get(self.page_kwarg, 1)
+            )
 
         # Add current sort to context with translation
         current_sort = self.request.GET.get('sort', '-created_at')
@@ -97,57 +280,132 @@ class ProductListView(ListView):
         ]
 
         # Add page title
-        category_slug = self.kwargs.get('slug')
-        if category_slug:
-            try:
-                category = Category.objects.get(slug=category_slug)
-                context['page_title'] = _('Products in category: %(category)s') % {'category': category.name}
-            except Category.DoesNotExist:
-                context['page_title'] = _('All Products')
+        if self.category is not None:
+            context['page_title'] = _('Products in category: %(category)s') % {'category': self.category.name}
         else:
             context['page_title'] = _('All Products')
 
         return context
 
 
-class ProductDetailView(DetailView):
+class ProductSearchView(ListView):
+    context_object_name = 'products'
+    template_name = 'store/search.html'
+    paginate_by = 9
+    max_query_length = 200
+
+    def get_query(self):
+        return self.request.GET.get('q', '').strip()[:self.max_query_length]
+
+    def get_queryset(self):
+        # Results come from the search index, see paginate_queryset
+        return Product.objects.none()
+
+    def paginate_queryset(self, queryset, page_size):
+        paginator = SearchPaginator(self.get_query(), page_size)
+        try:
+            page = paginator.page(self.request.GET.get('cursor'))
+        except InvalidPage:
+            raise Http404(_('Invalid page'))
+        return paginator, page, page.object_list, page.has_other_pages()
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['query'] = self.get_query()
+        context['page_title'] = _('Search results for "%(query)s"') % {'query': context['query']}
+        return context
+
+    def render_to_response(self, context, **response_kwargs):
+        if self.request.headers.get('x-requested-with') == 'XMLHttpRequest':
+            page = context['page_obj']
+            return JsonResponse({
+                'query': context['query'],
+                'results': [
+                    {'id': product.id, 'name': product.name, 'slug': product.slug, 'price': str(product.price)}
+                    for product in page
+                ],
+                'next_cursor': page.next_cursor,
+            })
+        return super().render_to_response(context, **response_kwargs)
+
+
+class ProductDetailView(ConditionalGetMixin, DetailView):
     model = Product
     context_object_name = 'product'
     template_name = 'store/shop-detail.html'
 
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
+    def get_validator_queryset(self):
+        return Product.objects.filter(slug=self.kwargs.get(self.slug_url_kwarg)).values('updated_at', 'category_id')
 
-        # Cache related products for this product
-        cache_key = f'related_products_{self.object.id}_{get_language()}'
-        related_products = cache.get(cache_key)
+    def make_validators(self, product, versions, page_state):
+        # The related products and the category name change with the versions,
+        # Last-Modified only covers the product itself
+        scope = f"category:{product['category_id']}"
+        etag = make_etag(
+            'product', self.kwargs.get(self.slug_url_kwarg), product['updated_at'].isoformat(),
+            versions['catalog'], versions[scope], *page_state
+        )
+        return etag, product['updated_at']
+
+    def get_validators(self):
+        if has_pending_messages(self.request):
+            return None, None
+        product = self.get_validator_queryset().first()
+        if product is None:
+            return None, None
+        versions = get_versions('catalog', f"category:{product['category_id']}")
+        return self.make_validators(product, versions, get_page_state(self.request, get_cart_count(self.request)))
+
+    async def aget_validators(self):
+        if has_pending_messages(self.request):
+            return None, None
+        product = await self.get_validator_queryset().afirst()
+        if product is None:
+            return None, None
+        versions = await aget_versions('catalog', f"category:{product['category_id']}")
+        # Counted here, the cart_processor reuses it when the page renders
+        self.request.cart_count = await CartStore(self.request).acount()
+        return self.make_validators(product, versions, await aget_page_state(self.request, self.request.cart_count))
 
-        if not related_products:
-            related_products = Product.objects.filter(
-                category=self.object.category
-            ).exclude(id=self.object.id)[:4]
-            cache.set(cache_key, related_products, 60 * 30)  # Cache for 30 minutes
+    def get_context_data(self, **kwargs):
+        # Async views pass the related products in
+        if 'related_products' not in kwargs:
+            kwargs['related_products'] = get_related_products(self.object)
+        context = super().get_context_data(**kwargs)
 
-        context['related_products'] = related_products
         context['page_title'] = self.object.name
-        context['product_details'] = {
-            'category': _('Category'),
-            'price': _('Price'),
-            'in_stock': _('In Stock'),
-            'out_of_stock': _('Out of Stock'),
-            'description': _('Description')
-        }
+        context['product_details'] = get_labels('product_details')
         return context
 
 
+class AsyncProductDetailView(ProductDetailView):
+    async def get(self, request, *args, **kwargs):
+        etag, last_modified = await self.aget_validators()
+        response = conditional_response(request, etag, last_modified)
+        if response is not None:
+            return response
+
+        self.object = await self.get_queryset().filter(slug=self.kwargs.get(self.slug_url_kwarg)).afirst()
+        if self.object is None:
+            raise Http404(_('No product found matching the query'))
+        related_products = await aget_related_products(self.object)
+        response = self.render_to_response(self.get_context_data(object=self.object, related_products=related_products))
+        return set_validators(response, etag, last_modified)
+
+
+def get_cart_count(request):
+    """The visitor's cart count, counted on first use and once per request"""
+    if not hasattr(request, 'cart_count'):
+        request.cart_count = SimpleLazyObject(CartStore(request).count)
+    return request.cart_count
+
+
 def cart_processor(request):
-    if hasattr(request, 'session'):
-        cart = request.session.get('cart', {})
-        return {
-            'cart_count': len(cart),
-            'cart_label': _('Cart')
-        }
+    if hasattr(request, 'session') and hasattr(request, 'user'):
+        cart_count = get_cart_count(request)
+    else:
+        cart_count = 0
     return {
-        'cart_count': 0,
+        'cart_count': cart_count,
         'cart_label': _('Cart')
-    }
\ No newline at end of file
+    }
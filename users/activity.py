@@ -0,0 +1,112 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import CustomUser
+
+# Pending activity stamps live in the cache. With redis every worker process
+# (and the flush_user_activity command) sees the same buffer; the local cache
+# is per process, there each worker flushes its own stamps from the middleware.
+# Each newly dirty user is appended to a numbered slot, so a flush only has to
+# read the slots written since the previous flush. A stamp is kept as long as
+# its slot, whenever the next flush comes.
+KEY_PREFIX = 'user_activity'
+SEQ_KEY = f'{KEY_PREFIX}:seq'
+FLUSHED_KEY = f'{KEY_PREFIX}:flushed'
+SLOT_TIMEOUT = 60 * 60 * 24
+
+_last_flush = time.monotonic()
+
+
+def get_granularity():
+    """How stale last_active_datetime may get before a new stamp is recorded"""
+    return timedelta(seconds=getattr(settings, 'USER_ACTIVITY_GRANULARITY', 300))
+
+
+def get_flush_interval():
+    return getattr(settings, 'USER_ACTIVITY_FLUSH_INTERVAL', 60)
+
+
+def is_buffer_shared():
+    # django_redis backends (also the metrics subclass) expose their client
+    return hasattr(cache, 'client')
+
+
+def _user_key(user_id):
+    return f'{KEY_PREFIX}:user:{user_id}'
+
+
+def _slot_key(slot):
+    return f'{KEY_PREFIX}:slot:{slot}'
+
+
+def is_activity_stale(user, now=None):
+    """True if last_active_datetime is older than the granularity and a stamp is due"""
+    last_active = user.last_active_datetime
+    return last_active is None or (now or timezone.now()) - last_active >= get_granularity()
+
+
+def record_activity(user, now=None):
+    """Buffer an activity stamp for the user, returns True if one was recorded"""
+    now = now or timezone.now()
+    if not is_activity_stale(user, now):
+        return False
+
+    # Only the first stamp inside a flush window claims a slot, later ones just
+    # move the pending value forward. A pending stamp whose slot was evicted
+    # would never be flushed, so it claims a new one.
+    pending = cache.get(_user_key(user.pk))
+    if pending is not None and cache.get(_slot_key(pending[0])) == user.pk:
+        slot = pending[0]
+    else:
+        cache.add(SEQ_KEY, 0, None)
+        slot = cache.incr(SEQ_KEY)
+        cache.set(_slot_key(slot), user.pk, SLOT_TIMEOUT)
+    cache.set(_user_key(user.pk), [slot, now.isoformat()], SLOT_TIMEOUT)
+
+    user.last_active_datetime = now
+    return True
+
+
+def flush_activity(batch_size=500):
+    """Write buffered activity stamps with bulk UPDATEs, returns the number of users updated"""
+    global _last_flush
+    _last_flush = time.monotonic()
+
+    last_slot = cache.get(SEQ_KEY) or 0
+    first_slot = (cache.get(FLUSHED_KEY) or 0) + 1
+    if first_slot > last_slot:
+        return 0
+
+    slot_keys = [_slot_key(slot) for slot in range(first_slot, last_slot + 1)]
+    user_ids = set(cache.get_many(slot_keys).values())
+    user_keys = [_user_key(user_id) for user_id in user_ids]
+    pending = cache.get_many(user_keys)
+
+    users = []
+    for user_id in user_ids:
+        stamp = pending.get(_user_key(user_id))
+        if stamp:
+            users.append(CustomUser(pk=user_id, last_active_datetime=parse_datetime(stamp[1])))
+
+    # Release the buffer before writing so stamps recorded during the UPDATE
+    # claim new slots instead of being dropped with these keys.
+    cache.delete_many(slot_keys + user_keys)
+    cache.set(FLUSHED_KEY, last_slot, None)
+
+    CustomUser.objects.bulk_update(users, ['last_active_datetime'], batch_size=batch_size)
+    return len(users)
+
+
+def is_flush_due():
+    return time.monotonic() - _last_flush >= get_flush_interval()
+
+
+def flush_activity_if_due():
+    if is_flush_due():
+        return flush_activity()
+    return 0
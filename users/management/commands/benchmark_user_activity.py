@@ -0,0 +1,68 @@
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.http import HttpResponse
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from users.activity import flush_activity
+from users.middleware import UserActivityMiddleware
+from users.models import CustomUser
+
+
+class LegacyUserActivityMiddleware:
+    """The previous behaviour: a full-row save on every authenticated request"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if request.user.is_authenticated:
+            request.user.last_active_datetime = timezone.now()
+            request.user.save()
+        return self.get_response(request)
+
+
+class Command(BaseCommand):
+    help = 'Count database writes per authenticated requests with and without activity buffering'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=1000, help='Number of simulated requests')
+        parser.add_argument('--users', type=int, default=50, help='Number of distinct users')
+
+    def handle(self, *args, **options):
+        # Everything runs inside a transaction that is rolled back afterwards
+        with transaction.atomic():
+            users = CustomUser.objects.bulk_create([
+                CustomUser(username=f'benchmark-activity-{i}') for i in range(options['users'])
+            ])
+            legacy = self.run(LegacyUserActivityMiddleware, users, options['requests'])
+            cache.clear()
+            buffered = self.run(UserActivityMiddleware, users, options['requests'], flush=True)
+            transaction.set_rollback(True)
+
+        self.stdout.write(f"Requests: {options['requests']}, users: {options['users']}")
+        self.stdout.write(f'Per-request save: {legacy} writes')
+        self.stdout.write(self.style.SUCCESS(f'Buffered tracker: {buffered} writes'))
+
+    def run(self, middleware_class, users, total, flush=False):
+        factory = RequestFactory()
+        middleware = middleware_class(lambda request: HttpResponse())
+        # Start every user out stale so each one needs at least one stamp
+        CustomUser.objects.filter(pk__in=[user.pk for user in users]).update(
+            last_active_datetime=timezone.now() - timedelta(days=1)
+        )
+
+        with CaptureQueriesContext(connection) as queries:
+            for i in range(total):
+                request = factory.get('/')
+                # Simulate AuthenticationMiddleware loading a fresh user per request
+                request.user = CustomUser.objects.get(pk=users[i % len(users)].pk)
+                middleware(request)
+            if flush:
+                flush_activity()
+
+        return sum(1 for query in queries if query['sql'].startswith('UPDATE'))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from users.activity import flush_activity, is_buffer_shared
+
+
+class Command(BaseCommand):
+    help = 'Write buffered user activity stamps to the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Number of users per bulk UPDATE'
+        )
+
+    def handle(self, *args, **options):
+        if not is_buffer_shared():
+            # This process would only see its own, empty, buffer
+            raise CommandError('The activity buffer is per process without a shared cache, set REDIS_URL')
+        updated = flush_activity(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Flushed activity for {updated} users'))
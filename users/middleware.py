@@ -1,12 +1,36 @@
-from django.utils import timezone
-from django.contrib.auth.decorators import login_required
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+from users.activity import flush_activity_if_due, is_activity_stale, is_flush_due, record_activity
+
 
 class UserActivityMiddleware:
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
+        if not getattr(settings, 'USER_ACTIVITY_TRACKING', True):
+            raise MiddlewareNotUsed
         self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
 
     def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
         if request.user.is_authenticated:
-            request.user.last_active_datetime = timezone.now()
-            request.user.save()
-        return self.get_response(request)
\ No newline at end of file
+            self.process_activity(request.user)
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        user = await request.auser()
+        # Most requests have nothing to record, only leave the event loop when there is
+        if user.is_authenticated and (is_activity_stale(user) or is_flush_due()):
+            await sync_to_async(self.process_activity)(user)
+        return await self.get_response(request)
+
+    def process_activity(self, user):
+        # Stamps are buffered and written in bulk instead of saving the user on every request
+        record_activity(user)
+        flush_activity_if_due()
@@ -1,3 +1,78 @@
-from django.test import TestCase
+import time
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from users import activity
+from users.models import CustomUser
+
+
+class UserActivityTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = CustomUser.objects.create_user(username='shopper', password='secret-password')
+
+    def last_active(self):
+        return CustomUser.objects.values_list('last_active_datetime', flat=True).get(pk=self.user.pk)
+
+    def test_stamps_are_buffered_until_the_flush(self):
+        first = timezone.now()
+        self.assertTrue(activity.record_activity(self.user, first))
+        # Not stale yet for the same request user
+        self.assertFalse(activity.record_activity(self.user, first + timedelta(seconds=1)))
+        # A fresh copy of the user, as the next request would load it
+        later = first + timedelta(seconds=5)
+        self.assertTrue(activity.record_activity(CustomUser.objects.get(pk=self.user.pk), later))
+        self.assertIsNone(self.last_active())
+        self.assertEqual(cache.get(activity.SEQ_KEY), 1)
+
+        self.assertEqual(activity.flush_activity(), 1)
+        self.assertEqual(self.last_active(), later)
+        self.assertEqual(activity.flush_activity(), 0)
+
+    def test_stamp_with_an_evicted_slot_is_queued_again(self):
+        activity.record_activity(self.user)
+        cache.delete(activity._slot_key(1))
+        stamp = timezone.now()
+        activity.record_activity(CustomUser.objects.get(pk=self.user.pk), stamp)
+        self.assertEqual(activity.flush_activity(), 1)
+        self.assertEqual(self.last_active(), stamp)
+
+    def test_stamp_is_kept_until_the_flush(self):
+        stamp = timezone.now()
+        activity.record_activity(self.user, stamp)
+        # A quiet hour without any request that would flush it
+        with mock.patch('django.core.cache.backends.locmem.time.time', return_value=time.time() + 60 * 60):
+            self.assertEqual(activity.flush_activity(), 1)
+        self.assertEqual(self.last_active(), stamp)
+
+    def test_flush_command(self):
+        other = CustomUser.objects.create_user(username='other', password='secret-password')
+        activity.record_activity(self.user)
+        activity.record_activity(other)
+        output = StringIO()
+        with mock.patch('users.management.commands.flush_user_activity.is_buffer_shared', return_value=True):
+            call_command('flush_user_activity', stdout=output)
+        self.assertIn('Flushed activity for 2 users', output.getvalue())
+        self.assertEqual(CustomUser.objects.filter(last_active_datetime__isnull=False).count(), 2)
+
+    def test_flush_command_needs_a_shared_cache(self):
+        with self.assertRaisesMessage(CommandError, 'set REDIS_URL'):
+            call_command('flush_user_activity')
+
+    def test_middleware_buffers_requests(self):
+        self.client.force_login(self.user)
+        self.client.get(reverse('home'))
+        self.assertIsNotNone(cache.get(activity._user_key(self.user.pk)))
+
+    @override_settings(USER_ACTIVITY_TRACKING=False)
+    def test_tracking_can_be_switched_off(self):
+        self.client.force_login(self.user)
+        self.client.get(reverse('home'))
+        self.assertIsNone(cache.get(activity._user_key(self.user.pk)))